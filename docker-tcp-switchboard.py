@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 
 from twisted.protocols.portforward import *
-from twisted.internet import reactor
+from twisted.internet import reactor, threads, defer, task, protocol, address
+from twisted.web import server, resource
+from twisted.protocols import amp
 
-import time, socket
+import time, socket, os, sys
 import configparser, glob
-import random, string
+import random
 import pprint
 import json
+import struct
+import ipaddress
+import urllib.parse
 import docker
-import copy
+import collections
+import collections.abc
+import types
+import pickle
+import bisect
+import math
+import queue
+import threading
+import signal
+import itertools
+import tempfile, shutil
 
 import logging
 import logging.handlers
@@ -21,10 +36,71 @@ logger = logging.getLogger("docker-tcp-switchboard")
 class DockerPorts():
     CONFIG_PROFILEPREFIX = "profile:"
     CONFIG_DOCKEROPTIONSPREFIX = "dockeroptions:"
+    CONFIG_DOCKERHOSTPREFIX = "dockerhost:"
+    # a pool that grew beyond prewarm shrinks back by one instance per this many seconds without a pool miss
+    POOL_SHRINKAFTER = 60
 
     def __init__(self):
         self.instancesByName = dict()
         self.imageParams = dict()
+        # pools of started and verified instances waiting to be handed out, per profile
+        self.idleByName = dict()
+        self.poolTarget = dict()
+        self.poolRefilling = dict()
+        self.poolLastMiss = dict()
+        self.poolHits = dict()
+        self.poolMisses = dict()
+        # instances of ended sessions, held for the client to resume, per profile
+        self.heldByName = dict()
+        self.poolShrinker = task.LoopingCall(self._shrinkPools)
+        self.shuttingDown = False
+        # docker daemons to place containers on. Each has one docker client, and its pool of
+        # connections to the daemon, shared by all instances on it
+        self.dockerHosts = dict()
+        self.dockerPoolSize = None
+        self.scheduler = "leastloaded"
+        # admission control for spawning containers, globally and per profile
+        self.spawnLimiter = SpawnLimiter()
+        self.spawnLimiters = dict()
+        self.limitQueues = dict()
+        # how to tell that a new instance is ready, per profile, and how long it took, per kind of check
+        self.readinessChecks = dict()
+        self.readyTimes = dict()
+        # checkpoints to restore new containers from, per profile with startmode checkpoint
+        self.checkpoints = dict()
+        self.checkpointDir = "/var/lib/docker-tcp-switchboard/checkpoints"
+        self.checkpointSerial = itertools.count()
+        self.stats = dict()
+        self.metricsPort = None
+        self.metricsInterface = "127.0.0.1"
+        # containers are labelled with the switchboard they belong to, and with the process that
+        # started them, so that leftovers from a previous process can be found and removed
+        self.switchboardID = socket.gethostname()
+        self.generation = "{}.{}".format(os.getpid(), int(time.time()))
+        self.reaper = ContainerReaper(self._getDockerHosts)
+        self.reaperInterval = 60
+        self.orphanSweeper = task.LoopingCall(self._sweepOrphans)
+        # samples the resources used by containers, for profiles with resource limits
+        self.resourceMonitor = ResourceMonitor(self._runningInstances, self._resourcesSampled)
+        # enforces session time limits and bandwidth limits
+        self.timerWheel = TimerWheel()
+        # JSON-lines log of sessions, for accounting
+        self.eventLog = None
+        # listening ports per profile, and the interface to listen on (None to not listen)
+        self.listeners = dict()
+        self.interface = None
+        self.listenBacklog = 50
+        # profiles that were removed from the config, but may still have sessions
+        self.retiredProfiles = set()
+        # profiles that do not accept sessions until they are undrained on the admin socket
+        self.drainedProfiles = set()
+        self.adminSocket = None
+        # with workers, this process manages the containers and worker processes relay the sessions
+        self.workers = 0
+        # None for a socket in a directory of its own, made at startup, that only this user can enter
+        self.coordinatorSocket = None
+        # the coordinator's connections to the workers
+        self.workerProtocols = set()
 
     def _getProfilesList(self, config):
         out = []
@@ -35,23 +111,62 @@ class DockerPorts():
 
     def _readProfileConfig(self, config, profilename):
         fullprofilename = "{}{}".format(self.CONFIG_PROFILEPREFIX, profilename)
+        for option in ["container", "outerport", "innerport"]:
+            if option not in config[fullprofilename]:
+                raise ValueError("Missing option {}".format(option))
         innerport = self._parseInt(config[fullprofilename]["innerport"])
         checkupport = self._parseInt(config[fullprofilename]["checkupport"]) if "checkupport" in config[fullprofilename] else innerport
-        return {
-            "outerport": int(config[fullprofilename]["outerport"]),
+        prewarm = self._parseInt(config[fullprofilename]["prewarm"]) if "prewarm" in config[fullprofilename] else 0
+        spec = ProfileSpec(profilename, **{
+            "outerport": self._parseInt(config[fullprofilename]["outerport"]),
             "innerport": innerport,
             "containername": config[fullprofilename]["container"],
             "checkupport": checkupport,
             "limit": self._parseInt(config[fullprofilename]["limit"]) if "limit" in config[fullprofilename] else 0,
             "reuse": self._parseTruthy(config[fullprofilename]["reuse"]) if "reuse" in config[fullprofilename] else False,
+            "reusesessions": self._parseInt(config[fullprofilename]["reusesessions"]) if "reusesessions" in config[fullprofilename] else 0,
+            "prewarm": prewarm,
+            "maxidle": max(prewarm, self._parseInt(config[fullprofilename]["maxidle"]) if "maxidle" in config[fullprofilename] else prewarm),
+            "prewarmdelay": float(config[fullprofilename]["prewarmdelay"]) if "prewarmdelay" in config[fullprofilename] else 1.0,
+            "spawnrate": float(config[fullprofilename]["spawnrate"]) if "spawnrate" in config[fullprofilename] else 0,
+            "spawnburst": self._parseInt(config[fullprofilename]["spawnburst"]) if "spawnburst" in config[fullprofilename] else 0,
+            "limitwait": float(config[fullprofilename]["limitwait"]) if "limitwait" in config[fullprofilename] else 0,
+            "limitqueuesize": self._parseInt(config[fullprofilename]["limitqueuesize"]) if "limitqueuesize" in config[fullprofilename] else 100,
+            "readiness": self._parseChoice(config[fullprofilename]["readiness"], READINESSCHECKS.keys()) if "readiness" in config[fullprofilename] else "banner",
+            "readinesstimeout": float(config[fullprofilename]["readinesstimeout"]) if "readinesstimeout" in config[fullprofilename] else 5,
+            "maxduration": float(config[fullprofilename]["maxduration"]) if "maxduration" in config[fullprofilename] else 0,
+            "idletimeout": float(config[fullprofilename]["idletimeout"]) if "idletimeout" in config[fullprofilename] else 0,
+            "maxbytes": self._parseInt(config[fullprofilename]["maxbytes"]) if "maxbytes" in config[fullprofilename] else 0,
+            "ratelimit": self._parseInt(config[fullprofilename]["ratelimit"]) if "ratelimit" in config[fullprofilename] else 0,
+            "highwatermark": self._parseInt(config[fullprofilename]["highwatermark"]) if "highwatermark" in config[fullprofilename] else 65536,
+            "startmode": self._parseChoice(config[fullprofilename]["startmode"], STARTMODES) if "startmode" in config[fullprofilename] else "run",
+            "resumegrace": float(config[fullprofilename]["resumegrace"]) if "resumegrace" in config[fullprofilename] else 0,
+            "resumekey": self._parseChoice(config[fullprofilename]["resumekey"], RESUMEKEYS.keys()) if "resumekey" in config[fullprofilename] else None,
+            "resumetlv": int(config[fullprofilename]["resumetlv"], 0) if "resumetlv" in config[fullprofilename] else 0xE0,
+            "resumemax": self._parseInt(config[fullprofilename]["resumemax"]) if "resumemax" in config[fullprofilename] else 0,
+            "acceptproxy": self._parseTruthy(config[fullprofilename]["acceptproxy"]) if "acceptproxy" in config[fullprofilename] else False,
+            "sendproxy": self._parseChoice(config[fullprofilename]["sendproxy"], ["none", "v1", "v2"]) if "sendproxy" in config[fullprofilename] else "none",
+            "maxcpu": float(config[fullprofilename]["maxcpu"]) if "maxcpu" in config[fullprofilename] else 0,
+            "maxmemory": self._parseSize(config[fullprofilename]["maxmemory"]) if "maxmemory" in config[fullprofilename] else 0,
+            "maxload": float(config[fullprofilename]["maxload"]) if "maxload" in config[fullprofilename] else 0,
+            "dockerhosts": tuple(self._parseChoice(h.strip(), self.dockerHosts.keys()) for h in config[fullprofilename]["dockerhosts"].split(",")) if "dockerhosts" in config[fullprofilename] else tuple(sorted(self.dockerHosts.keys())),
             "dockeroptions": self._getDockerOptions(config, profilename, innerport, checkupport)
-        }
+        })
+        # the arguments to create containers are compiled for the docker hosts already
+        # connected to now, so that starting a container only looks them up
+        for hostname in spec.dockerhosts:
+            version = self._apiVersion(hostname)
+            if version != None:
+                spec.createArgs(version)
+        # the load is only known for the machine the switchboard runs on
+        if spec.maxload > 0 and not all(self.dockerHosts[hostname].isLocal() for hostname in spec.dockerhosts):
+            raise ValueError("Invalid value {} for maxload, expected 0 with docker hosts on other machines".format(spec.maxload))
+        return spec
 
     def _addDockerOptionsFromConfigSection(self, config, sectionname, base={}):
-        import collections
         def update(d, u):
             for k, v in u.items():
-                if isinstance(v, collections.Mapping):
+                if isinstance(v, collections.abc.Mapping):
                     r = update(d.get(k, {}), v)
                     d[k] = r
                 else:
@@ -59,9 +174,14 @@ class DockerPorts():
             return d
 
         # we may need to read json values
-        def guessvalue(v):
-            if v in ["True", "False"] or all(c in string.digits for c in v) or v.startswith("[") or v.startswith("{"):
-                return json.loads(v)
+        def guessvalue(k, v):
+            if v in ["True", "False"]:
+                return v == "True"
+            if v.isdigit() or v.startswith("[") or v.startswith("{"):
+                try:
+                    return json.loads(v)
+                except ValueError as e:
+                    raise ValueError("Invalid value {} for {} in section {}: {}".format(v, k, sectionname, e))
             return v
 
         # if sectionname doesn't exist, return base
@@ -70,7 +190,7 @@ class DockerPorts():
             newvals = dict(config[sectionname])
             fixedvals = {}
             for (k,v) in newvals.items():
-                fixedvals[k] = guessvalue(v)
+                fixedvals[k] = guessvalue(k, v)
             base = update(base, fixedvals)
             
         return base # FIXME
@@ -81,6 +201,12 @@ class DockerPorts():
         out = self._addDockerOptionsFromConfigSection(config, "{}{}".format(self.CONFIG_DOCKEROPTIONSPREFIX, profilename), out)
 
         out["detach"] = True
+        labels = out.get("labels", {})
+        if isinstance(labels, list):
+            labels = dict((label, "") for label in labels)
+        labels[ContainerReaper.LABEL_OWNER] = self.switchboardID
+        labels[ContainerReaper.LABEL_GENERATION] = self.generation
+        out["labels"] = labels
         if "ports" not in out:
             out["ports"] = {}
         out["ports"][innerport] = None
@@ -91,10 +217,50 @@ class DockerPorts():
         #out["auto_remove"] = True
         return out
 
+    def _getDockerHostsList(self, config):
+        out = []
+        for n in config.sections():
+            if n.startswith(self.CONFIG_DOCKERHOSTPREFIX):
+                out += [n[len(self.CONFIG_DOCKERHOSTPREFIX):]]
+        return out
+
+    def _readDockerHostConfig(self, config, hostname):
+        section = config["{}{}".format(self.CONFIG_DOCKERHOSTPREFIX, hostname)]
+        url = section["url"]
+        # mapped ports are published on the address of the daemon's host
+        address = urllib.parse.urlparse(url).hostname if url.startswith(("tcp://", "http://", "https://")) else "0.0.0.0"
+        return DockerHost(hostname, url,
+            section["address"] if "address" in section else address,
+            float(section["weight"]) if "weight" in section else 1.0,
+            self._parseInt(section["maxcontainers"]) if "maxcontainers" in section else 0,
+            self.dockerPoolSize)
+
+    def _getDockerHosts(self):
+        return list(self.dockerHosts.values())
+
+    # the docker API version of a docker host, or None until its client has connected.
+    # Connecting can take as long as the daemon takes to answer, so it never happens on the
+    # reactor thread: _connectHosts() connects them in threads, and compiles the arguments to
+    # create containers for them once they are.
+    def _apiVersion(self, hostname):
+        return self.dockerHosts[hostname].apiVersion
+
+    def _connectHosts(self):
+        for host in self.dockerHosts.values():
+            if host.apiVersion == None:
+                d = threads.deferToThread(host.getClient)
+                d.addCallbacks(lambda client, host=host: self._hostConnected(host),
+                    lambda failure, host=host: logger.warning("Failed to connect to docker host %s: %s", host.name, failure.getErrorMessage()))
+
+    def _hostConnected(self, host):
+        for spec in self.imageParams.values():
+            if host.name in spec.dockerhosts:
+                spec.createArgs(host.apiVersion)
+
     def readConfig(self, fn):
         # read the configfile.
         config = configparser.ConfigParser()
-        logger.debug("Reading configfile from {}".format(fn))
+        logger.debug("Reading configfile from %s", fn)
         config.read(fn)
 
         # set log file
@@ -112,251 +278,2630 @@ class DockerPorts():
             #global logger
             logger.setLevel(logging.getLevelName(config["global"]["loglevel"]))
 
-        # if there is a configdir directory, reread everything
-        if "global" in config.sections() and "splitconfigfiles" in config["global"]:
-            fnlist = [fn] + [f for f in glob.glob(config["global"]["splitconfigfiles"])]
-            logger.debug("Detected configdir directive. Reading configfiles from {}".format(fnlist))
-            config = configparser.ConfigParser()
-            config.read(fnlist)
+        # log sessions to a file of their own
+        if "global" in config.sections() and "eventlog" in config["global"]:
+            self.eventLog = EventLog(config["global"]["eventlog"])
+            reactor.addSystemEventTrigger("after", "shutdown", self.eventLog.close)
+
+        # docker calls are made from the reactor's threadpool, so its size bounds how many
+        # containers can be started or removed at the same time
+        if "global" in config.sections() and "dockerthreads" in config["global"]:
+            reactor.suggestThreadPoolSize(self._parseInt(config["global"]["dockerthreads"]))
+            self.dockerPoolSize = self._parseInt(config["global"]["dockerthreads"])
+
+        # every thread needs its own connection to the daemon, so the pool defaults to the threadpool size
+        if "global" in config.sections() and "dockerpoolsize" in config["global"]:
+            self.dockerPoolSize = self._parseInt(config["global"]["dockerpoolsize"])
+
+        # spawn rate and concurrency limits for the docker daemon as a whole
+        if "global" in config.sections():
+            g = config["global"]
+            self.spawnLimiter = SpawnLimiter(
+                float(g["spawnrate"]) if "spawnrate" in g else 0,
+                self._parseInt(g["spawnburst"]) if "spawnburst" in g else 0,
+                self._parseInt(g["maxconcurrentspawns"]) if "maxconcurrentspawns" in g else 0,
+                self._parseInt(g["spawnqueuesize"]) if "spawnqueuesize" in g else 100,
+                float(g["spawnqueuetimeout"]) if "spawnqueuetimeout" in g else 30)
+
+        # removing containers in the background
+        if "global" in config.sections():
+            g = config["global"]
+            if "switchboardid" in g:
+                self.switchboardID = g["switchboardid"]
+            self.reaper = ContainerReaper(self._getDockerHosts,
+                self._parseInt(g["reaperconcurrency"]) if "reaperconcurrency" in g else 4,
+                self._parseInt(g["reaperretries"]) if "reaperretries" in g else 3)
+            if "reaperinterval" in g:
+                self.reaperInterval = float(g["reaperinterval"])
+
+        # sampling the resources used by containers
+        if "global" in config.sections():
+            g = config["global"]
+            self.resourceMonitor = ResourceMonitor(self._runningInstances, self._resourcesSampled,
+                float(g["statsinterval"]) if "statsinterval" in g else 10,
+                self._parseInt(g["statsconcurrency"]) if "statsconcurrency" in g else 4)
+
+        # how new containers are spread over the docker hosts
+        if "global" in config.sections() and "scheduler" in config["global"]:
+            self.scheduler = self._parseChoice(config["global"]["scheduler"], ["leastloaded", "twochoices"])
+
+        # where the docker hosts keep checkpoints
+        if "global" in config.sections() and "checkpointdir" in config["global"]:
+            self.checkpointDir = config["global"]["checkpointdir"]
+
+        # connections the kernel queues up for the switchboard to accept, during bursts
+        if "global" in config.sections() and "listenbacklog" in config["global"]:
+            self.listenBacklog = self._parseInt(config["global"]["listenbacklog"])
+
+        # worker processes
+        if "global" in config.sections() and "workers" in config["global"]:
+            self.workers = self._parseInt(config["global"]["workers"])
+        if "global" in config.sections() and "coordinatorsocket" in config["global"]:
+            self.coordinatorSocket = config["global"]["coordinatorsocket"]
+
+        # serve the admin API on a UNIX socket
+        if "global" in config.sections() and "adminsocket" in config["global"]:
+            self.adminSocket = config["global"]["adminsocket"]
+
+        # serve metrics over HTTP
+        if "global" in config.sections() and "metricsport" in config["global"]:
+            self.metricsPort = self._parseInt(config["global"]["metricsport"])
+            if "metricsinterface" in config["global"]:
+                self.metricsInterface = config["global"]["metricsinterface"]
+
+        config = self._readSplitConfigFiles(config, fn)
+
+        # docker daemons, by default the one configured in the environment
+        for hostname in self._getDockerHostsList(config):
+            self.dockerHosts[hostname] = self._readDockerHostConfig(config, hostname)
+        if len(self.dockerHosts) == 0:
+            self.dockerHosts["local"] = DockerHost("local", poolsize=self.dockerPoolSize)
 
         if len(self._getProfilesList(config)) == 0:
             logger.error("invalid configfile. No docker images")
             sys.exit(1)
 
+        # a profile with a bad value stops the switchboard now, rather than its first session
+        confs = dict()
         for profilename in self._getProfilesList(config):
-            conf = self._readProfileConfig(config, profilename)
-            logger.debug("Read config for profile {} as:\n {}".format(profilename, pprint.pformat(conf)))
-            self.registerProxy(profilename, conf)
+            try:
+                confs[profilename] = self._readProfileConfig(config, profilename)
+            except ValueError as e:
+                logger.error("invalid configfile. Profile %s: %s", profilename, e)
+                sys.exit(1)
+        for profilename in self._getProfilesList(config):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Read config for profile %s as:\n %s", profilename, pprint.pformat(dict(confs[profilename])))
+            self.registerProxy(profilename, confs[profilename])
+
+        return dict([(name, self.imageParams[name].outerport) for name in self.imageParams.keys()])
+
+    def _readSplitConfigFiles(self, config, fn):
+        # if there is a configdir directory, reread everything
+        if "global" in config.sections() and "splitconfigfiles" in config["global"]:
+            fnlist = [fn] + [f for f in glob.glob(config["global"]["splitconfigfiles"])]
+            logger.debug("Detected configdir directive. Reading configfiles from %s", fnlist)
+            config = configparser.ConfigParser()
+            config.read(fnlist)
+        return config
 
-        return dict([(name, self.imageParams[name]["outerport"]) for name in self.imageParams.keys()])
+    # Rereads the profiles from the configfile and applies what changed, without a restart.
+    # Sessions keep the settings and the instances they started with. Global settings,
+    # other than the loglevel, and docker hosts only change with a restart.
+    def reload(self, fn):
+        started = time.time()
+        logger.info("Reloading configfile from %s", fn)
+        try:
+            config = configparser.ConfigParser()
+            config.read(fn)
+            if "global" in config.sections() and "loglevel" in config["global"]:
+                logger.setLevel(logging.getLevelName(config["global"]["loglevel"]))
+            config = self._readSplitConfigFiles(config, fn)
+            confs = dict((profilename, self._readProfileConfig(config, profilename)) for profilename in self._getProfilesList(config))
+        except Exception as e:
+            logger.error("Failed to reload configfile, keeping the current config: %s", e)
+            return
+        if len(confs) == 0:
+            logger.error("invalid configfile. No docker images, keeping the current config")
+            return
+
+        added, removed, changed = [], [], {}
+        for profilename in sorted(set(confs.keys()) | set(self.imageParams.keys())):
+            if profilename not in confs:
+                if profilename not in self.retiredProfiles:
+                    self._retireProfile(profilename)
+                    removed += [profilename]
+            elif profilename not in self.imageParams:
+                self.registerProxy(profilename, confs[profilename])
+                self._openListener(profilename)
+                added += [profilename]
+            else:
+                old = self.imageParams[profilename]
+                changes = sorted(k for k in confs[profilename].keys() if confs[profilename][k] != old.get(k))
+                if profilename in self.retiredProfiles:
+                    self.retiredProfiles.discard(profilename)
+                    changes = sorted(set(changes) | {"outerport"})
+                if len(changes) > 0:
+                    self._updateProfile(profilename, confs[profilename], changes)
+                    changed[profilename] = changes
+
+        logger.info("Reloaded configfile in %.3fs: added %s, removed %s, changed %s", time.time() - started, added, removed, changed)
+        # docker hosts that could not be reached are tried again
+        self._connectHosts()
+
+    # a removed profile stops accepting sessions, and goes away once its sessions have ended
+    def _retireProfile(self, profilename):
+        self.retiredProfiles.add(profilename)
+        self._closeListener(profilename)
+        conf = self.imageParams[profilename].replace(prewarm=0, maxidle=0)
+        self._updateProfile(profilename, conf, ["maxidle", "prewarm"])
+        self.dropIfRetired(profilename)
+
+    # forgets a retired profile once it has no sessions, no instances and no connections
+    # waiting for one, so that it is gone from the metrics and the admin socket as well
+    def dropIfRetired(self, profilename):
+        if profilename not in self.retiredProfiles or len(self.stats[profilename].sessions) > 0 or \
+                self._countInstances(profilename) > 0 or len(self.limitQueues[profilename]) > 0:
+            return
+        logger.info("Profile %s has no sessions left, dropping it", profilename)
+        for byName in [self.imageParams, self.instancesByName, self.stats, self.idleByName, self.heldByName, self.poolTarget,
+                self.poolLastMiss, self.poolHits, self.poolMisses, self.spawnLimiters, self.limitQueues, self.readinessChecks,
+                self.checkpoints]:
+            byName.pop(profilename, None)
+        # the sessions workers reported for it are not counted anywhere anymore
+        for worker in self.workerProtocols:
+            worker.sessionsActive.pop(profilename, None)
+        self.resourceMonitor.setLimits(profilename, 0, 0, 0)
+        self.retiredProfiles.discard(profilename)
+        self.drainedProfiles.discard(profilename)
+
+    def _updateProfile(self, profilename, conf, changes):
+        self.imageParams[profilename] = conf
+
+        # instances started with the old container settings keep their sessions, but get no new ones
+        if any(k in changes for k in ["containername", "innerport", "checkupport", "dockeroptions", "reuse", "dockerhosts"]):
+            self.instancesByName[profilename].retire()
+            pool = self.idleByName[profilename]
+            while len(pool) > 0:
+                self._stopInstance(pool.pop())
+            if profilename in self.poolRefilling:
+                self._stopInstance(self.poolRefilling[profilename])
+            held = self.heldByName[profilename]
+            while len(held) > 0:
+                self._stopInstance(held.evict())
+
+        # a checkpoint only fits containers started with the settings it was taken with
+        if any(k in changes for k in ["containername", "innerport", "checkupport", "dockeroptions", "startmode"]):
+            self._configureStartMode(profilename, conf)
+
+        if any(k in changes for k in ["readiness", "readinesstimeout", "sendproxy", "innerport", "checkupport"]):
+            self.readinessChecks[profilename] = self._makeReadinessCheck(conf)
+
+        self.spawnLimiters[profilename].setRate(conf["spawnrate"], conf["spawnburst"])
+        self.resourceMonitor.setLimits(profilename, conf["maxcpu"], conf["maxmemory"], conf["maxload"])
+        self.limitQueues[profilename].maxsize = conf["limitqueuesize"]
+        self.limitQueues[profilename].timeout = conf["limitwait"]
+
+        if "outerport" in changes:
+            self._closeListener(profilename)
+            self._openListener(profilename)
+
+        # resize the pool in place
+        self.poolTarget[profilename] = min(max(self.poolTarget[profilename], conf["prewarm"]), conf["maxidle"])
+        pool = self.idleByName[profilename]
+        while len(pool) > self.poolTarget[profilename]:
+            self._stopInstance(pool.pop())
+        if conf["maxidle"] > conf["prewarm"] and not self.poolShrinker.running:
+            self.poolShrinker.start(self.POOL_SHRINKAFTER, now=False)
+
+        # connections waiting for a slot may fit below a raised limit
+        free = len(self.limitQueues[profilename])
+        if conf["limit"] > 0:
+            free = min(free, conf["limit"] - self._countInstances(profilename))
+        for _ in range(free):
+            self._slotFreed(profilename)
+        self._refillPool(profilename)
+
+    def listen(self, interface):
+        self.interface = interface
+        for profilename in self.imageParams.keys():
+            self._openListener(profilename)
+
+    def _openListener(self, profilename):
+        if self.interface == None or profilename in self.listeners or profilename in self.drainedProfiles:
+            return
+        outerport = self.imageParams[profilename].outerport
+        logger.debug("Listening on port %s", outerport)
+        self.listeners[profilename] = self._listenTCP(outerport, DockerProxyFactory(profilename))
+
+    def _listenTCP(self, port, factory):
+        return reactor.listenTCP(port, factory, backlog=self.listenBacklog, interface=self.interface)
+
+    def _closeListener(self, profilename):
+        if profilename in self.listeners:
+            logger.debug("No longer listening on port %s", self.listeners[profilename].getHost().port)
+            self.listeners.pop(profilename).stopListening()
 
     def _parseInt(self, x):
         return int(x)
 
+    # bytes, with an optional suffix k, m or g as for docker run --memory
+    def _parseSize(self, x):
+        units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+        if x[-1:].lower() in units:
+            return int(float(x[:-1]) * units[x[-1:].lower()])
+        return int(x)
+
+    def _parseChoice(self, x, choices):
+        if x not in choices:
+            raise ValueError("Unknown value {}, expected one of {}".format(x, ", ".join(sorted(choices))))
+        return x
+
     def _parseTruthy(self, x):
         if x.lower() in ["0", "false", "no"]:
             return False
         if x.lower() in ["1", "true", "yes"]:
             return True
 
-        raise "Unknown truthy value {}".format(x)
+        raise ValueError("Unknown truthy value {}".format(x))
 
     def registerProxy(self, profilename, conf):
-        self.imageParams[profilename] = copy.deepcopy(conf)
-
-    def create(self, profilename):
-        containername = self.imageParams[profilename]["containername"]
-        dockeroptions = self.imageParams[profilename]["dockeroptions"]
-        imagelimit = self.imageParams[profilename]["limit"]
-        reuse = self.imageParams[profilename]["reuse"]
-        innerport = self.imageParams[profilename]["innerport"]
-        checkupport = self.imageParams[profilename]["checkupport"]
-
-        icount = 0
-        if profilename in self.instancesByName:
-            icount = len(self.instancesByName[profilename])
-
-        if imagelimit > 0 and icount >= imagelimit:
-            logger.warn("Reached max count of {} (currently {}) for image {}".format(imagelimit, icount, profilename))
+        self.imageParams[profilename] = conf
+        self.instancesByName[profilename] = ProfileInstances()
+        self.stats[profilename] = ProfileStats()
+        self.idleByName[profilename] = collections.deque()
+        self.heldByName[profilename] = HeldInstances()
+        self.poolTarget[profilename] = conf["prewarm"]
+        self.poolLastMiss[profilename] = 0
+        self.poolHits[profilename] = 0
+        self.poolMisses[profilename] = 0
+        self.spawnLimiters[profilename] = SpawnLimiter(conf["spawnrate"], conf["spawnburst"], 0,
+            self.spawnLimiter.queue.maxsize, self.spawnLimiter.queue.timeout)
+        self.limitQueues[profilename] = WaitQueue(conf["limitqueuesize"], conf["limitwait"])
+        self.readinessChecks[profilename] = self._makeReadinessCheck(conf)
+        self._configureStartMode(profilename, conf)
+        self.resourceMonitor.setLimits(profilename, conf["maxcpu"], conf["maxmemory"], conf["maxload"])
+        if conf["maxidle"] > conf["prewarm"] and not self.poolShrinker.running:
+            self.poolShrinker.start(self.POOL_SHRINKAFTER, now=False)
+        reactor.callWhenRunning(self._refillPool, profilename)
+
+    def _makeReadinessCheck(self, conf):
+        if conf["readiness"] not in self.readyTimes:
+            self.readyTimes[conf["readiness"]] = Histogram()
+        # a service that expects a PROXY protocol header gets one for a connection of the switchboard's own
+        probeHeader = b""
+        if conf["sendproxy"] != "none" and conf["checkupport"] == conf["innerport"]:
+            probeHeader = buildProxyHeader(conf["sendproxy"], None, None)
+        return READINESSCHECKS[conf["readiness"]](conf["readinesstimeout"], self.readyTimes[conf["readiness"]], probeHeader)
+
+    def _usesPool(self, params):
+        return not params.reuse and params.maxidle > 0
+
+    # with startmode paused, the idle pool is kept paused. With startmode checkpoint, every
+    # configuration of a profile gets a checkpoint of its own.
+    def _configureStartMode(self, profilename, conf):
+        if conf["startmode"] == "paused" and (conf["reuse"] or conf["maxidle"] == 0):
+            logger.warning("Profile %s has startmode paused, but no idle pool to pause. Containers are started normally", profilename)
+        if conf["startmode"] == "checkpoint":
+            name = "{}-{}-{}".format(profilename, self.generation, next(self.checkpointSerial))
+            self.checkpoints[profilename] = ContainerCheckpoint(self.checkpointDir, name, self.checkpoints.get(profilename))
+        else:
+            self.checkpoints.pop(profilename, None)
+
+    # the available host with the least containers relative to its weight, either among all
+    # hosts of the profile, or among two picked at random, which is nearly as good and
+    # does not send every new container to the same host
+    def _pickHost(self, profilename):
+        hosts = [self.dockerHosts[hostname] for hostname in self.imageParams[profilename].dockerhosts]
+        hosts = [host for host in hosts if host.isAvailable()]
+        if len(hosts) == 0:
             return None
+        if self.scheduler == "twochoices" and len(hosts) > 2:
+            hosts = random.sample(hosts, 2)
+        return min(hosts, key=lambda host: host.load())
+
+    def _newInstance(self, profilename):
+        host = self._pickHost(profilename)
+        instance = DockerInstance(host, self.imageParams[profilename], self.readinessChecks[profilename], self.checkpoints.get(profilename))
+        if host == None:
+            logger.warning("No docker host available for image %s", profilename)
+            instance.reject()
+            return instance
+
+        # the instance counts against its host until its container is gone
+        host.instances.add(instance)
+        instance.whenReady().addErrback(lambda failure: host.instances.discard(instance))
+        self._startInstance(instance)
+        return instance
+
+    # the instance only gets started once both the profile's and the global spawn limiter
+    # admit it. Until then it is already accounted for, but has no container yet. Both
+    # limiters are released once the container has started, or failed to.
+    def _startInstance(self, instance):
+        profilename = instance.getProfileName()
+        profileLimiter = self.spawnLimiters[profilename]
+        globalLimiter = self.spawnLimiter
+
+        def profileAdmitted(admitted):
+            if not admitted:
+                logger.warning("Spawn queue for image %s is full or timed out (%s waiting)", profilename, len(profileLimiter.queue))
+                instance.reject()
+                return
+            globalLimiter.acquire().addCallback(globalAdmitted)
+
+        def globalAdmitted(admitted):
+            if not admitted:
+                profileLimiter.release()
+                logger.warning("Spawn queue for image %s is full or timed out (%s waiting)", profilename, len(globalLimiter.queue))
+                instance.reject()
+                return
+            started = time.time()
+            def spawned(isReady):
+                globalLimiter.release()
+                profileLimiter.release()
+                if instance.restoreFailed:
+                    self.stats[profilename].startFallbacks += 1
+                if isReady:
+                    self.resourceMonitor.instanceReady(profilename)
+                    self.stats[profilename].spawnTimes.observe(time.time() - started)
+                    self.stats[profilename].observeStart(instance.startMode, time.time() - started)
+                elif instance.readinessFailed:
+                    self.stats[profilename].readinessFailures += 1
+            instance.start().addCallback(spawned)
+
+        profileLimiter.acquire().addCallback(profileAdmitted)
+
+    # wake up a connection that is waiting for room below the profile's limit
+    def _slotFreed(self, profilename):
+        self.limitQueues[profilename].wakeOne()
+
+    # idle instances count against the limit of a profile too, since they use up
+    # just as many resources on the docker host
+    def _countInstances(self, profilename):
+        icount = self.instancesByName[profilename].sessions
+        icount += len(self.idleByName[profilename])
+        icount += len(self.heldByName[profilename])
+        if profilename in self.poolRefilling:
+            icount += 1
+        return icount
+
+    # instances of a profile that have a running container
+    def _runningInstances(self, profilename):
+        for group in [self.instancesByName[profilename], self.idleByName[profilename], self.heldByName[profilename]]:
+            for instance in group:
+                if not instance.isStarting() and not instance.isStopped():
+                    yield instance
+
+    # a new sample may leave room for more containers, for as many waiting connections
+    def _resourcesSampled(self, profilename):
+        if profilename not in self.imageParams:
+            return
+        waiting = len(self.limitQueues[profilename])
+        for _ in range(min(waiting, self.resourceMonitor.headroom(profilename))):
+            self._slotFreed(profilename)
+        self._refillPool(profilename)
+
+    def _refillPool(self, profilename):
+        if profilename not in self.imageParams:
+            return
+        params = self.imageParams[profilename]
+        if self.shuttingDown or not self._usesPool(params) or profilename in self.poolRefilling or profilename in self.drainedProfiles:
+            return
+
+        pool = self.idleByName[profilename]
+
+        if len(pool) >= self.poolTarget[profilename]:
+            return
+        if params.limit > 0 and self._countInstances(profilename) >= params.limit:
+            return
+        # connections waiting for a free slot go first
+        if len(self.limitQueues[profilename]) > 0:
+            return
+        if not self.resourceMonitor.admit(profilename):
+            return
+
+        # start one instance at a time, spaced by prewarmdelay, so refilling does not hog the docker daemon
+        logger.debug("Prewarming instance for image %s (%s idle, target %s)", profilename, len(pool), self.poolTarget[profilename])
+        instance = self._newInstance(profilename)
+        self.poolRefilling[profilename] = instance
+
+        def prewarmed(instance):
+            del self.poolRefilling[profilename]
+            if self.shuttingDown or instance.isStopped() or profilename in self.drainedProfiles or profilename in self.retiredProfiles:
+                self._stopInstance(instance)
+                self.dropIfRetired(profilename)
+                return
+            pool.append(instance)
+            reactor.callLater(params.prewarmdelay, self._refillPool, profilename)
+
+        def prewarmFailed(failure):
+            del self.poolRefilling[profilename]
+            self._slotFreed(profilename)
+            self.dropIfRetired(profilename)
+            logger.warning("Failed to prewarm instance for image %s: %s", profilename, failure.getErrorMessage())
+            if not self.shuttingDown:
+                reactor.callLater(max(params.prewarmdelay, 1.0), self._refillPool, profilename)
+
+        d = instance.whenReady()
+        if params.startmode == "paused":
+            d.addCallback(self._pause)
+        d.addCallbacks(prewarmed, prewarmFailed)
+
+    # pauses an idle instance, so it uses no CPU until it is handed out. If that fails, it
+    # waits in the pool unpaused.
+    def _pause(self, instance):
+        def failed(failure):
+            logger.warning("Failed to pause idle instance %s of image %s: %s", instance.getInstanceID(), instance.getProfileName(), failure.getErrorMessage())
+            return instance
+        return threads.deferToThread(instance.pause).addCallbacks(lambda _: instance, failed)
+
+    # unpauses an instance from the pool. If that fails, the caller gets a freshly started
+    # instance instead, which takes over the accounting of the paused one.
+    def _unpause(self, instance):
+        profilename = instance.getProfileName()
+        started = time.time()
+        def unpaused(_):
+            self.stats[profilename].observeStart("paused", time.time() - started)
+            return instance
+        def failed(failure):
+            if failure.check(defer.CancelledError):
+                return failure
+            logger.warning("Failed to unpause idle instance %s of image %s, starting a new one: %s", instance.getInstanceID(), profilename, failure.getErrorMessage())
+            self.stats[profilename].startFallbacks += 1
+            replacement = self._newInstance(profilename)
+            self.instancesByName[profilename].add(replacement)
+            self.destroy(instance)
+            return replacement
+        return threads.deferToThread(instance.unpause).addCallbacks(unpaused, failed)
+
+    def _shrinkPools(self):
+        # shrink back towards prewarm if the extra instances have not been needed for a while
+        for profilename in self.idleByName.keys():
+            if self.poolTarget[profilename] > self.imageParams[profilename].prewarm and self.poolLastMiss[profilename] + self.POOL_SHRINKAFTER < time.time():
+                self.poolTarget[profilename] -= 1
+                self.poolLastMiss[profilename] = time.time()
+            pool = self.idleByName[profilename]
+            while len(pool) > self.poolTarget[profilename]:
+                self._stopInstance(pool.pop())
+                self._slotFreed(profilename)
+
+    # stops the instance, and has its container removed in the background. The returned
+    # Deferred fires once the container is gone.
+    def _stopInstance(self, instance):
+        if instance.stop():
+            host = instance.getHost()
+            def removed(result):
+                host.instances.discard(instance)
+                return result
+            return self.reaper.reap(instance).addCallback(removed)
+        return defer.succeed(True)
+
+    def _allInstances(self):
+        for profilename in self.imageParams.keys():
+            for instance in self.instancesByName[profilename]:
+                yield instance
+            for instance in self.idleByName[profilename]:
+                yield instance
+            if profilename in self.poolRefilling:
+                yield self.poolRefilling[profilename]
+            for instance in self.heldByName[profilename]:
+                yield instance
+
+    def start(self):
+        reactor.callWhenRunning(self._connectHosts)
+        # containers left behind by a previous process, e.g. after it got killed, are removed right away
+        reactor.callWhenRunning(self._sweepOrphans)
+        if self.reaperInterval > 0:
+            self.orphanSweeper.start(self.reaperInterval, now=False)
+        self.resourceMonitor.start()
+
+    # instances that are starting might not have a container yet, to know the ID of
+    def _sweepOrphans(self):
+        knownIDs = set(instance.getInstanceID() for instance in self._allInstances() if instance.hasContainer())
+        return self.reaper.sweep(self.switchboardID, self.generation, knownIDs)
+
+    def shutdown(self):
+        # called before the reactor shuts down. Remove all containers now, while the threadpool
+        # is still around. The sessions get closed afterwards, and find their instances stopped.
+        self.shuttingDown = True
+        if self.poolShrinker.running:
+            self.poolShrinker.stop()
+        if self.orphanSweeper.running:
+            self.orphanSweeper.stop()
+        self.resourceMonitor.stop()
+        self.timerWheel.stop()
+        pending = []
+        for pool in self.idleByName.values():
+            while len(pool) > 0:
+                pending += [self._stopInstance(pool.pop())]
+        for held in self.heldByName.values():
+            while len(held) > 0:
+                pending += [self._stopInstance(held.evict())]
+        for instance in list(self._allInstances()):
+            if instance.isStarting():
+                pending += [instance.whenReady()]
+            pending += [self._stopInstance(instance)]
+        return defer.DeferredList(pending, consumeErrors=True)
+
+    def create(self, profilename, resumeKey=None, waitingSince=None):
+        params = self.imageParams[profilename]
+        imagelimit = params.limit
+
+        # a client that comes back within the grace period gets its container back
+        instance = self.heldByName[profilename].take(resumeKey) if resumeKey != None else None
+        if instance != None:
+            logger.debug("Resuming held instance %s of image %s", instance.getInstanceID(), profilename)
+            self.stats[profilename].resumes += 1
+            self.instancesByName[profilename].add(instance)
+            return instance.whenReady()
+
+        icount = self._countInstances(profilename)
+
+        if self._usesPool(params):
+            pool = self.idleByName[profilename]
+            if len(pool) > 0:
+                self.poolHits[profilename] += 1
+                instance = pool.popleft()
+            else:
+                self.poolMisses[profilename] += 1
+                self.poolLastMiss[profilename] = time.time()
+                self.poolTarget[profilename] = min(self.poolTarget[profilename] + 1, params.maxidle)
+            logger.debug("Pool %s for image %s (hits=%s, misses=%s)", "hit" if instance else "miss", profilename,
+                self.poolHits[profilename], self.poolMisses[profilename])
+            icount = self._countInstances(profilename)
+
+        if instance == None:
+            # held instances give way to new sessions, the least recently held first
+            held = self.heldByName[profilename]
+            while imagelimit > 0 and icount >= imagelimit and len(held) > 0:
+                self._evictHeld(profilename)
+                icount -= 1
+            if imagelimit > 0 and icount >= imagelimit:
+                limitQueue = self.limitQueues[profilename]
+                if limitQueue.timeout > 0:
+                    # wait for another session to end, then try again
+                    logger.debug("Reached max count of %s for image %s, waiting for a free slot (%s waiting)", imagelimit, profilename, len(limitQueue))
+                    return self._waitForSlot(profilename, waitingSince)
+                logger.warning("Reached max count of %s (currently %s) for image %s", imagelimit, icount, profilename)
+                return defer.succeed(self._rejected(profilename))
+
+            if params.reuse:
+                instance = self.instancesByName[profilename].leastLoaded(params.reusesessions)
+                if instance != None:
+                    logger.debug("Reusing existing instance for image %s (%s sessions)", profilename, instance.sessions)
+            if instance == None and not self.resourceMonitor.admit(profilename):
+                limitQueue = self.limitQueues[profilename]
+                if limitQueue.timeout > 0:
+                    # wait for a sample that shows room for another container, then try again
+                    logger.debug("Reached resource limits for image %s, waiting for a free slot (%s waiting)", profilename, len(limitQueue))
+                    return self._waitForSlot(profilename, waitingSince)
+                logger.warning("Reached resource limits for image %s", profilename)
+                return defer.succeed(self._rejected(profilename))
+            if instance == None:
+                instance = self._newInstance(profilename)
+
+        self.instancesByName[profilename].add(instance)
+
+        if self._usesPool(params):
+            self._refillPool(profilename)
+
+        # the instance is accounted for already, but it is only handed out once
+        # it is ready. If it fails to start, undo the accounting before passing on the error.
+        def startFailed(failure, instance):
+            self.destroy(instance)
+            if failure.check(SpawnRejected):
+                return self._rejected(profilename)
+            return failure
+
+        if instance.isPaused():
+            d = self._unpause(instance)
+            d.addCallbacks(lambda instance: instance.whenReady().addErrback(startFailed, instance), startFailed, errbackArgs=(instance,))
+            return d
+        return instance.whenReady().addErrback(startFailed, instance)
+
+    # waits in the limit queue of the profile, then tries again. A connection that was
+    # woken, but finds the slot taken after all, keeps its place at the front.
+    def _waitForSlot(self, profilename, waitingSince):
+        limitQueue = self.limitQueues[profilename]
+        since = waitingSince if waitingSince != None else time.time()
+        def woken(hasSlot):
+            if not hasSlot:
+                return self._rejected(profilename)
+            return self.create(profilename, waitingSince=since)
+        return limitQueue.wait(waitingSince).addCallback(woken)
+
+    def _canHold(self, instance):
+        params = self.imageParams[instance.getProfileName()]
+        return params.resumegrace > 0 and not params.reuse and not self.shuttingDown and \
+            instance.getProfileName() not in self.retiredProfiles and not instance.isStarting() and not instance.isStopped()
+
+    # keeps the container of an ended session around for resumegrace seconds, for the
+    # client to reconnect to. It still counts against the limit of its profile.
+    def _hold(self, instance, resumeKey):
+        profilename = instance.getProfileName()
+        params = self.imageParams[profilename]
+        held = self.heldByName[profilename]
+        if params.resumemax > 0 and len(held) >= params.resumemax:
+            self._evictHeld(profilename)
+        logger.debug("Holding instance %s of image %s for %s seconds", instance.getInstanceID(), profilename, params.resumegrace)
+        expiry = reactor.callLater(params.resumegrace, self._releaseHeld, instance)
+        held.hold(resumeKey, instance, expiry)
+
+    def _releaseHeld(self, instance):
+        profilename = instance.getProfileName()
+        logger.debug("Grace period for instance %s of image %s is over", instance.getInstanceID(), profilename)
+        self.heldByName[profilename].remove(instance)
+        self._stopInstance(instance)
+        self._slotFreed(profilename)
+        self.dropIfRetired(profilename)
+
+    def _evictHeld(self, profilename):
+        instance = self.heldByName[profilename].evict()
+        logger.debug("Evicting held instance %s of image %s", instance.getInstanceID(), profilename)
+        self.stats[profilename].resumeEvictions += 1
+        self._stopInstance(instance)
+
+    def _rejected(self, profilename):
+        self.stats[profilename].limitRejections += 1
+        return None
 
-        instance = None
+    # A drained profile stops accepting sessions and stops keeping idle instances, but its
+    # sessions go on until they end, so that the host can be taken out of service without
+    # cutting them off. Workers get drained along with the coordinator.
+    def drain(self, profilename, drained=True):
+        if drained:
+            logger.info("Draining profile %s", profilename)
+            self.drainedProfiles.add(profilename)
+            self._closeListener(profilename)
+            pool = self.idleByName[profilename]
+            while len(pool) > 0:
+                self._stopInstance(pool.pop())
+                self._slotFreed(profilename)
+        else:
+            logger.info("Undraining profile %s", profilename)
+            self.drainedProfiles.discard(profilename)
+            if profilename not in self.retiredProfiles:
+                self._openListener(profilename)
+            self._refillPool(profilename)
+        for worker in self.workerProtocols:
+            worker.callRemote(DrainProfile, profilename=profilename, drained=drained)
+
+    # changes the limit of a profile, until the configfile is reloaded
+    def setLimit(self, profilename, limit):
+        if limit < 0:
+            raise ValueError("Invalid limit {}".format(limit))
+        logger.info("Setting limit of profile %s to %s", profilename, limit)
+        conf = self.imageParams[profilename].replace(limit=limit)
+        self._updateProfile(profilename, conf, ["limit"])
+
+    def describeProfiles(self):
+        out = []
+        for profilename in sorted(self.imageParams.keys()):
+            params = self.imageParams[profilename]
+            out += [{"profile": profilename, "outerport": params.outerport, "limit": params.limit,
+                "drained": profilename in self.drainedProfiles, "retired": profilename in self.retiredProfiles,
+                "sessions": self.stats[profilename].sessionsActive, "containers": len(self.instancesByName[profilename]),
+                "idle": len(self.idleByName[profilename]), "held": len(self.heldByName[profilename]),
+                "waiting": len(self.limitQueues[profilename]), "usage": self.resourceMonitor.describe(profilename)}]
+        return out
+
+    def describeContainers(self):
+        out = []
+        for profilename in sorted(self.imageParams.keys()):
+            instances = self.instancesByName[profilename]
+            states = [("active", instances.instances), ("retired", instances.retired), ("idle", self.idleByName[profilename]),
+                ("held", self.heldByName[profilename])]
+            if profilename in self.poolRefilling:
+                states += [("prewarming", [self.poolRefilling[profilename]])]
+            for (state, group) in states:
+                for instance in group:
+                    out += [self._describeInstance(instance, state)]
+        return out
+
+    def _describeInstance(self, instance, state):
+        starting = instance.isStarting()
+        host = instance.getHost()
+        return {"instance": None if starting else instance.getInstanceID(), "profile": instance.getProfileName(),
+            "host": host.name if host != None else None, "port": None if starting else instance.getMiddlePort(),
+            "state": "starting" if starting else state, "paused": instance.isPaused(), "sessions": instance.sessions}
+
+    # the sessions of this process, in the order they started
+    def _localSessions(self):
+        return sorted((session for st in self.stats.values() for session in st.sessions), key=lambda session: session.sessionNumber)
+
+    # Deferred list of all sessions, from the workers if there are any
+    def listSessions(self):
+        sessions = [session.describe() for session in self._localSessions()]
+        if len(self.workerProtocols) == 0:
+            return defer.succeed(sessions)
+        d = defer.gatherResults([self._listWorkerSessions(worker) for worker in self.workerProtocols])
+        return d.addCallback(lambda answers: sessions + [session for answer in answers for session in answer])
+
+    # the worker sends its sessions in batches, to fit into AMP's limit on the size of a value
+    # in batches of the sessions after the last one listed, so that sessions which begin or
+    # end meanwhile do not shift the others into the next batch or back into the last one
+    def _listWorkerSessions(self, worker, after=0, sessions=None):
+        sessions = [] if sessions == None else sessions
+        def answered(response):
+            sessions.extend(json.loads(response["sessions"]))
+            if response["more"]:
+                return self._listWorkerSessions(worker, response["last"], sessions)
+            return sessions
+        return worker.callRemote(ListSessions, after=after).addCallback(answered)
+
+    # Deferred that fires with whether a session with this ID was found and killed
+    def killSession(self, sessionID):
+        for session in self._localSessions():
+            if session.sessionID == sessionID:
+                session.kill()
+                return defer.succeed(True)
+        if len(self.workerProtocols) == 0:
+            return defer.succeed(False)
+        d = defer.DeferredList([worker.callRemote(KillSession, session=sessionID) for worker in self.workerProtocols], consumeErrors=True)
+        return d.addCallback(lambda results: any(ok and response["killed"] for (ok, response) in results))
+
+    def destroy(self, instance, resumeKey=None):
+        profilename = instance.getProfileName()
+
+        self.instancesByName[profilename].remove(instance)
+
+        if instance.sessions == 0 and resumeKey != None and self._canHold(instance):
+            self._hold(instance, resumeKey)
+            return
+
+        # stop the instance if this was its last session, which is the only one without reuse
+        if instance.sessions == 0:
+            started = time.time()
+            stats = self.stats[profilename]
+            d = self._stopInstance(instance)
+            d.addCallback(lambda _: stats.destroyTimes.observe(time.time() - started))
+
+        self._slotFreed(profilename)
+        self.dropIfRetired(profilename)
+
+
+# The settings of a profile, checked and converted once when the configfile is read, so
+# that spawning containers and relaying sessions only look them up, as attributes. A spec
+# also reads like a dict of its settings, which is how a reload finds what changed. It
+# never changes; replace() makes a new one. The dockeroptions are converted to the
+# arguments for creating the containers when the spec is made, and bad ones fail then.
+# Both are kept read-only, and createArgs() hands out copies.
+class ProfileSpec(collections.abc.Mapping):
+    OPTIONS = ["outerport", "innerport", "containername", "checkupport", "limit", "reuse", "reusesessions",
+        "prewarm", "maxidle", "prewarmdelay", "spawnrate", "spawnburst", "limitwait", "limitqueuesize",
+        "readiness", "readinesstimeout", "maxduration", "idletimeout", "maxbytes", "ratelimit", "highwatermark",
+        "startmode", "resumegrace", "resumekey", "resumetlv", "resumemax", "acceptproxy", "sendproxy", "maxcpu", "maxmemory",
+        "maxload", "dockerhosts", "dockeroptions"]
+    # numbers that may be 0 or more
+    AMOUNTS = ["limit", "reusesessions", "prewarm", "maxidle", "prewarmdelay", "spawnrate", "spawnburst",
+        "limitwait", "limitqueuesize", "readinesstimeout", "maxduration", "idletimeout", "maxbytes", "ratelimit",
+        "resumegrace", "resumemax", "maxcpu", "maxmemory", "maxload"]
+    __slots__ = OPTIONS + ["name", "innerPortKey", "checkupPortKey", "_createArgs"]
+
+    def __init__(self, name, **options):
+        if set(options.keys()) != set(self.OPTIONS):
+            raise TypeError("Profile {} has options {}, expected {}".format(name, sorted(options.keys()), self.OPTIONS))
+        object.__setattr__(self, "name", name)
+        for option in self.OPTIONS:
+            object.__setattr__(self, option, options[option])
+        object.__setattr__(self, "dockeroptions", frozen(self.dockeroptions))
+        self._check()
+        # the keys of the mapped ports in the attributes of a container
+        object.__setattr__(self, "innerPortKey", "{}/tcp".format(self.innerport))
+        object.__setattr__(self, "checkupPortKey", "{}/tcp".format(self.checkupport))
+        # by docker API version, which the daemons of the docker hosts may differ in
+        object.__setattr__(self, "_createArgs", dict())
+        self.createArgs(docker.constants.DEFAULT_DOCKER_API_VERSION)
+
+    def _check(self):
+        def invalid(option, expected):
+            return ValueError("Invalid value {} for {}, expected {}".format(getattr(self, option), option, expected))
+        if not 0 <= self.outerport <= 65535:
+            raise invalid("outerport", "a port, or 0 for any")
+        for option in ["innerport", "checkupport"]:
+            if not 1 <= getattr(self, option) <= 65535:
+                raise invalid(option, "a port")
+        for option in self.AMOUNTS:
+            if not (math.isfinite(getattr(self, option)) and getattr(self, option) >= 0):
+                raise invalid(option, "a number of 0 or more")
+        if self.highwatermark <= 0:
+            raise invalid("highwatermark", "a number of bytes")
+        if self.containername == "":
+            raise invalid("containername", "an image")
+        if len(self.dockerhosts) == 0:
+            raise invalid("dockerhosts", "a docker host")
+        # resuming has to be asked for along with how clients are told apart
+        if self.resumegrace > 0 and self.resumekey == None:
+            raise invalid("resumekey", "one of {} with resumegrace".format(", ".join(sorted(RESUMEKEYS.keys()))))
+        if self.resumekey == "tlv" and not self.acceptproxy:
+            raise invalid("resumekey", "acceptproxy for tlv")
+        if not 0 <= self.resumetlv <= 255:
+            raise invalid("resumetlv", "a TLV type")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The spec of profile {} cannot be changed".format(self.name))
+
+    def __getitem__(self, option):
+        if option not in self.OPTIONS:
+            raise KeyError(option)
+        return getattr(self, option)
+
+    def __iter__(self):
+        return iter(self.OPTIONS)
+
+    def __len__(self):
+        return len(self.OPTIONS)
+
+    def __repr__(self):
+        return "ProfileSpec({!r}, {!r})".format(self.name, dict(self))
+
+    def replace(self, **changes):
+        options = dict(self)
+        options.update(changes)
+        return ProfileSpec(self.name, **options)
+
+    # the arguments to the docker API client's create_container(), which are what
+    # docker run makes of the dockeroptions
+    def createArgs(self, version):
+        if version not in self._createArgs:
+            options = dict(thawed(self.dockeroptions), image=self.containername, command=None, version=version)
+            try:
+                # pickled, which is the cheapest way to hand out a deep copy on every spawn
+                self._createArgs[version] = pickle.dumps(createContainerArgs(options), pickle.HIGHEST_PROTOCOL)
+            except (TypeError, ValueError, docker.errors.DockerException) as e:
+                raise ValueError("Invalid dockeroptions: {}".format(e))
+        return pickle.loads(self._createArgs[version])
+
+# What docker run makes of its arguments: those of the low-level create_container(). The
+# Docker SDK has no public call for that, so requirements.txt pins the versions that are
+# known to have this one, and others fail when the configfile is read.
+def createContainerArgs(options):
+    convert = getattr(docker.models.containers, "_create_container_args", None)
+    if convert == None:
+        raise ValueError("This version of the Docker SDK cannot convert dockeroptions, see requirements.txt")
+    return convert(options)
+
+# A read-only copy of a value made of dicts, lists and tuples, with mappingproxies for
+# the dicts and FrozenLists for the lists. thawed() makes a mutable copy of it again.
+class FrozenList(tuple):
+    pass
+
+def frozen(value):
+    if isinstance(value, collections.abc.Mapping):
+        return types.MappingProxyType(dict((k, frozen(v)) for (k, v) in value.items()))
+    if isinstance(value, list):
+        return FrozenList(frozen(v) for v in value)
+    if isinstance(value, tuple):
+        return tuple(frozen(v) for v in value)
+    return value
+
+def thawed(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict((k, thawed(v)) for (k, v) in value.items())
+    if isinstance(value, FrozenList):
+        return [thawed(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(thawed(v) for v in value)
+    return value
+
+
+# Removes containers in the background, at most concurrency at the same time, and
+# retries failed removals up to retries times. It also sweeps for containers that carry
+# the labels of this switchboard, but are not known to belong to a live instance.
+class ContainerReaper():
+    LABEL_OWNER = "docker-tcp-switchboard.owner"
+    LABEL_GENERATION = "docker-tcp-switchboard.generation"
+    RETRYDELAY = 1.0
+
+    def __init__(self, getDockerHosts, concurrency=4, retries=3):
+        self.getDockerHosts = getDockerHosts
+        self.concurrency = concurrency
+        self.retries = retries
+        self._queue = collections.deque()
+        self._active = 0
+        # removals waiting to be retried, which leave their slot to others meanwhile
+        self._retrying = 0
+        self._idleWaiters = []
+        # containers of this process that were unknown in the last sweep
+        self._suspects = set()
+        self.removed = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._queue) + self._active + self._retrying
+
+    def reap(self, instance):
+        return self._enqueue(instance.removeContainer, instance.getInstanceID())
+
+    def _enqueue(self, remove, description):
+        d = defer.Deferred()
+        self._queue.append((remove, description, 0, d))
+        self._next()
+        return d
+
+    def _next(self):
+        while self._active < self.concurrency and len(self._queue) > 0:
+            (remove, description, attempt, d) = self._queue.popleft()
+            self._active += 1
+            threads.deferToThread(remove).addBoth(self._removed, remove, description, attempt, d)
+
+        if len(self) == 0:
+            waiters, self._idleWaiters = self._idleWaiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+
+    def _removed(self, result, remove, description, attempt, d):
+        self._active -= 1
+        if result is True:
+            self.removed += 1
+            d.callback(True)
+        elif attempt < self.retries:
+            logger.debug("Retrying to remove container %s (attempt %s)", description, attempt + 1)
+            reactor.callLater(self.RETRYDELAY * 2 ** attempt, self._retry, (remove, description, attempt + 1, d))
+            self._retrying += 1
+        else:
+            logger.warning("Giving up on removing container %s", description)
+            self.failed += 1
+            d.callback(False)
+        self._next()
+
+    def _retry(self, item):
+        self._retrying -= 1
+        self._queue.append(item)
+        self._next()
+
+    # fires once nothing is queued or being removed anymore
+    def whenIdle(self):
+        if len(self) == 0:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idleWaiters += [d]
+        return d
+
+    def _listOwn(self, host, owner):
+        # runs in a thread
+        return host.getClient().containers.list(all=True, sparse=True,
+            filters={"label": "{}={}".format(self.LABEL_OWNER, owner)})
+
+    @defer.inlineCallbacks
+    def sweep(self, owner, generation, knownIDs):
+        suspects = set()
+        for host in self.getDockerHosts():
+            try:
+                containers = yield threads.deferToThread(self._listOwn, host, owner)
+            except Exception as e:
+                logger.warning("Failed to list containers on docker host %s to sweep: %s", host.name, e)
+                continue
+
+            for container in containers:
+                if container.id in knownIDs:
+                    continue
+                labels = container.attrs.get("Labels") or {}
+                # containers of this process might just be starting up, so they have to be
+                # unknown in two sweeps in a row to be removed
+                if labels.get(self.LABEL_GENERATION) == generation and container.id not in self._suspects:
+                    suspects.add(container.id)
+                    continue
+                logger.info("Removing orphaned container %s on docker host %s", container.id, host.name)
+                self._enqueue(lambda container=container: self._removeOrphan(container), container.id)
+        self._suspects = suspects
+
+    def _removeOrphan(self, container):
+        # runs in a thread
+        try:
+            container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            logger.warning("Failed to remove orphaned container %s: %s", container.id, e)
+            return False
+        return True
 
-        if reuse and icount > 0:
-            logger.debug("Reusing existing instance for image {}".format(profilename))
-            instance = self.instancesByName[profilename][0]
+# Samples the CPU and memory used by the containers of profiles with the resource limits
+# maxcpu and maxmemory, every interval seconds, reading the stats of at most concurrency
+# containers at the same time, as well as the load of this machine for maxload. A new
+# container may only be started while the containers of its profile, plus those started
+# since the last sample taken as average ones, stay below the limits. Until a container of
+# a profile has been sampled, they are started one at a time. The usage of a profile is
+# summed up over all its docker hosts.
+class ResourceMonitor():
+    def __init__(self, getInstances, onSample, interval=10, concurrency=4):
+        self.getInstances = getInstances
+        self.onSample = onSample
+        self.interval = interval
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.sampler = task.LoopingCall(self.sample)
+        # profilename to (maxcpu, maxmemory, maxload), for profiles that have any
+        self.limits = dict()
+        # profilename to (CPUs, bytes of memory, containers) as of the last sample, and the
+        # number of containers started since
+        self.usage = dict()
+        self.started = dict()
+        # profilename to instance to the CPU counters of its last sample
+        self.counters = dict()
+        # 1-minute load average per CPU
+        self.load = 0.0
+
+    def setLimits(self, profilename, maxcpu, maxmemory, maxload):
+        if maxcpu > 0 or maxmemory > 0 or maxload > 0:
+            self.limits[profilename] = (maxcpu, maxmemory, maxload)
+            self.started.setdefault(profilename, 0)
         else:
-            instance = DockerInstance(profilename, containername, innerport, checkupport, dockeroptions)
-            instance.start()
+            self.limits.pop(profilename, None)
+            self.usage.pop(profilename, None)
+            self.counters.pop(profilename, None)
+
+    def start(self):
+        if self.interval > 0:
+            self.sampler.start(self.interval, now=False)
+            # the load is known right away, rather than after the first interval
+            reactor.callWhenRunning(self.sample)
+
+    def stop(self):
+        if self.sampler.running:
+            self.sampler.stop()
+
+    # how many more containers of the profile fit within its limits
+    def headroom(self, profilename):
+        if profilename not in self.limits:
+            return math.inf
+        (maxcpu, maxmemory, maxload) = self.limits[profilename]
+        if maxload > 0 and self.load >= maxload:
+            return 0
+        if maxcpu == 0 and maxmemory == 0:
+            return math.inf
+        (cpu, memory, containers) = self.usage.get(profilename, (0.0, 0, 0))
+        if containers == 0:
+            # nothing to tell what a container uses until one has been sampled, so one at a time
+            return max(0, 1 - self.started[profilename])
+        fits = math.inf
+        if maxcpu > 0 and cpu > 0:
+            fits = min(fits, math.floor(maxcpu * containers / cpu) - containers)
+        if maxmemory > 0 and memory > 0:
+            fits = min(fits, math.floor(maxmemory * containers / memory) - containers)
+        return max(0, fits - self.started[profilename])
+
+    # whether a new container of the profile may be started, counting it if so
+    def admit(self, profilename):
+        if profilename not in self.limits:
+            return True
+        if self.headroom(profilename) < 1:
+            return False
+        self.started[profilename] += 1
+        return True
+
+    # samples a profile as soon as a container of it is running, if none has been sampled yet,
+    # rather than keep the connections waiting for it until the next interval
+    def instanceReady(self, profilename):
+        if profilename not in self.limits or self.usage.get(profilename, (0.0, 0, 0))[2] > 0:
+            return
+        (maxcpu, maxmemory, maxload) = self.limits[profilename]
+        if maxcpu > 0 or maxmemory > 0:
+            self._sampleProfile(profilename)
+
+    def describe(self, profilename):
+        if profilename not in self.usage:
+            return None
+        (cpu, memory, containers) = self.usage[profilename]
+        return {"cpu": cpu, "memory": memory, "containers": containers, "load": self.load}
+
+    def sample(self):
+        self.load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        profiles = [p for (p, (maxcpu, maxmemory, maxload)) in self.limits.items() if maxcpu > 0 or maxmemory > 0]
+        for profilename in self.limits.keys():
+            if profilename not in profiles:
+                self.onSample(profilename)
+        return defer.DeferredList([self._sampleProfile(profilename) for profilename in profiles])
+
+    def _sampleProfile(self, profilename):
+        instances = list(self.getInstances(profilename))
+        d = defer.DeferredList([self.semaphore.run(threads.deferToThread, self._readStats, instance) for instance in instances], consumeErrors=True)
+        d.addCallback(self._sampled, profilename, instances)
+        d.addErrback(lambda failure: logger.warning("Failed to sample resources of image %s: %s", profilename, failure.getErrorMessage()))
+        return d
+
+    def _readStats(self, instance):
+        # runs in a thread
+        stats = instance.getStats()
+        cpu = stats["cpu_stats"]
+        cpus = cpu.get("online_cpus") or len(cpu["cpu_usage"].get("percpu_usage") or []) or 1
+        memory = stats["memory_stats"]
+        # like docker stats, leave out the page cache, which the kernel frees when memory runs low
+        cache = memory.get("stats", {}).get("inactive_file", memory.get("stats", {}).get("cache", 0))
+        precpu = stats.get("precpu_stats") or {}
+        previous = (precpu["cpu_usage"]["total_usage"], precpu["system_cpu_usage"]) if "system_cpu_usage" in precpu else None
+        return ((cpu["cpu_usage"]["total_usage"], cpu.get("system_cpu_usage", 0)), previous, cpus, memory.get("usage", 0) - cache)
+
+    def _sampled(self, results, profilename, instances):
+        if profilename not in self.limits:
+            return
+        cpu = 0.0
+        memory = 0
+        containers = 0
+        last = self.counters.get(profilename, {})
+        counters = dict()
+        for (instance, (ok, result)) in zip(instances, results):
+            if not ok:
+                # the container may be gone by now
+                logger.debug("Failed to read stats of instance %s: %s", instance.getInstanceID(), result.getErrorMessage())
+                continue
+            (current, previous, cpus, used) = result
+            # with one-shot stats, the CPU use is the difference to the last sample
+            previous = last.get(instance, previous)
+            if previous != None and current[1] > previous[1]:
+                cpu += (current[0] - previous[0]) / (current[1] - previous[1]) * cpus
+            counters[instance] = current
+            memory += used
+            containers += 1
+        self.counters[profilename] = counters
+        self.usage[profilename] = (cpu, memory, containers)
+        self.started[profilename] = 0
+        logger.debug("Containers of image %s use %.2f CPUs and %s bytes of memory (%s containers, load %.2f)", profilename, cpu, memory, containers, self.load)
+        self.onSample(profilename)
+
+# A hashed timer wheel that keeps timers for any number of entries with a single
+# LoopingCall. Time advances in ticks of tick seconds. An entry is scheduled into the
+# slot it expires in, along with the number of rounds around the wheel still to go,
+# and its timerExpired() is called when its slot comes up in its last round.
+# Entries keep their slot in a wheelSlot attribute. Entries in throttled have their
+# throttleExpired() called on every tick, until they remove themselves.
+# now is a clock that is only updated once per tick, for cheap timestamps.
+class TimerWheel():
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.position = 0
+        self.throttled = set()
+        self.now = time.time()
+        self._loop = task.LoopingCall(self._advance)
+
+    def schedule(self, entry, delay):
+        self.cancel(entry)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot][entry] = (ticks - 1) // len(self.slots)
+        entry.wheelSlot = slot
+        self.start()
+
+    def cancel(self, entry):
+        if entry.wheelSlot != None:
+            del self.slots[entry.wheelSlot][entry]
+            entry.wheelSlot = None
+        self.throttled.discard(entry)
+
+    def throttle(self, entry):
+        self.throttled.add(entry)
+        self.start()
+
+    # starts the clock, if it is not running yet
+    def start(self):
+        if not self._loop.running:
+            self.now = time.time()
+            self._loop.start(self.tick, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _advance(self):
+        self.now = time.time()
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        expired = []
+        for (entry, rounds) in slot.items():
+            if rounds == 0:
+                expired += [entry]
+            else:
+                slot[entry] = rounds - 1
+        for entry in expired:
+            del slot[entry]
+            entry.wheelSlot = None
+            entry.timerExpired()
+        for entry in list(self.throttled):
+            entry.throttleExpired()
+
+# Writes events as JSON lines to a file. Events are queued and written in batches by a
+# thread of its own, so the reactor never waits for the disk, and pays for little more
+# than putting a dict on the queue. Each batch is a single write to a file opened for
+# appending, so that the lines of the workers, which share the file, do not interleave.
+class EventLog():
+    BATCHSIZE = 1000
+
+    def __init__(self, fn):
+        self._fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="eventlog", daemon=True)
+        self._thread.start()
+
+    def write(self, event):
+        self._queue.put(event)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCHSIZE and not self._queue.empty():
+                batch += [self._queue.get()]
+            if batch[-1] == None:
+                closing = True
+                batch.pop()
+            try:
+                data = "".join(json.dumps(event) + "\n" for event in batch).encode("utf-8")
+                # a short write only happens when the disk is full
+                while len(data) > 0:
+                    data = data[os.write(self._fd, data):]
+            except Exception as e:
+                logger.error("Failed to write %s events to the event log: %s", len(batch), e)
+        os.close(self._fd)
+
+    # writes out what is queued, and stops
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+# Counters of one profile, cheap enough to update from the relay
+class ProfileStats():
+    __slots__ = ("sessionsActive", "sessionsTotal", "limitRejections", "readinessFailures", "quotaDisconnects",
+        "bytesUp", "bytesDown", "spawnTimes", "destroyTimes", "startTimes", "startFallbacks", "resumes", "resumeEvictions", "sessions")
+
+    def __init__(self):
+        self.sessionsActive = 0
+        self.sessionsTotal = 0
+        self.limitRejections = 0
+        self.readinessFailures = 0
+        self.quotaDisconnects = 0
+        self.bytesUp = 0
+        self.bytesDown = 0
+        self.spawnTimes = Histogram()
+        self.destroyTimes = Histogram()
+        # time until a container is ready, by how it was started
+        self.startTimes = dict()
+        self.startFallbacks = 0
+        self.resumes = 0
+        self.resumeEvictions = 0
+        # sessions going on, whose bytes are not in bytesUp and bytesDown yet
+        self.sessions = set()
+
+    # bytes in both directions, including those of the sessions going on
+    def traffic(self):
+        up = self.bytesUp
+        down = self.bytesDown
+        for session in self.sessions:
+            up += session.upBytes
+            down += session.downBytes
+        return (up, down)
+
+    def observeStart(self, startmode, value):
+        if startmode not in self.startTimes:
+            self.startTimes[startmode] = Histogram()
+        self.startTimes[startmode].observe(value)
+
+# Serves the counters of a DockerPorts object in the Prometheus text format
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, dockerports):
+        super().__init__()
+        self.dockerports = dockerports
+
+    # label values, like the names of profiles, as the text format expects them
+    def _escape(self, value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _metric(self, out, name, kind, help, values):
+        out += ["# HELP switchboard_{} {}".format(name, help), "# TYPE switchboard_{} {}".format(name, kind)]
+        for (labels, value) in values:
+            labelstr = ",".join('{}="{}"'.format(k, self._escape(v)) for (k, v) in labels)
+            braced = "{" + labelstr + "}" if labelstr else ""
+            if kind == "histogram":
+                cumulative = 0
+                for (bound, count) in zip(Histogram.BUCKETS + ["+Inf"], value.counts):
+                    cumulative += count
+                    out += ['switchboard_{}_bucket{{{}le="{}"}} {}'.format(name, labelstr + "," if labelstr else "", bound, cumulative)]
+                out += ["switchboard_{}_sum{} {}".format(name, braced, value.sum)]
+                out += ["switchboard_{}_count{} {}".format(name, braced, value.count)]
+            else:
+                out += ["switchboard_{}{} {}".format(name, braced, value)]
 
-        if profilename not in self.instancesByName:
-            self.instancesByName[profilename] = []
+    def render_GET(self, request):
+        dp = self.dockerports
+        profiles = sorted(dp.stats.keys())
+        def perProfile(f):
+            return [((("profile", p),), f(p)) for p in profiles]
 
-        # in case of reuse, the list will have duplicates
-        self.instancesByName[profilename] += [instance]
+        out = []
+        self._metric(out, "sessions", "gauge", "Active sessions", perProfile(lambda p: dp.stats[p].sessionsActive))
+        self._metric(out, "sessions_total", "counter", "Sessions since startup", perProfile(lambda p: dp.stats[p].sessionsTotal))
+        self._metric(out, "containers", "gauge", "Live containers, including idle and starting ones",
+            perProfile(lambda p: len(dp.instancesByName[p]) + len(dp.idleByName[p]) + len(dp.heldByName[p]) + (1 if p in dp.poolRefilling else 0)))
+        self._metric(out, "idle_containers", "gauge", "Idle prewarmed containers", perProfile(lambda p: len(dp.idleByName[p])))
+        self._metric(out, "pool_hits_total", "counter", "Sessions that got a prewarmed container", perProfile(lambda p: dp.poolHits[p]))
+        self._metric(out, "pool_misses_total", "counter", "Sessions that found no prewarmed container", perProfile(lambda p: dp.poolMisses[p]))
+        self._metric(out, "held_containers", "gauge", "Containers of ended sessions held for the client to resume", perProfile(lambda p: len(dp.heldByName[p])))
+        self._metric(out, "resumes_total", "counter", "Sessions that got the held container of an earlier session", perProfile(lambda p: dp.stats[p].resumes))
+        self._metric(out, "resume_evictions_total", "counter", "Held containers removed before their grace period was over, to make room",
+            perProfile(lambda p: dp.stats[p].resumeEvictions))
+        self._metric(out, "limit_rejections_total", "counter", "Sessions turned away because of limits", perProfile(lambda p: dp.stats[p].limitRejections))
+        self._metric(out, "readiness_failures_total", "counter", "Containers that did not become ready", perProfile(lambda p: dp.stats[p].readinessFailures))
+        self._metric(out, "quota_disconnects_total", "counter", "Sessions disconnected for exceeding a time or traffic limit", perProfile(lambda p: dp.stats[p].quotaDisconnects))
+        self._metric(out, "limit_queue_length", "gauge", "Sessions waiting for a free slot", perProfile(lambda p: len(dp.limitQueues[p])))
+        sampled = [p for p in profiles if p in dp.resourceMonitor.usage]
+        self._metric(out, "containers_cpu", "gauge", "CPUs used by the containers of profiles with resource limits, as of the last sample",
+            [((("profile", p),), dp.resourceMonitor.usage[p][0]) for p in sampled])
+        self._metric(out, "containers_memory_bytes", "gauge", "Memory used by the containers of profiles with resource limits, as of the last sample",
+            [((("profile", p),), dp.resourceMonitor.usage[p][1]) for p in sampled])
+        self._metric(out, "host_load", "gauge", "1-minute load average per CPU of the switchboard's machine", [((), dp.resourceMonitor.load)])
+        self._metric(out, "up_bytes_total", "counter", "Bytes sent from containers to clients", perProfile(lambda p: dp.stats[p].traffic()[0]))
+        self._metric(out, "down_bytes_total", "counter", "Bytes sent from clients to containers", perProfile(lambda p: dp.stats[p].traffic()[1]))
+        self._metric(out, "spawn_seconds", "histogram", "Time from starting a container until it is ready", perProfile(lambda p: dp.stats[p].spawnTimes))
+        self._metric(out, "destroy_seconds", "histogram", "Time to remove a container", perProfile(lambda p: dp.stats[p].destroyTimes))
+        self._metric(out, "start_seconds", "histogram", "Time until a container is ready, by how it was started (run, checkpoint or paused)",
+            [((("profile", p), ("mode", m)), dp.stats[p].startTimes[m]) for p in profiles for m in sorted(dp.stats[p].startTimes.keys())])
+        self._metric(out, "start_fallbacks_total", "counter", "Containers started normally after a checkpoint restore or an unpause failed",
+            perProfile(lambda p: dp.stats[p].startFallbacks))
+        self._metric(out, "ready_seconds", "histogram", "Time from a started container until the readiness check passes",
+            [((("check", k),), dp.readyTimes[k]) for k in sorted(dp.readyTimes.keys())])
+        hosts = sorted(dp.dockerHosts.values(), key=lambda host: host.name)
+        self._metric(out, "docker_host_containers", "gauge", "Containers on a docker host", [((("host", h.name),), len(h.instances)) for h in hosts])
+        self._metric(out, "docker_host_up", "gauge", "Whether new containers are placed on a docker host", [((("host", h.name),), 1 if h.isHealthy() else 0) for h in hosts])
+        self._metric(out, "docker_host_start_failures_total", "counter", "Containers that failed to start on a docker host", [((("host", h.name),), h.startFailures) for h in hosts])
+        self._metric(out, "spawn_queue_length", "gauge", "Sessions waiting to start a container", [((), len(dp.spawnLimiter.queue))])
+        self._metric(out, "spawn_queue_wait_seconds_max", "gauge", "Longest wait to start a container", [((), dp.spawnLimiter.queue.maxWaitTime)])
+        self._metric(out, "spawns_active", "gauge", "Containers being started", [((), dp.spawnLimiter.active)])
+
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        return ("\n".join(out) + "\n").encode("utf-8")
+
+# Serves the admin API of a DockerPorts object, as JSON over HTTP on the admin socket:
+#   GET /profiles, /sessions, /containers
+#   POST /profiles/<name>/drain, /profiles/<name>/undrain, /profiles/<name>/limit?value=<limit>
+#   POST /sessions/<id>/kill
+# All of it is answered from what the switchboard keeps track of, without asking the docker daemon.
+class AdminResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, dockerports):
+        super().__init__()
+        self.dockerports = dockerports
+
+    def _path(self, request):
+        return [p.decode("utf-8") for p in request.postpath if p != b""]
+
+    def _respond(self, request, result, code=200):
+        # the client may be gone by the time a deferred answer is ready
+        if request.channel == None:
+            return
+        request.setResponseCode(code)
+        request.setHeader(b"Content-Type", b"application/json")
+        request.write((json.dumps(result) + "\n").encode("utf-8"))
+        request.finish()
+
+    def _error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader(b"Content-Type", b"application/json")
+        return (json.dumps({"error": message}) + "\n").encode("utf-8")
+
+    def _deferred(self, request, d):
+        def failed(failure):
+            logger.warning("Admin request %s failed: %s", request.uri, failure.getErrorMessage())
+            self._respond(request, {"error": failure.getErrorMessage()}, 500)
+        d.addCallbacks(lambda result: self._respond(request, result), failed)
+        return server.NOT_DONE_YET
+
+    def render_GET(self, request):
+        dp = self.dockerports
+        path = self._path(request)
+        if path == ["profiles"]:
+            return self._deferred(request, defer.succeed(dp.describeProfiles()))
+        if path == ["containers"]:
+            return self._deferred(request, defer.succeed(dp.describeContainers()))
+        if path == ["sessions"]:
+            return self._deferred(request, dp.listSessions())
+        return self._error(request, 404, "Not found")
+
+    def render_POST(self, request):
+        dp = self.dockerports
+        path = self._path(request)
+        if len(path) == 3 and path[0] == "profiles":
+            (profilename, action) = (path[1], path[2])
+            if profilename not in dp.imageParams:
+                return self._error(request, 404, "Unknown profile {}".format(profilename))
+            if action in ["drain", "undrain"]:
+                dp.drain(profilename, action == "drain")
+                return self._deferred(request, defer.succeed(dp.describeProfiles()))
+            if action == "limit":
+                try:
+                    dp.setLimit(profilename, dp._parseInt(request.args.get(b"value", [b""])[0].decode("utf-8")))
+                except ValueError as e:
+                    return self._error(request, 400, str(e))
+                return self._deferred(request, defer.succeed(dp.describeProfiles()))
+        if len(path) == 3 and path[0] == "sessions" and path[2] == "kill":
+            def killed(found):
+                if not found:
+                    self._respond(request, {"error": "Unknown session {}".format(path[1])}, 404)
+                    return
+                self._respond(request, {"killed": path[1]})
+            dp.killSession(path[1]).addCallbacks(killed, lambda failure: self._respond(request, {"error": failure.getErrorMessage()}, 500))
+            return server.NOT_DONE_YET
+        return self._error(request, 404, "Not found")
+
+# The instances of one profile that are handed out to sessions. Every instance counts
+# its own sessions, so that adding and removing a session is O(1), also when many
+# sessions share an instance.
+class ProfileInstances():
+    __slots__ = ("instances", "retired", "sessions")
 
+    def __init__(self):
+        self.instances = set()
+        # instances that keep their sessions, but are not handed out anymore
+        self.retired = set()
+        self.sessions = 0
+
+    def __len__(self):
+        return len(self.instances) + len(self.retired)
+
+    def __iter__(self):
+        return itertools.chain(self.instances, self.retired)
+
+    def add(self, instance):
+        instance.sessions += 1
+        self.sessions += 1
+        self.instances.add(instance)
+
+    def remove(self, instance):
+        instance.sessions -= 1
+        self.sessions -= 1
+        if instance.sessions == 0:
+            self.instances.discard(instance)
+            self.retired.discard(instance)
+
+    def retire(self):
+        self.retired |= self.instances
+        self.instances = set()
+
+    # the shared instance with the fewest sessions, as long as it has less than maxsessions
+    # (0 for no maximum), or None if a new instance should be started
+    def leastLoaded(self, maxsessions):
+        instance = min(self.instances, key=lambda i: i.sessions, default=None)
+        if instance == None or (maxsessions > 0 and instance.sessions >= maxsessions):
+            return None
         return instance
 
-    def destroy(self, instance):
-        profilename = instance.getProfileName()
-        reuse = self.imageParams[profilename]["reuse"]
 
-        # in case of reuse, the list will have duplicates, but remove() does not care
-        self.instancesByName[profilename].remove(instance)
+# Instances of ended sessions, held for their clients to reconnect to, by resume key. A
+# key may hold several instances, of which the most recently held one is resumed first.
+# The least recently held instance is the first to go when room is needed.
+class HeldInstances():
+    def __init__(self):
+        # instance to (key, DelayedCall that ends the grace period), in the order they were held
+        self.instances = collections.OrderedDict()
+        self.byKey = dict()
 
-        # stop the instance if there is no reuse, or if this is the last instance for a reused image
-        if not reuse or len(self.instancesByName[profilename]) == 0:
-            instance.stop()
+    def __len__(self):
+        return len(self.instances)
 
+    def __iter__(self):
+        return iter(self.instances)
+
+    def hold(self, key, instance, expiry):
+        self.instances[instance] = (key, expiry)
+        self.byKey.setdefault(key, []).append(instance)
+
+    # the instance held for key, or None
+    def take(self, key):
+        if key not in self.byKey:
+            return None
+        return self.remove(self.byKey[key][-1])
+
+    def remove(self, instance):
+        (key, expiry) = self.instances.pop(instance)
+        if expiry.active():
+            expiry.cancel()
+        held = self.byKey[key]
+        held.remove(instance)
+        if len(held) == 0:
+            del self.byKey[key]
+        return instance
+
+    def evict(self):
+        return self.remove(next(iter(self.instances)))
+
+
+# A bounded FIFO queue of callers waiting for something, each for at most timeout
+# seconds (0 waits forever). wait() returns a Deferred that fires with True when the
+# caller is woken up, or with False if the queue was full or the wait timed out.
+class WaitQueue():
+    def __init__(self, maxsize=0, timeout=0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._waiters = collections.deque()
+        # statistics
+        self.woken = 0
+        self.rejected = 0
+        self.totalWaitTime = 0.0
+        self.maxWaitTime = 0.0
+
+    def __len__(self):
+        return len(self._waiters)
+
+    # a waiter that was woken, but lost its turn after all, passes the time it first
+    # started waiting as since. It goes back to the front, with the time it had left.
+    def wait(self, since=None):
+        if since == None and self.maxsize > 0 and len(self._waiters) >= self.maxsize:
+            self.rejected += 1
+            return defer.succeed(False)
+
+        waiter = [None, since if since != None else time.time(), None]
+        waiter[0] = defer.Deferred(lambda d: self._remove(waiter))
+        if self.timeout > 0:
+            waiter[2] = reactor.callLater(max(0, waiter[1] + self.timeout - time.time()), self._expire, waiter)
+        if since != None:
+            self._waiters.appendleft(waiter)
+        else:
+            self._waiters.append(waiter)
+        return waiter[0]
+
+    def _remove(self, waiter):
+        self._waiters.remove(waiter)
+        if waiter[2] != None and waiter[2].active():
+            waiter[2].cancel()
+        waittime = time.time() - waiter[1]
+        self.totalWaitTime += waittime
+        self.maxWaitTime = max(self.maxWaitTime, waittime)
+
+    def _expire(self, waiter):
+        self._remove(waiter)
+        self.rejected += 1
+        waiter[0].callback(False)
+
+    def wakeOne(self):
+        if len(self._waiters) == 0:
+            return False
+        waiter = self._waiters[0]
+        self._remove(waiter)
+        self.woken += 1
+        waiter[0].callback(True)
+        return True
+
+
+# Hands out permits to spawn containers: at most rate per second (0 for no limit) with
+# bursts of up to burst, and at most maxconcurrent (0 for no limit) until release() is
+# called. Callers that do not get a permit right away wait in a WaitQueue, in order.
+class SpawnLimiter():
+    def __init__(self, rate=0, burst=0, maxconcurrent=0, queuesize=0, queuetimeout=0):
+        self.rate = rate
+        self.burst = burst if burst > 0 else max(1, rate)
+        self.maxconcurrent = maxconcurrent
+        self.queue = WaitQueue(queuesize, queuetimeout)
+        self.tokens = self.burst
+        self.lastRefill = time.time()
+        self.active = 0
+        self._dispatchCall = None
+
+    def _canAdmit(self):
+        now = time.time()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+        if self.maxconcurrent > 0 and self.active >= self.maxconcurrent:
+            return False
+        return self.rate <= 0 or self.tokens >= 1
+
+    def _admit(self):
+        if self.rate > 0:
+            self.tokens -= 1
+        self.active += 1
+
+    def setRate(self, rate, burst):
+        self._canAdmit()
+        self.rate = rate
+        self.burst = burst if burst > 0 else max(1, rate)
+        self.tokens = min(self.tokens, self.burst)
+        self._dispatch()
+
+    def acquire(self):
+        if len(self.queue) == 0 and self._canAdmit():
+            self._admit()
+            return defer.succeed(True)
+        d = self.queue.wait()
+        self._scheduleDispatch()
+        return d
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        self._dispatchCall = None
+        while len(self.queue) > 0 and self._canAdmit():
+            self._admit()
+            self.queue.wakeOne()
+        self._scheduleDispatch()
+
+    def _scheduleDispatch(self):
+        # when waiting for tokens rather than for a release(), check back once the next token is due
+        if len(self.queue) == 0 or self._dispatchCall != None or self.rate <= 0:
+            return
+        if self.maxconcurrent > 0 and self.active >= self.maxconcurrent:
+            return
+        self._dispatchCall = reactor.callLater(max(0, (1 - self.tokens) / self.rate), self._dispatch)
+
+
+# A docker daemon to place containers on, at url (None for the one configured in the
+# environment). Mapped ports of its containers are reached on address. Containers are
+# spread over the hosts in proportion to their weight, with at most maxcontainers on this
+# one (0 for no maximum). A host that failed to start MAXFAILURES containers in a row gets
+# no new ones for RETRYAFTER seconds, after which it gets to try again.
+class DockerHost():
+    MAXFAILURES = 3
+    RETRYAFTER = 30
+
+    def __init__(self, name, url=None, address="0.0.0.0", weight=1.0, maxcontainers=0, poolsize=None):
+        self.name = name
+        self.url = url
+        self.address = address
+        self.weight = weight
+        self.maxcontainers = maxcontainers
+        self.poolsize = poolsize
+        self.client = None
+        self._clientLock = threading.Lock()
+        # the docker API version of the daemon, once the client has connected to it
+        self.apiVersion = None
+        # live instances, including starting ones
+        self.instances = set()
+        self.failures = 0
+        self.failedAt = 0
+        self.startFailures = 0
+
+    def getClient(self):
+        # runs in a thread, and asks the daemon for its API version the first time
+        with self._clientLock:
+            if self.client == None:
+                options = {"max_pool_size": self.poolsize} if self.poolsize != None else {}
+                if self.url == None:
+                    client = docker.from_env(**options)
+                else:
+                    client = docker.DockerClient(base_url=self.url, **options)
+                self.apiVersion = client.api.api_version
+                self.client = client
+        return self.client
+
+    def load(self):
+        return len(self.instances) / self.weight
+
+    # whether the daemon runs on this machine
+    def isLocal(self):
+        return self.url == None or self.url.startswith("unix://")
+
+    def isHealthy(self):
+        return self.failures < self.MAXFAILURES
+
+    def isAvailable(self):
+        if self.maxcontainers > 0 and len(self.instances) >= self.maxcontainers:
+            return False
+        return self.isHealthy() or self.failedAt + self.RETRYAFTER <= time.time()
+
+    def startSucceeded(self):
+        self.failures = 0
+
+    def startFailed(self):
+        self.failures += 1
+        self.failedAt = time.time()
+        self.startFailures += 1
+        if self.failures == self.MAXFAILURES:
+            logger.warning("Docker host %s failed to start %s containers in a row, skipping it for %s seconds", self.name, self.failures, self.RETRYAFTER)
+
+class DockerInstanceStartError(Exception):
+    pass
+
+class SpawnRejected(DockerInstanceStartError):
+    pass
+
+# how the containers of a profile get started, selected with the startmode option:
+# - run: docker run, and wait for the readiness check
+# - paused: like run, but the idle pool is paused and gets unpaused when handed out
+# - checkpoint: restored from a checkpoint of an already started container
+STARTMODES = ["run", "paused", "checkpoint"]
+
+# A checkpoint of a started and ready container of a profile, taken with docker checkpoint
+# on every docker host, to restore new containers from instead of booting them. That needs
+# CRIU and the experimental features of the daemon, which the Docker SDK has no calls for.
+# A host where taking or restoring the checkpoint fails starts containers normally from
+# then on. A checkpoint replaces the ones taken for earlier settings of the profile, and
+# deletes them on every host it gets taken on.
+class ContainerCheckpoint():
+    TAKING = "taking"
+    TAKEN = "taken"
+    FAILED = "failed"
+    DELETED = "deleted"
+
+    def __init__(self, directory, name, previous=None):
+        # directory on the docker hosts
+        self.directory = directory
+        self.name = name
+        self.state = dict()
+        self.lock = threading.Lock()
+        # the checkpoints this one replaces that are still taken on some host
+        self.replaced = []
+        if previous != None:
+            self.replaced = [checkpoint for checkpoint in [previous] + previous.replaced if checkpoint.hasFiles()]
+
+    def isTaken(self, host):
+        return self.state.get(host.name) == self.TAKEN
+
+    # whether the checkpoint is, or is being, taken on any host
+    def hasFiles(self):
+        with self.lock:
+            return any(state in [self.TAKING, self.TAKEN] for state in self.state.values())
+
+    # whether the caller should take the checkpoint on this host. Only the first one does.
+    def shouldTake(self, host):
+        with self.lock:
+            if host.name in self.state:
+                return False
+            self.state[host.name] = self.TAKING
+            return True
+
+    def failed(self, host):
+        with self.lock:
+            self.state[host.name] = self.FAILED
+
+    def take(self, host, container):
+        # runs in a thread. The container keeps running.
+        api = host.getClient().api
+        started = time.time()
+        try:
+            dockerRequest(api, "post", "/containers/{}/checkpoints".format(container.id),
+                json={"CheckpointID": self.name, "CheckpointDir": self.directory, "Exit": False})
+        except Exception as e:
+            logger.warning("Failed to take checkpoint %s of %s on docker host %s, starting containers normally: %s", self.name, container.id, host.name, e)
+            self.failed(host)
+            return
+        logger.info("Took checkpoint %s of %s on docker host %s in %.3fs", self.name, container.id, host.name, time.time() - started)
+        with self.lock:
+            self.state[host.name] = self.TAKEN
+        self._deleteReplaced(host, container)
+
+    # deletes the files of the replaced checkpoints on the host. Any container can do that,
+    # since they are in a directory of their own, so it is done through the new one.
+    def _deleteReplaced(self, host, container):
+        api = host.getClient().api
+        for checkpoint in self.replaced:
+            with checkpoint.lock:
+                if checkpoint.state.get(host.name) != checkpoint.TAKEN:
+                    continue
+                checkpoint.state[host.name] = checkpoint.DELETED
+            try:
+                dockerRequest(api, "delete", "/containers/{}/checkpoints/{}".format(container.id, checkpoint.name), params={"dir": self.directory})
+                logger.debug("Deleted checkpoint %s on docker host %s", checkpoint.name, host.name)
+            except Exception as e:
+                logger.warning("Failed to delete checkpoint %s on docker host %s: %s", checkpoint.name, host.name, e)
+        self.replaced = [checkpoint for checkpoint in self.replaced if checkpoint.hasFiles()]
+
+    def restore(self, host, spec):
+        # runs in a thread
+        def start(api, containerid):
+            dockerRequest(api, "post", "/containers/{}/start".format(containerid), params={"checkpoint": self.name, "checkpoint-dir": self.directory})
+        return runContainer(host.getClient(), spec, start)
+
+# Calls an endpoint of the Docker API that the Docker SDK has no method for, like the
+# checkpoint ones. The SDK's low-level client is a requests.Session that is set up for
+# its base_url, so this only needs its public attributes.
+def dockerRequest(api, method, path, **kwargs):
+    response = getattr(api, method)("{}/v{}{}".format(api.base_url, api.api_version, path), **kwargs)
+    if response.status_code >= 400:
+        raise docker.errors.APIError("{} {} failed with status {}".format(method.upper(), path, response.status_code),
+            response=response, explanation=response.text)
+    return response
+
+# Creates and starts a container of a profile, from the arguments its spec was compiled
+# to, and pulls the image first if the docker host lacks it, as docker run does. Returns
+# the container as inspected once it is started, with its port mappings.
+def runContainer(client, spec, start=None):
+    # runs in a thread
+    api = client.api
+    args = spec.createArgs(api.api_version)
+    try:
+        containerid = api.create_container(**args)["Id"]
+    except docker.errors.ImageNotFound:
+        client.images.pull(spec.containername)
+        containerid = api.create_container(**args)["Id"]
+    try:
+        if start != None:
+            start(api, containerid)
+        else:
+            api.start(containerid)
+    except Exception:
+        api.remove_container(containerid, force=True)
+        raise
+    return client.containers.get(containerid)
 
 # this class represents a single docker instance listening on a certain middleport.
 # The middleport is managed by the DockerPorts global object
-# After the docker container is started, we wait until the middleport becomes reachable
-# before returning
+# Starting the docker container happens in a thread, after which we wait until the
+# middleport becomes reachable. Nothing in here blocks the reactor; use whenReady()
+# to get notified once the instance can be connected to.
 class DockerInstance():
-    def __init__(self, profilename, containername, innerport, checkupport, dockeroptions):
-        self._profilename = profilename
-        self._containername = containername
-        self._dockeroptions = dockeroptions
-        self._innerport = innerport
-        self._checkupport = checkupport
+    def __init__(self, host, spec, readiness, checkpoint=None):
+        self._host = host
+        self._readiness = readiness
+        self._checkpoint = checkpoint
+        self._spec = spec
         self._instance = None
+        self._mappedPorts = dict()
+        self._ready = None
+        self._readyError = None
+        self._readyWaiters = []
+        self._started = False
+        self._stopped = False
+        self._paused = False
+        # how the container got started, run or checkpoint, and whether restoring it failed
+        self.startMode = "run"
+        self.restoreFailed = False
+        # whether the container started, but did not pass the readiness check
+        self.readinessFailed = False
+        # number of sessions using this instance, maintained by ProfileInstances
+        self.sessions = 0
 
     def getDockerOptions(self):
-        return self._dockeroptions
+        return self._spec.dockeroptions
 
     def getContainerName(self):
-        return self._containername
+        return self._spec.containername
 
-    def getMappedPort(self, inp):
+    # the port key is one of the spec's, like "8000/tcp"
+    def getMappedPort(self, portkey):
+        if portkey in self._mappedPorts:
+            return self._mappedPorts[portkey]
         try:
-            return int(self._instance.attrs["NetworkSettings"]["Ports"]["{}/tcp".format(inp)][0]["HostPort"])
+            self._mappedPorts[portkey] = int(self._instance.attrs["NetworkSettings"]["Ports"][portkey][0]["HostPort"])
+            return self._mappedPorts[portkey]
         except Exception as e:
-            logger.warn("Failed to get port information for port {} from {}: {}".format(inp, self.getInstanceID(), e))
+            logger.warning("Failed to get port information for port %s from %s: %s", portkey, self.getInstanceID(), e)
         return None
 
     def getMiddlePort(self):
-        return self.getMappedPort(self._innerport)
+        return self.getMappedPort(self._spec.innerPortKey)
+
+    def getMiddleHost(self):
+        return self._host.address
+
+    def getHost(self):
+        return self._host
 
     def getMiddleCheckupPort(self):
-        return self.getMappedPort(self._checkupport)
+        return self.getMappedPort(self._spec.checkupPortKey)
 
     def getProfileName(self):
-        return self._profilename
+        return self._spec.name
+
+    def hasContainer(self):
+        return self._instance != None
 
     def getInstanceID(self):
         try:
             return self._instance.id
         except Exception as e:
-            logger.warn("Failed to get instanceid: {}".format(e))
+            logger.warning("Failed to get instanceid: %s", e)
         return "None"
 
+    def whenReady(self):
+        if self._ready is True:
+            return defer.succeed(self)
+        if self._ready is False:
+            return defer.fail(self._readyError)
+        d = defer.Deferred(lambda d: self._readyWaiters.remove(d))
+        self._readyWaiters += [d]
+        return d
+
+    def _setReady(self, ready, error=None):
+        self._ready = ready
+        if not ready:
+            self._readyError = error if error != None else DockerInstanceStartError("Instance of {} failed to start".format(self.getProfileName()))
+        waiters, self._readyWaiters = self._readyWaiters, []
+        for d in waiters:
+            if ready:
+                d.callback(self)
+            else:
+                d.errback(self._readyError)
+
+    # called instead of start() if the instance was not admitted
+    def reject(self):
+        self._setReady(False, SpawnRejected("Not admitted to start an instance of {}".format(self.getProfileName())))
+
+    def _runContainer(self):
+        # runs in a thread, so this is free to block on the docker daemon
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Starting instance %s of container %s with dockeroptions %s", self.getProfileName(), self.getContainerName(), pprint.pformat(self.getDockerOptions()))
+        if self._checkpoint != None and self._checkpoint.isTaken(self._host):
+            try:
+                self._instance = self._checkpoint.restore(self._host, self._spec)
+                self.startMode = "checkpoint"
+            except Exception as e:
+                logger.warning("Failed to restore instance %s from checkpoint %s on docker host %s, starting it normally: %s",
+                    self.getProfileName(), self._checkpoint.name, self._host.name, e)
+                self._checkpoint.failed(self._host)
+                self.restoreFailed = True
+        if self._instance == None:
+            self._instance = runContainer(self._host.getClient(), self._spec)
+        logger.debug("Done starting instance %s of container %s", self.getProfileName(), self.getContainerName())
+
+    @defer.inlineCallbacks
     def start(self):
-        # get docker client
-        client = docker.from_env()
+        self._started = True
+        # the instance may have been stopped while it was waiting to be admitted
+        if self._stopped:
+            self._setReady(False)
+            return False
 
         # start instance
         try:
-            logger.debug("Starting instance {} of container {} with dockeroptions {}".format(self.getProfileName(), self.getContainerName(), pprint.pformat(self.getDockerOptions())))
-            clientres = client.containers.run(self.getContainerName(), **self.getDockerOptions())
-            self._instance = client.containers.get(clientres.id)
-            logger.debug("Done starting instance {} of container {}".format(self.getProfileName(), self.getContainerName()))
+            yield threads.deferToThread(self._runContainer)
         except Exception as e:
-            logger.debug("Failed to start instance {} of container {}: {}".format(self.getProfileName(), self.getContainerName(), e))
-            self.stop()
+            logger.debug("Failed to start instance %s of container %s on docker host %s: %s", self.getProfileName(), self.getContainerName(), self._host.name, e)
+            self._host.startFailed()
+            yield threads.deferToThread(self.removeContainer)
+            self._setReady(False)
+            return False
+        self._host.startSucceeded()
+
+        # or while the container was starting up
+        if self._stopped:
+            yield threads.deferToThread(self.removeContainer)
+            self._setReady(False)
             return False
 
-        # wait until container's checkupport is available
-        logger.debug("Started instance on middleport {} with ID {}".format(self.getMiddlePort(), self.getInstanceID()))
-        if self.__waitForOpenPort(self.getMiddleCheckupPort()):
-            logger.debug("Started instance on middleport {} with ID {} has open port {}".format(self.getMiddlePort(), self.getInstanceID(), self.getMiddleCheckupPort()))
+        # wait until container is ready
+        logger.debug("Started instance on middleport %s with ID %s", self.getMiddlePort(), self.getInstanceID())
+        isOpen = yield self._readiness.waitUntilReady(self)
+        self.readinessFailed = not isOpen
+        # the first ready container on a host gets checkpointed, for the ones after it
+        if isOpen and not self._stopped and self._checkpoint != None and self._checkpoint.shouldTake(self._host):
+            yield threads.deferToThread(self._checkpoint.take, self._host, self._instance)
+        if isOpen and not self._stopped:
+            logger.debug("Started instance on middleport %s with ID %s has open port %s", self.getMiddlePort(), self.getInstanceID(), self.getMiddleCheckupPort())
+            self._setReady(True)
             return True
         else:
-            logger.debug("Started instance on middleport {} with ID {} has closed port {}".format(self.getMiddlePort(), self.getInstanceID(), self.getMiddleCheckupPort()))
-            self.stop()
+            logger.debug("Started instance on middleport %s with ID %s has closed port %s", self.getMiddlePort(), self.getInstanceID(), self.getMiddleCheckupPort())
+            yield threads.deferToThread(self.removeContainer)
+            self._setReady(False)
             return False
 
+    def isStopped(self):
+        return self._stopped
+
+    def getHealthStatus(self):
+        # runs in a thread
+        self._instance.reload()
+        return self._instance.attrs["State"].get("Health", {}).get("Status")
+
+    def isStarting(self):
+        return self._ready is None
+
+    def getStats(self):
+        # runs in a thread
+        return self._instance.stats(stream=False, one_shot=True)
+
+    def pause(self):
+        # runs in a thread
+        self._instance.pause()
+        self._paused = True
+
+    def unpause(self):
+        # runs in a thread
+        self._instance.unpause()
+        self._paused = False
+
+    def isPaused(self):
+        return self._paused
+
+    # Marks the instance as stopped. Returns whether the container still has to be removed
+    # by the caller, which is not the case if it is already gone, or if start() is still in
+    # progress and removes it once it notices.
     def stop(self):
+        if self._stopped:
+            return False
+        self._stopped = True
+        if self._ready is None and not self._started:
+            # not even admitted to start yet
+            self._setReady(False)
+        return self._ready is True
+
+    def removeContainer(self):
+        # runs in a thread
+        if self._instance == None:
+            return True
         mp = self.getMiddlePort()
         cid = self.getInstanceID()
-        logger.debug("Killing and removing {} (middleport {})".format(cid, mp))
+        logger.debug("Killing and removing %s (middleport %s)", cid, mp)
         try:
             self._instance.remove(force=True)
+        except docker.errors.NotFound:
+            pass
         except Exception as e:
-            logger.warn("Failed to remove instance for middleport {}, id {}".format(mp, cid))
+            logger.warning("Failed to remove instance for middleport %s, id %s", mp, cid)
             return False
         return True
 
-    def __isPortOpen(self, port, readtimeout=0.1):
-        s = socket.socket()
-        ret = False
-        logger.debug("Checking whether port {} is open...".format(port))
+
+# Histogram of durations in seconds, with the bucket bounds in BUCKETS
+class Histogram():
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Ways to tell that a freshly started container is ready to accept sessions, selected
+# with the readiness option of a profile. waitUntilReady() returns a Deferred that fires
+# with True once the instance is ready, or with False if it did not become ready within
+# timeout seconds. The time it took is recorded in readyTimes.
+# This one is the banner check: the container is ready once its checkupport sends at least
+# 1 byte, like the banner of an SSH server. Just connecting is not enough, since
+# docker-proxy accepts connections before the daemon in the container does.
+class ReadinessCheck():
+    # delay between attempts, doubling from MINSTEP up to MAXSTEP
+    MINSTEP = 0.05
+    MAXSTEP = 1.0
+    requireData = True
+
+    def __init__(self, timeout, readyTimes, probeHeader=b""):
+        self.timeout = timeout
+        self.readyTimes = readyTimes
+        # sent first on every connection to the container, if the check makes any
+        self.probeHeader = probeHeader
+
+    def check(self, instance, step):
+        port = instance.getMiddleCheckupPort()
         if port == None:
-            time.sleep(readtimeout)
-        else:
-            try:
-                s.connect(("0.0.0.0", port))
-                # just connecting is not enough, we should try to read and get at least 1 byte back
-                # since the daemon in the container might not have started accepting connections yet, while docker-proxy does
-                s.settimeout(readtimeout)
-                data = s.recv(1)
-                ret = len(data) > 0
-            except socket.error:
-                ret = False
-
-        logger.debug("result = ".format(ret))
-        s.close()
-        return ret
-
-    def __waitForOpenPort(self, port, timeout=5, step=0.1):
+            return defer.succeed(False)
+
+        factory = PortProbeFactory(max(0.1, step), self.requireData, self.probeHeader)
+        reactor.connectTCP(instance.getMiddleHost(), port, factory, timeout=max(0.1, step))
+        return factory.deferred
+
+    @defer.inlineCallbacks
+    def waitUntilReady(self, instance):
         started = time.time()
+        step = self.MINSTEP
 
-        while started + timeout >= time.time():
-            if self.__isPortOpen(port):
+        while started + self.timeout >= time.time():
+            isReady = yield self.check(instance, step)
+            logger.debug("Readiness check %s for %s: %s", self.__class__.__name__, instance.getInstanceID(), isReady)
+            if isReady:
+                self.readyTimes.observe(time.time() - started)
                 return True
-            time.sleep(step)
+            yield task.deferLater(reactor, step, lambda: None)
+            step = min(step * 2, self.MAXSTEP)
         return False
-        
+
+# For services that do not send a banner: the container is ready once a connection to its
+# checkupport is accepted and not closed right away, which is what docker-proxy does for
+# as long as nothing in the container listens on the port.
+class TcpReadiness(ReadinessCheck):
+    requireData = False
+
+# The container is ready once the HEALTHCHECK of its image reports it as healthy.
+class HealthcheckReadiness(ReadinessCheck):
+    def check(self, instance, step):
+        d = threads.deferToThread(instance.getHealthStatus)
+        def gotStatus(status):
+            if status == None:
+                raise DockerInstanceStartError("Instance {} has no HEALTHCHECK".format(instance.getInstanceID()))
+            if status == "unhealthy":
+                raise DockerInstanceStartError("Instance {} is unhealthy".format(instance.getInstanceID()))
+            return status == "healthy"
+        return d.addCallback(gotStatus)
+
+    def waitUntilReady(self, instance):
+        # an unhealthy container is not going to get healthy anymore, nor is one without
+        # a HEALTHCHECK going to report anything
+        def failed(failure):
+            logger.warning("Readiness check of %s failed: %s", instance.getProfileName(), failure.getErrorMessage())
+            return False
+        return super().waitUntilReady(instance).addErrback(failed)
+
+READINESSCHECKS = {
+    "banner": ReadinessCheck,
+    "tcp": TcpReadiness,
+    "healthcheck": HealthcheckReadiness,
+}
+
+# Probes a port from within the reactor. The result is True if the connection sent
+# data, or if requireData is False and the connection stayed open for readtimeout.
+class PortProbe(protocol.Protocol):
+    def connectionMade(self):
+        self._timeout = self.factory.reactor.callLater(self.factory.readtimeout, self.timedOut)
+        if self.factory.header:
+            self.transport.write(self.factory.header)
+
+    def timedOut(self):
+        self.factory.result = not self.factory.requireData
+        self.transport.abortConnection()
+
+    def dataReceived(self, data):
+        self.factory.result = len(data) > 0
+        self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        if self._timeout.active():
+            self._timeout.cancel()
+
+class PortProbeFactory(protocol.ClientFactory):
+    protocol = PortProbe
+    noisy = False
+
+    def __init__(self, readtimeout, requireData=True, header=b""):
+        self.reactor = reactor
+        self.readtimeout = readtimeout
+        self.requireData = requireData
+        self.header = header
+        self.result = False
+        self.deferred = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.deferred.callback(False)
+
+    def clientConnectionLost(self, connector, reason):
+        self.deferred.callback(self.result)
+
+# The PROXY protocol, see https://www.haproxy.org/download/2.8/doc/proxy-protocol.txt. Load
+# balancers send a header with the address of the client first thing on a connection, and
+# the switchboard can pass one on to the containers in turn.
+PROXY_V1_PREFIX = b"PROXY "
+PROXY_V1_MAXLENGTH = 107
+PROXY_V2_SIGNATURE = b"\r\n\r\n\x00\r\nQUIT\n"
+
+# the length of the address block of a version 2 header, per address family and protocol
+PROXY_V2_ADDRESSLENGTHS = {0x11: 12, 0x12: 12, 0x21: 36, 0x22: 36, 0x31: 216, 0x32: 216}
+
+# Parses the PROXY protocol header, of either version, at the start of data. Returns None
+# if data does not hold all of it yet, or (length, source, destination, tlvs), with the
+# addresses as IPv4Address or IPv6Address, or None for connections that the proxy made on
+# its own behalf, and the TLVs of a version 2 header as a dict of their values by type.
+# Raises ValueError if data does not start with a valid header.
+def parseProxyHeader(data):
+    if data.startswith(PROXY_V2_SIGNATURE):
+        if len(data) < 16:
+            return None
+        (versionCommand, family, length) = struct.unpack_from("!BBH", data, 12)
+        if versionCommand >> 4 != 2 or versionCommand & 0xF > 1:
+            raise ValueError("Unsupported PROXY v2 version or command {:#x}".format(versionCommand))
+        if len(data) < 16 + length:
+            return None
+        # LOCAL tells nothing about the client
+        if versionCommand & 0xF == 0:
+            return (16 + length, None, None, {})
+        addressLength = PROXY_V2_ADDRESSLENGTHS.get(family, 0)
+        if length < addressLength:
+            raise ValueError("PROXY v2 address block too short")
+        tlvs = dict()
+        offset = 16 + addressLength
+        while offset < 16 + length:
+            if offset + 3 > 16 + length:
+                raise ValueError("PROXY v2 TLV truncated")
+            (kind, size) = struct.unpack_from("!BH", data, offset)
+            if offset + 3 + size > 16 + length:
+                raise ValueError("PROXY v2 TLV truncated")
+            tlvs[kind] = data[offset + 3:offset + 3 + size]
+            offset += 3 + size
+        # anything other than TCP tells nothing about the client either
+        if family not in (0x11, 0x21):
+            return (16 + length, None, None, tlvs)
+        (kind, af, size) = (address.IPv4Address, socket.AF_INET, 4) if family == 0x11 else (address.IPv6Address, socket.AF_INET6, 16)
+        (source, destination, sourcePort, destinationPort) = struct.unpack_from("!{0}s{0}sHH".format(size), data, 16)
+        return (16 + length, kind("TCP", socket.inet_ntop(af, source), sourcePort), kind("TCP", socket.inet_ntop(af, destination), destinationPort), tlvs)
+
+    if data.startswith(PROXY_V1_PREFIX):
+        end = data.find(b"\r\n", 0, PROXY_V1_MAXLENGTH)
+        if end < 0:
+            if len(data) >= PROXY_V1_MAXLENGTH:
+                raise ValueError("PROXY v1 header too long")
+            return None
+        fields = data[:end].decode("ascii", "replace").split(" ")
+        if len(fields) >= 2 and fields[1] == "UNKNOWN":
+            return (end + 2, None, None, {})
+        if len(fields) != 6 or fields[1] not in ("TCP4", "TCP6"):
+            raise ValueError("Malformed PROXY v1 header")
+        (kind, version) = (address.IPv4Address, 4) if fields[1] == "TCP4" else (address.IPv6Address, 6)
+        try:
+            hosts = [ipaddress.ip_address(h) for h in fields[2:4]]
+            ports = [int(p) for p in fields[4:6]]
+        except ValueError:
+            raise ValueError("Malformed PROXY v1 header")
+        if any(h.version != version for h in hosts):
+            raise ValueError("PROXY v1 header has addresses of another family than {}".format(fields[1]))
+        hosts = [str(h) for h in hosts]
+        if any(p < 0 or p > 65535 for p in ports):
+            raise ValueError("Malformed PROXY v1 header")
+        return (end + 2, kind("TCP", hosts[0], ports[0]), kind("TCP", hosts[1], ports[1]), {})
+
+    # may still become either
+    if PROXY_V2_SIGNATURE.startswith(data) or PROXY_V1_PREFIX.startswith(data):
+        return None
+    raise ValueError("No PROXY protocol header")
+
+# The PROXY protocol header of version v1 or v2 for a connection from source to
+# destination. Without both addresses of the same family, the header says that the
+# connection is the proxy's own.
+def buildProxyHeader(version, source, destination):
+    if source == None or destination == None or type(source) != type(destination):
+        return b"PROXY UNKNOWN\r\n" if version == "v1" else PROXY_V2_SIGNATURE + b"\x20\x00\x00\x00"
+    ipv6 = isinstance(source, address.IPv6Address)
+    if version == "v1":
+        return "PROXY {} {} {} {} {}\r\n".format("TCP6" if ipv6 else "TCP4", source.host, destination.host, source.port, destination.port).encode("ascii")
+    af = socket.AF_INET6 if ipv6 else socket.AF_INET
+    addresses = socket.inet_pton(af, source.host) + socket.inet_pton(af, destination.host) + struct.pack("!HH", source.port, destination.port)
+    return PROXY_V2_SIGNATURE + struct.pack("!BBH", 0x21, 0x21 if ipv6 else 0x11, len(addresses)) + addresses
+
+# The end of a session towards the container. Its peer is the session.
 class LoggingProxyClient(ProxyClient):
+    def __init__(self, server):
+        self.transport = None
+        self.connected = 0
+        self.peer = server
+
+    def connectionMade(self):
+        # ProxyClient registers each transport as the producer for the other one, so one side
+        # stops reading as soon as more than bufferSize bytes wait to be written to the other side,
+        # and resumes once those have been written out.
+        server = self.peer
+        params = server.params
+        self.transport.bufferSize = params.highwatermark
+        server.transport.bufferSize = params.highwatermark
+        server.lastActivity = globalDockerPorts.timerWheel.now
+        # tell the container where the client connects from
+        if params.sendproxy != "none":
+            self.transport.write(buildProxyHeader(params.sendproxy, server.getClientAddress(), server.getLocalAddress()))
+        super().connectionMade()
+        # what the client sent right after its PROXY header
+        if server.pendingData != None:
+            data, server.pendingData = server.pendingData, None
+            server.dataReceived(data)
+
     def dataReceived(self, data):
-        payloadlen = len(data)
-        self.factory.server.upBytes += payloadlen
-        self.peer.transport.write(data)
+        server = self.peer
+        server.upBytes += len(data)
+        server.transport.write(data)
+        if server.quotas:
+            server.checkQuotas(len(data))
 
-class LoggingProxyClientFactory(ProxyClientFactory):
-    protocol = LoggingProxyClient
+    def connectionLost(self, reason):
+        self.peer.containerClosed = True
+        super().connectionLost(reason)
 
+# How a client that reconnects is recognized, to resume its session on the container it
+# had, selected with the resumekey option of a profile. A session without a key is not
+# held, and gets a new container.
+# - ip: the address the client connects from. Clients behind the same NAT or load balancer
+#   share it, so one of them can get the container that another one left.
+# - tlv: the address along with the PROXY protocol v2 TLV of type resumetlv, which a load
+#   balancer in front of the switchboard sets to tell its clients apart
+def tlvResumeKey(session):
+    if session.proxyTLVs == None or session.params.resumetlv not in session.proxyTLVs:
+        return None
+    return "{} {}".format(session.getClientAddress().host, session.proxyTLVs[session.params.resumetlv].hex())
+
+RESUMEKEYS = {
+    "ip": lambda session: session.getClientAddress().host,
+    "tlv": tlvResumeKey,
+}
+
+# Sessions are numbered per process, with a random prefix to tell processes apart
+SESSIONPREFIX = os.urandom(3).hex()
+sessionNumbers = itertools.count(1)
+
+# A session, from the client to the container. Most sessions sit idle for a long time, so
+# they are kept small: the settings are shared with the profile, and bytes are counted here
+# rather than in the profile's counters, which only get them once the session ends. The
+# session also serves as the factory of its connection to the container, rather than
+# allocating one.
 class DockerProxyServer(ProxyServer):
-    clientProtocolFactory = LoggingProxyClientFactory
-    reactor = None
+    # seconds to wait for the PROXY protocol header, if the profile expects one
+    PROXYHEADERTIMEOUT = 5
 
     def __init__(self):
-        super().__init__()
-        self.downBytes = 0
-        self.upBytes = 0
-        self.sessionID = "".join([random.choice(string.ascii_letters) for _ in range(16)])
+        self.transport = None
+        self.factory = None
+        self.connected = 0
+        self.peer = None
+        self.sessionNumber = next(sessionNumbers)
         self.sessionStart = time.time()
+        self.upBytes = 0
+        self.downBytes = 0
+        self.disconnected = False
+        # how the session ended, for the event log
+        self.outcome = "closed"
+        self.dockerinstance = None
+        self.instanceID = None
+        self.pendingCreate = None
+        # whether the container ended the session, rather than the client
+        self.containerClosed = False
+        self.stats = None
+        # the settings of the profile at the time the session started
+        self.params = None
+        # where the client connects from and to, as told by the PROXY protocol header if the
+        # profile expects one. Until that has been read, proxyHeader holds what came so far.
+        self.proxySource = None
+        self.proxyDestination = None
+        self.proxyTLVs = None
+        self.proxyHeader = None
+        self.proxyTimeout = None
+        self.pendingData = None
+        # time and traffic limits
+        self.quotas = False
+        self.wheelSlot = None
+        self.lastActivity = self.sessionStart
+        self.windowStart = 0
+        self.windowBytes = 0
+        # whether the rate limit paused both transports until the next tick
+        self.throttled = False
+
+    @property
+    def sessionID(self):
+        return "{}{:06x}".format(SESSIONPREFIX, self.sessionNumber)
+
+    def getClientAddress(self):
+        return self.proxySource if self.proxySource != None else self.transport.getPeer()
+
+    def getLocalAddress(self):
+        return self.proxyDestination if self.proxyDestination != None else self.transport.getHost()
 
     # This is a reimplementation, except that we want to specify host and port...
     def connectionMade(self): 
+        global globalDockerPorts
+        self.stats = globalDockerPorts.stats[self.factory.profilename]
+        self.stats.sessionsActive += 1
+        self.stats.sessionsTotal += 1
+        self.stats.sessions.add(self)
+
+        params = self.params = globalDockerPorts.imageParams[self.factory.profilename]
+        self.quotas = params.idletimeout > 0 or params.maxbytes > 0 or params.ratelimit > 0
+        if params.maxduration > 0 or params.idletimeout > 0:
+            globalDockerPorts.timerWheel.schedule(self, self._timeLeft(self.sessionStart))
+
+        if params.acceptproxy:
+            self.proxyHeader = b""
+            self.proxyTimeout = reactor.callLater(self.PROXYHEADERTIMEOUT, self._proxyHeaderTimedOut)
+            return
+        self._startSession()
+
+    def _startSession(self):
         # Don't read anything from the connecting client until we have
         # somewhere to send it to.
         self.transport.pauseProducing()
+        logger.info("[Session %s] Incoming connection for image %s from %s at %s", self.sessionID, self.factory.profilename,
+            self.getClientAddress(), self.sessionStart)
 
-        client = self.clientProtocolFactory()
-        client.setServer(self)
+        # the instance may take a while to start. Meanwhile the reactor keeps serving other sessions.
+        self.pendingCreate = globalDockerPorts.create(self.factory.profilename, self._resumeKey())
+        self.pendingCreate.addCallbacks(self._instanceReady, self._instanceFailed)
 
-        if self.reactor is None:
-            from twisted.internet import reactor
-            self.reactor = reactor
-        global globalDockerPorts
-        self.dockerinstance = globalDockerPorts.create(self.factory.profilename)
-        if self.dockerinstance == None:
-            self.transport.write(bytearray("Maximum connection-count reached. Try again later.\r\n", "utf-8"))
+    def _readProxyHeader(self, data):
+        if len(self.proxyHeader) > 0:
+            data = self.proxyHeader + data
+        try:
+            header = parseProxyHeader(data)
+        except ValueError as e:
+            logger.warning("[Session %s] Closing connection for image %s from %s: %s", self.sessionID, self.factory.profilename, self.getClientAddress(), e)
+            self._proxyHeaderFailed()
+            return
+        if header == None:
+            self.proxyHeader = data
+            return
+
+        (length, source, destination, tlvs) = header
+        self.proxyHeader = None
+        self.proxyTimeout.cancel()
+        self.proxyTimeout = None
+        self.proxySource = source
+        self.proxyDestination = destination
+        self.proxyTLVs = tlvs
+        # the first payload is only copied if it came along with the header
+        if length < len(data):
+            self.pendingData = data[length:]
+        self._startSession()
+
+    def _proxyHeaderTimedOut(self):
+        logger.warning("[Session %s] Closing connection for image %s from %s: no PROXY protocol header within %s seconds",
+            self.sessionID, self.factory.profilename, self.getClientAddress(), self.PROXYHEADERTIMEOUT)
+        self._proxyHeaderFailed()
+
+    def _proxyHeaderFailed(self):
+        self.proxyHeader = None
+        if self.proxyTimeout.active():
+            self.proxyTimeout.cancel()
+        self.outcome = "failed"
+        self.transport.abortConnection()
+
+    def _instanceReady(self, instance):
+        self.pendingCreate = None
+        if instance == None:
+            self.outcome = "rejected"
+            self.transport.write("Maximum connection-count reached. Try again later.\r\n".encode("utf-8"))
+            self.transport.loseConnection()
+            return
+
+        if self.disconnected:
+            # the client left while the instance was starting up
+            global globalDockerPorts
+            globalDockerPorts.destroy(instance, self._resumeKey() if self.outcome == "closed" else None)
+            return
+
+        self.dockerinstance = instance
+        self.instanceID = instance.getInstanceID()
+        logger.debug("[Session %s] Connecting to middleport %s with ID %s", self.sessionID, instance.getMiddlePort(), instance.getInstanceID())
+        reactor.connectTCP(instance.getMiddleHost(), instance.getMiddlePort(), self)
+
+    # the factory of the connection to the container
+
+    def doStart(self):
+        pass
+
+    def doStop(self):
+        pass
+
+    def startedConnecting(self, connector):
+        pass
+
+    def buildProtocol(self, addr):
+        if self.disconnected:
+            return None
+        return LoggingProxyClient(self)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.containerClosed = True
+        self.transport.loseConnection()
+
+    def clientConnectionLost(self, connector, reason):
+        pass
+
+    def describe(self):
+        peer = self.getClientAddress()
+        return {"session": self.sessionID, "profile": self.factory.profilename, "client": peer.host, "clientport": peer.port,
+            "instance": self.instanceID, "start": self.sessionStart, "duration": time.time() - self.sessionStart,
+            "upbytes": self.upBytes, "downbytes": self.downBytes}
+
+    # ends the session right away, without holding its container for the client
+    def kill(self):
+        logger.info("[Session %s] Killing session for image %s", self.sessionID, self.factory.profilename)
+        self.outcome = "killed"
+        self.transport.abortConnection()
+
+    # the key to recognize the client by when it reconnects, or None if the profile does not
+    # hold on to containers
+    def _resumeKey(self):
+        if self.params.resumegrace <= 0:
+            return None
+        return RESUMEKEYS[self.params.resumekey](self)
+
+    def _instanceFailed(self, failure):
+        self.pendingCreate = None
+        if failure.check(defer.CancelledError):
+            return
+        logger.warning("[Session %s] Failed to start instance for image %s: %s", self.sessionID, self.factory.profilename, failure.getErrorMessage())
+        self.outcome = "failed"
+        if not self.disconnected:
+            self.transport.write("Failed to start a container. Try again later.\r\n".encode("utf-8"))
             self.transport.loseConnection()
-        else:
-            logger.info("[Session {}] Incoming connection for image {} from {} at {}".format(self.sessionID, self.dockerinstance.getProfileName(),
-                self.transport.getPeer(), self.sessionStart))
-            self.reactor.connectTCP("0.0.0.0", self.dockerinstance.getMiddlePort(), client)
 
     def connectionLost(self, reason):
-        profilename = "<none>"
+        self.disconnected = True
+        self.stats.sessionsActive -= 1
+        self.stats.sessions.discard(self)
+        self.stats.bytesUp += self.upBytes
+        self.stats.bytesDown += self.downBytes
+        globalDockerPorts.timerWheel.cancel(self)
+        profilename = self.factory.profilename
+        # stop waiting for an instance that is not needed anymore
+        if self.pendingCreate != None:
+            self.pendingCreate.cancel()
+        if self.proxyTimeout != None and self.proxyTimeout.active():
+            self.proxyTimeout.cancel()
         if self.dockerinstance != None:
-            global globalDockerPorts
-            globalDockerPorts.destroy(self.dockerinstance)
-            profilename = self.dockerinstance.getProfileName()
+            # the container is held for the client to come back, unless the session ended for good
+            resumable = self.outcome == "closed" and not self.containerClosed
+            globalDockerPorts.destroy(self.dockerinstance, self._resumeKey() if resumable else None)
         self.dockerinstance = None
+        globalDockerPorts.dropIfRetired(profilename)
         super().connectionLost(reason)
         timenow = time.time()
-        logger.info("[Session {}] server disconnected session for image {} from {} (start={}, end={}, duration={}, upBytes={}, downBytes={}, totalBytes={})".format(
-                self.sessionID, profilename, self.transport.getPeer(),
+        peer = self.getClientAddress()
+        if globalDockerPorts.eventLog != None:
+            globalDockerPorts.eventLog.write({"event": "session", "session": self.sessionID, "profile": profilename,
+                "client": peer.host, "clientport": peer.port, "instance": self.instanceID, "outcome": self.outcome,
+                "start": self.sessionStart, "end": timenow, "duration": timenow - self.sessionStart,
+                "upbytes": self.upBytes, "downbytes": self.downBytes})
+        logger.info("[Session %s] server disconnected session for image %s from %s (start=%s, end=%s, duration=%s, upBytes=%s, downBytes=%s, totalBytes=%s)",
+                self.sessionID, profilename, peer,
                 self.sessionStart, timenow, timenow-self.sessionStart,
-                self.upBytes, self.downBytes, self.upBytes + self.downBytes))
+                self.upBytes, self.downBytes, self.upBytes + self.downBytes)
 
     def dataReceived(self, data):
-        payloadlen = len(data)
-        self.downBytes += payloadlen
+        if self.proxyHeader != None:
+            self._readProxyHeader(data)
+            return
+        self.downBytes += len(data)
         self.peer.transport.write(data)
+        if self.quotas:
+            self.checkQuotas(len(data))
+
+    # called for data in either direction, if the profile has traffic or idle limits
+    def checkQuotas(self, payloadlen):
+        timerWheel = globalDockerPorts.timerWheel
+        self.lastActivity = timerWheel.now
+        maxBytes = self.params.maxbytes
+        if maxBytes > 0 and self.upBytes + self.downBytes > maxBytes:
+            self._quotaExceeded("traffic limit of {} bytes".format(maxBytes))
+            return
+        rateLimit = self.params.ratelimit
+        if rateLimit > 0:
+            if self.windowStart != timerWheel.now:
+                # now only moves on while the wheel runs
+                timerWheel.start()
+                self.windowStart = timerWheel.now
+                self.windowBytes = 0
+            self.windowBytes += payloadlen
+            if self.windowBytes > rateLimit * timerWheel.tick and not self.throttled:
+                # stop reading from both sides until the next tick
+                self.throttled = True
+                self.transport.pauseProducing()
+                self.peer.transport.pauseProducing()
+                timerWheel.throttle(self)
+
+    def throttleExpired(self):
+        timerWheel = globalDockerPorts.timerWheel
+        timerWheel.throttled.discard(self)
+        self.windowStart = timerWheel.now
+        self.windowBytes = 0
+        if not self.throttled:
+            return
+        self.throttled = False
+        # A side stays paused if the other side's buffer is above highwatermark, then
+        # flow control resumes it once that buffer has been written out.
+        if self.peer == None:
+            self.transport.resumeProducing()
+            return
+        if not self.peer.transport.producerPaused:
+            self.transport.resumeProducing()
+        if not self.transport.producerPaused:
+            self.peer.transport.resumeProducing()
+
+    def _timeLeft(self, now):
+        left = []
+        if self.params.maxduration > 0:
+            left += [self.sessionStart + self.params.maxduration - now]
+        if self.params.idletimeout > 0:
+            # the idle clock only starts once the container is connected
+            lastActivity = self.lastActivity if self.peer != None else now
+            left += [lastActivity + self.params.idletimeout - now]
+        return min(left)
+
+    def timerExpired(self):
+        timerWheel = globalDockerPorts.timerWheel
+        left = self._timeLeft(timerWheel.now)
+        maxDuration = self.params.maxduration
+        if left > 0:
+            timerWheel.schedule(self, left)
+        elif maxDuration > 0 and self.sessionStart + maxDuration <= timerWheel.now:
+            self._quotaExceeded("time limit of {} seconds".format(maxDuration))
+        else:
+            self._quotaExceeded("idle timeout of {} seconds".format(self.params.idletimeout))
+
+    def _quotaExceeded(self, why):
+        logger.info("[Session %s] Disconnecting session for image %s: exceeded %s", self.sessionID, self.factory.profilename, why)
+        self.stats.quotaDisconnects += 1
+        self.outcome = "quota"
+        self.quotas = False
+        globalDockerPorts.timerWheel.cancel(self)
+        self.transport.loseConnection()
 
 
 class DockerProxyFactory(ProxyFactory):
@@ -366,15 +2911,413 @@ class DockerProxyFactory(ProxyFactory):
         self.profilename = profilename
 
 
-if __name__ == "__main__":
-    import sys
+# With workers, the process that was started becomes the coordinator. It is the only one
+# to manage containers, so limits hold across all workers. The workers each accept
+# connections on the outer ports, which the kernel balances between them using
+# SO_REUSEPORT, and ask the coordinator for instances over a UNIX socket.
+
+class CreateInstance(amp.Command):
+    # request numbers the request for CancelCreate
+    arguments = [(b"profilename", amp.Unicode()), (b"resumekey", amp.Unicode(optional=True)), (b"request", amp.Integer(optional=True))]
+    # a key of 0 means that the limit was reached
+    response = [(b"key", amp.Integer()), (b"middlehost", amp.Unicode()), (b"middleport", amp.Integer()), (b"instanceid", amp.Unicode())]
+    errors = {DockerInstanceStartError: b"START_FAILED"}
+
+# the session that asked for an instance is gone, so it should stop waiting for one
+class CancelCreate(amp.Command):
+    arguments = [(b"request", amp.Integer())]
+    requiresAnswer = False
+
+class DestroyInstance(amp.Command):
+    arguments = [(b"key", amp.Integer()), (b"resumekey", amp.Unicode(optional=True))]
+    requiresAnswer = False
+
+# JSON object of profilename to counters, see RemoteDockerPorts._reportStats
+class ReportStats(amp.Command):
+    arguments = [(b"stats", amp.Unicode())]
+    requiresAnswer = False
+
+# The coordinator asks the workers about their sessions for the admin socket, and passes
+# on what it is told to do with them
+class ListSessions(amp.Command):
+    # sessions per answer, each of them well below 200 bytes of JSON
+    BATCHSIZE = 250
+    # the sessions with a sessionNumber above after, up to the one numbered last
+    arguments = [(b"after", amp.Integer())]
+    response = [(b"sessions", amp.Unicode()), (b"last", amp.Integer()), (b"more", amp.Boolean())]
+
+class KillSession(amp.Command):
+    arguments = [(b"session", amp.Unicode())]
+    response = [(b"killed", amp.Boolean())]
+
+class DrainProfile(amp.Command):
+    arguments = [(b"profilename", amp.Unicode()), (b"drained", amp.Boolean())]
+    requiresAnswer = False
+
+# The coordinator's end of the connection to a worker
+class CoordinatorProtocol(amp.AMP):
+    def __init__(self, dockerports):
+        super().__init__()
+        self.dockerports = dockerports
+        self.instances = dict()
+        self.keys = itertools.count(1)
+        self.pending = dict()
+        self.sessionsActive = dict()
+        self.disconnected = False
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.dockerports.workerProtocols.add(self)
+        # a restarted worker starts out with all profiles open
+        for profilename in self.dockerports.drainedProfiles:
+            self.callRemote(DrainProfile, profilename=profilename, drained=True)
+
+    @CreateInstance.responder
+    def createInstance(self, profilename, resumekey=None, request=None):
+        def created(instance):
+            if instance == None:
+                return {"key": 0, "middlehost": "", "middleport": 0, "instanceid": ""}
+            if self.disconnected:
+                self.dockerports.destroy(instance)
+                return {"key": 0, "middlehost": "", "middleport": 0, "instanceid": ""}
+            key = next(self.keys)
+            self.instances[key] = instance
+            return {"key": key, "middlehost": instance.getMiddleHost(), "middleport": instance.getMiddlePort(), "instanceid": instance.getInstanceID()}
+        # the profile may have been dropped after a reload, before the worker noticed
+        if profilename not in self.dockerports.imageParams:
+            return created(None)
+        d = self.dockerports.create(profilename, resumekey)
+        if request != None:
+            self.pending[request] = d
+        def answered(result):
+            self.pending.pop(request, None)
+            return result
+        def cancelled(failure):
+            failure.trap(defer.CancelledError)
+            return None
+        return d.addBoth(answered).addErrback(cancelled).addCallback(created)
+
+    @CancelCreate.responder
+    def cancelCreate(self, request):
+        d = self.pending.pop(request, None)
+        if d != None:
+            d.cancel()
+        return {}
+
+    @DestroyInstance.responder
+    def destroyInstance(self, key, resumekey=None):
+        instance = self.instances.pop(key, None)
+        if instance != None:
+            self.dockerports.destroy(instance, resumekey)
+        return {}
+
+    @ReportStats.responder
+    def reportStats(self, stats):
+        for (profilename, counters) in json.loads(stats).items():
+            if profilename not in self.dockerports.stats:
+                continue
+            st = self.dockerports.stats[profilename]
+            st.sessionsTotal += counters["sessionsTotal"]
+            st.quotaDisconnects += counters["quotaDisconnects"]
+            st.bytesUp += counters["bytesUp"]
+            st.bytesDown += counters["bytesDown"]
+            st.sessionsActive += counters["sessionsActive"] - self.sessionsActive.get(profilename, 0)
+            self.sessionsActive[profilename] = counters["sessionsActive"]
+        return {}
 
-    globalDockerPorts = DockerPorts()
-    portsAndNames = globalDockerPorts.readConfig(sys.argv[1] if len(sys.argv) > 1 else '/etc/docker-tcp-switchboard.conf')
+    def connectionLost(self, reason):
+        # the worker is gone, and so are its sessions
+        self.disconnected = True
+        self.dockerports.workerProtocols.discard(self)
+        super().connectionLost(reason)
+        for d in list(self.pending.values()):
+            d.cancel()
+        self.pending = dict()
+        for instance in self.instances.values():
+            self.dockerports.destroy(instance)
+        self.instances = dict()
+        for (profilename, active) in self.sessionsActive.items():
+            if profilename in self.dockerports.stats:
+                self.dockerports.stats[profilename].sessionsActive -= active
+
+class CoordinatorFactory(protocol.Factory):
+    def __init__(self, dockerports):
+        self.dockerports = dockerports
+
+    def buildProtocol(self, addr):
+        return CoordinatorProtocol(self.dockerports)
+
+# The worker's end of the connection to the coordinator
+class WorkerProtocol(amp.AMP):
+    def __init__(self, dockerports):
+        super().__init__()
+        self.dockerports = dockerports
 
-    for (name, outerport) in portsAndNames.items():
-        logger.debug("Listening on port {}".format(outerport))
-        reactor.listenTCP(outerport, DockerProxyFactory(name), interface=sys.argv[2] if len(sys.argv) > 2 else '')
-    reactor.run()
+    @ListSessions.responder
+    def listSessions(self, after):
+        sessions = [session for session in self.dockerports._localSessions() if session.sessionNumber > after]
+        batch = sessions[:ListSessions.BATCHSIZE]
+        last = batch[-1].sessionNumber if len(batch) > 0 else after
+        return {"sessions": json.dumps([session.describe() for session in batch]), "last": last, "more": len(sessions) > len(batch)}
+
+    @KillSession.responder
+    def killSession(self, session):
+        return self.dockerports.killSession(session).addCallback(lambda killed: {"killed": killed})
+
+    @DrainProfile.responder
+    def drainProfile(self, profilename, drained):
+        if profilename in self.dockerports.imageParams:
+            self.dockerports.drain(profilename, drained)
+        return {}
 
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        # without the coordinator, there is nothing left to do
+        if reactor.running:
+            reactor.stop()
+
+# Starts a worker process, and starts it again if it exits while the coordinator is running
+class WorkerProcess(protocol.ProcessProtocol):
+    RESTARTDELAY = 1.0
+
+    def __init__(self, args):
+        self.args = args
+        self.ended = defer.Deferred()
+        self.stopping = False
+
+    def spawn(self):
+        logger.debug("Starting worker %s", self.args)
+        reactor.spawnProcess(self, sys.executable, [sys.executable] + self.args, env=os.environ, childFDs={0: "w", 1: 1, 2: 2})
+
+    def processEnded(self, reason):
+        if self.stopping:
+            self.ended.callback(None)
+            return
+        logger.warning("Worker exited (%s), restarting it", reason.getErrorMessage())
+        reactor.callLater(self.RESTARTDELAY, self.spawn)
+
+    def reload(self):
+        try:
+            self.transport.signalProcess("HUP")
+        except Exception:
+            pass
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.transport.signalProcess("TERM")
+        except Exception:
+            return defer.succeed(None)
+        return self.ended
+
+# The instance a worker got from the coordinator
+class RemoteInstance():
+    def __init__(self, profilename, key, middlehost, middleport, instanceid):
+        self.key = key
+        self._profilename = profilename
+        self._middlehost = middlehost
+        self._middleport = middleport
+        self._instanceid = instanceid
 
+    def getProfileName(self):
+        return self._profilename
+
+    def getMiddlePort(self):
+        return self._middleport
+
+    def getMiddleHost(self):
+        return self._middlehost
+
+    def getInstanceID(self):
+        return self._instanceid
+
+# Stands in for DockerPorts in a worker process: it reads the same configfile for the
+# settings of the sessions, but leaves creating and destroying instances to the coordinator.
+class RemoteDockerPorts(DockerPorts):
+    STATSINTERVAL = 5
+
+    def __init__(self):
+        super().__init__()
+        self.coordinator = None
+        self.requests = itertools.count(1)
+        self.reported = dict()
+        self.statsReporter = task.LoopingCall(self._reportStats)
+
+    def registerProxy(self, profilename, conf):
+        self.imageParams[profilename] = conf
+        self.stats[profilename] = ProfileStats()
+
+    def _retireProfile(self, profilename):
+        self.retiredProfiles.add(profilename)
+        self._closeListener(profilename)
+        self.dropIfRetired(profilename)
+
+    # workers do not start containers
+    def _apiVersion(self, hostname):
+        return None
+
+    def _connectHosts(self):
+        pass
+
+    def dropIfRetired(self, profilename):
+        if profilename not in self.retiredProfiles or len(self.stats[profilename].sessions) > 0:
+            return
+        for byName in [self.imageParams, self.stats, self.reported]:
+            byName.pop(profilename, None)
+        self.retiredProfiles.discard(profilename)
+        self.drainedProfiles.discard(profilename)
+
+    def _updateProfile(self, profilename, conf, changes):
+        self.imageParams[profilename] = conf
+        if "outerport" in changes:
+            self._closeListener(profilename)
+            self._openListener(profilename)
+
+    def _listenTCP(self, port, factory):
+        return listenReusePort(port, factory, self.interface, self.listenBacklog)
+
+    def drain(self, profilename, drained=True):
+        if drained:
+            self.drainedProfiles.add(profilename)
+            self._closeListener(profilename)
+        else:
+            self.drainedProfiles.discard(profilename)
+            if profilename not in self.retiredProfiles:
+                self._openListener(profilename)
+
+    def connectCoordinator(self, socketpath):
+        d = protocol.ClientCreator(reactor, WorkerProtocol, self).connectUNIX(socketpath)
+        def connected(coordinator):
+            self.coordinator = coordinator
+            return coordinator
+        return d.addCallback(connected)
+
+    def start(self):
+        self.statsReporter.start(self.STATSINTERVAL, now=False)
+
+    def shutdown(self):
+        if self.statsReporter.running:
+            self.statsReporter.stop()
+        self.timerWheel.stop()
+
+    def create(self, profilename, resumeKey=None):
+        # if the session is gone before the coordinator answers, it stops waiting for an
+        # instance. If it answers anyway, give the instance back.
+        cancelled = []
+        request = next(self.requests)
+        def cancel(d):
+            cancelled.append(True)
+            if self.coordinator.transport.connected:
+                self.coordinator.callRemote(CancelCreate, request=request)
+        result = defer.Deferred(cancel)
+        def answered(response):
+            instance = None
+            if response["key"] != 0:
+                instance = RemoteInstance(profilename, response["key"], response["middlehost"], response["middleport"], response["instanceid"])
+            if cancelled:
+                if instance != None:
+                    self.destroy(instance)
+                return
+            result.callback(instance)
+        def failed(failure):
+            if not cancelled:
+                result.errback(failure)
+        self.coordinator.callRemote(CreateInstance, profilename=profilename, resumekey=resumeKey, request=request).addCallbacks(answered, failed)
+        return result
+
+    def destroy(self, instance, resumeKey=None):
+        if self.coordinator != None and self.coordinator.transport.connected:
+            self.coordinator.callRemote(DestroyInstance, key=instance.key, resumekey=resumeKey)
+
+    def _reportStats(self):
+        # counters are sent as increments since the last report, sessionsActive as is
+        report = dict()
+        for (profilename, st) in self.stats.items():
+            last = self.reported.get(profilename, (0, 0, 0, 0))
+            current = (st.sessionsTotal, st.quotaDisconnects) + st.traffic()
+            report[profilename] = {
+                "sessionsTotal": current[0] - last[0],
+                "quotaDisconnects": current[1] - last[1],
+                "bytesUp": current[2] - last[2],
+                "bytesDown": current[3] - last[3],
+                "sessionsActive": st.sessionsActive,
+            }
+            self.reported[profilename] = current
+        self.coordinator.callRemote(ReportStats, stats=json.dumps(report))
+
+# Listens on a port that other processes may listen on as well, with the kernel
+# spreading incoming connections over them
+def listenReusePort(port, factory, interface, backlog):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((interface, port))
+    s.listen(backlog)
+    s.setblocking(False)
+    listener = reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+    s.close()
+    return listener
+
+
+if __name__ == "__main__":
+    configfile = sys.argv[1] if len(sys.argv) > 1 else '/etc/docker-tcp-switchboard.conf'
+    interface = sys.argv[2] if len(sys.argv) > 2 else ''
+
+    if len(sys.argv) > 4 and sys.argv[3] == "--worker":
+        globalDockerPorts = RemoteDockerPorts()
+        globalDockerPorts.readConfig(configfile)
+        reactor.addSystemEventTrigger("before", "shutdown", globalDockerPorts.shutdown)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(globalDockerPorts.reload, configfile))
+
+        def coordinatorConnected(coordinator):
+            globalDockerPorts.start()
+            logger.debug("Worker %s listening", os.getpid())
+            globalDockerPorts.listen(interface)
+        def coordinatorFailed(failure):
+            logger.error("Worker %s failed to connect to coordinator: %s", os.getpid(), failure.getErrorMessage())
+            reactor.stop()
+        reactor.callWhenRunning(lambda: globalDockerPorts.connectCoordinator(sys.argv[4]).addCallbacks(coordinatorConnected, coordinatorFailed))
+        reactor.run()
+        sys.exit(0)
+
+    globalDockerPorts = DockerPorts()
+    globalDockerPorts.readConfig(configfile)
+    globalDockerPorts.start()
+    reactor.addSystemEventTrigger("before", "shutdown", globalDockerPorts.shutdown)
+
+    if globalDockerPorts.metricsPort != None:
+        logger.debug("Serving metrics on port %s", globalDockerPorts.metricsPort)
+        reactor.listenTCP(globalDockerPorts.metricsPort, server.Site(MetricsResource(globalDockerPorts)), interface=globalDockerPorts.metricsInterface)
+
+    if globalDockerPorts.adminSocket != None:
+        logger.debug("Serving the admin API on %s", globalDockerPorts.adminSocket)
+        if os.path.exists(globalDockerPorts.adminSocket):
+            os.unlink(globalDockerPorts.adminSocket)
+        reactor.listenUNIX(globalDockerPorts.adminSocket, server.Site(AdminResource(globalDockerPorts)), mode=0o600)
+
+    if globalDockerPorts.workers > 0:
+        coordinatorSocket = globalDockerPorts.coordinatorSocket
+        if coordinatorSocket == None:
+            socketDir = tempfile.mkdtemp(prefix="docker-tcp-switchboard.")
+            reactor.addSystemEventTrigger("after", "shutdown", shutil.rmtree, socketDir, True)
+            coordinatorSocket = os.path.join(socketDir, "coordinator.sock")
+        logger.debug("Starting %s workers, coordinating on %s", globalDockerPorts.workers, coordinatorSocket)
+        if os.path.exists(coordinatorSocket):
+            os.unlink(coordinatorSocket)
+        reactor.listenUNIX(coordinatorSocket, CoordinatorFactory(globalDockerPorts), mode=0o600)
+        workerProcesses = [WorkerProcess([os.path.abspath(__file__), configfile, interface, "--worker", coordinatorSocket])
+            for _ in range(globalDockerPorts.workers)]
+        for worker in workerProcesses:
+            reactor.callWhenRunning(worker.spawn)
+        reactor.addSystemEventTrigger("before", "shutdown", lambda: defer.DeferredList([worker.stop() for worker in workerProcesses]))
+    else:
+        workerProcesses = []
+        globalDockerPorts.listen(interface)
+
+    # reload the config on SIGHUP, and have the workers do the same
+    def reload():
+        globalDockerPorts.reload(configfile)
+        for worker in workerProcesses:
+            worker.reload()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(reload))
+    reactor.run()
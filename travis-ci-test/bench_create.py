@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Measures what building the request to create a container costs per spawn, with the
+# Docker SDK, but without a daemon: the request is built and then dropped instead of
+# sent. "run" converts the dockeroptions of the profile on every spawn, as
+# containers.run() does, "spec" uses the arguments the profile's spec converted them to
+# when the configfile was read.
+#
+# usage: ./bench_create.py [requests]
+
+import docker
+import importlib.util
+import os, sys, tempfile, time
+
+def loadSwitchboard():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker-tcp-switchboard.py")
+    spec = importlib.util.spec_from_file_location("switchboard", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+CONFIG = """
+[global]
+loglevel = WARNING
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+checkupport = 8001
+
+[dockeroptions:echo]
+mem_limit = 64m
+cpu_quota = 50000
+pids_limit = 64
+dns = [ "8.8.8.8", "1.2.3.4" ]
+cap_drop = [ "ALL" ]
+environment = { "SERVICE": "echo", "GREETING": "hello" }
+labels = [ "ctf" ]
+"""
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sb = loadSwitchboard()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "config.ini")
+        with open(fn, "w") as f:
+            f.write(CONFIG)
+        ports = sb.DockerPorts()
+        ports.readConfig(fn)
+    spec = ports.imageParams["echo"]
+
+    # the client never connects, the request it builds is kept instead of sent
+    api = docker.APIClient(base_url="unix:///nonexistent.sock", version=docker.constants.DEFAULT_DOCKER_API_VERSION)
+    sent = []
+    api.create_container_from_config = lambda config, name=None, platform=None: sent.append(config) or {"Id": "none"}
+
+    def run():
+        args = sb.createContainerArgs(dict(sb.thawed(spec.dockeroptions), image=spec.containername, command=None, version=api.api_version))
+        api.create_container(**args)
+
+    def precompiled():
+        api.create_container(**spec.createArgs(api.api_version))
+
+    built = dict()
+    for (name, build) in [("run", run), ("spec", precompiled)]:
+        for _ in range(requests // 10):
+            build()
+        sent.clear()
+        started = time.perf_counter()
+        for _ in range(requests):
+            build()
+        elapsed = time.perf_counter() - started
+        print("{:<16} {:8.1f} us per request".format(name, elapsed / requests * 1e6))
+        built[name] = sent[-1]
+
+    # both build the same request
+    if built["run"] != built["spec"]:
+        print("requests differ:\n{}\n{}".format(built["run"], built["spec"]))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Measures what logging costs per session. Sessions connect and disconnect one after
+# another through the switchboard, on a shared container of the in-process fake docker,
+# with the log at INFO and at DEBUG, and with the event log on top.
+#
+# usage: ./bench_logging.py [sessions]
+
+import fakedocker
+fakedocker.install()
+from switchboardtest import loadSwitchboard
+
+from twisted.internet import reactor, defer, protocol
+import logging
+import os, sys, tempfile, time
+
+CONFIG = """
+[global]
+logfile = {tmpdir}/switchboard.log
+loglevel = INFO
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+reuse = true
+"""
+
+class Session(protocol.Protocol):
+    def dataReceived(self, data):
+        if not self.factory.hold:
+            self.transport.write(b"quit\n")
+        elif not self.factory.done.called:
+            self.factory.done.callback(None)
+
+    def connectionLost(self, reason):
+        if not self.factory.done.called:
+            self.factory.done.callback(None)
+
+def session(port, hold=False):
+    factory = protocol.ClientFactory.forProtocol(Session)
+    factory.done = defer.Deferred()
+    factory.hold = hold
+    reactor.connectTCP("127.0.0.1", port, factory)
+    return factory.done
+
+@defer.inlineCallbacks
+def run(sb, ports, tmpdir, sessions):
+    port = ports.listeners["echo"].getHost().port
+    # start the shared container, and keep it around
+    yield session(port, hold=True)
+
+    for (name, level, eventlog) in [("INFO", logging.INFO, False), ("DEBUG", logging.DEBUG, False), ("INFO+eventlog", logging.INFO, True)]:
+        sb.logger.setLevel(level)
+        if eventlog:
+            ports.eventLog = sb.EventLog(os.path.join(tmpdir, "events.jsonl"))
+        for _ in range(sessions // 10):
+            yield session(port)
+        started = time.perf_counter()
+        for _ in range(sessions):
+            yield session(port)
+        elapsed = time.perf_counter() - started
+        if eventlog:
+            ports.eventLog.close()
+            ports.eventLog = None
+        print("{:<16} {:8.1f} us per session".format(name, elapsed / sessions * 1e6))
+    reactor.stop()
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    sb = loadSwitchboard()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "config.ini")
+        with open(fn, "w") as f:
+            f.write(CONFIG.format(tmpdir=tmpdir))
+        ports = sb.DockerPorts()
+        sb.globalDockerPorts = ports
+        ports.readConfig(fn)
+        ports.listen("127.0.0.1")
+        reactor.addSystemEventTrigger("before", "shutdown", ports.shutdown)
+        reactor.callWhenRunning(run, sb, ports, tmpdir, sessions)
+        reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Measures the aggregate relay throughput of the switchboard by the number of workers,
+# against fakedocker.py. The switchboard runs as it would from the command line, in a
+# child process that has fakedocker.py installed, so with workers it spawns them as usual.
+# Several load generators, benchmark.py --client, echo --bytes through every session at
+# once. The fake containers all run in the coordinator, so with enough workers they
+# become what limits the throughput.
+#
+# usage: ./bench_workers.py [--workers 0,1,2,4] [--sessions 64] [--clients 4] [--bytes 4194304]
+
+import argparse
+import json
+import os, runpy, socket, subprocess, sys, tempfile, time
+
+SWITCHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker-tcp-switchboard.py")
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.py")
+
+CONFIG = """
+[global]
+logfile = {tmpdir}/switchboard.log
+loglevel = WARNING
+reaperinterval = 0
+dockerthreads = 16
+workers = {workers}
+
+[profile:relay]
+container = echo
+outerport = {port}
+innerport = 8000
+"""
+
+def freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def waitListening(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The switchboard does not listen on port {}".format(port))
+
+def measure(args, workers):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        port = freePort()
+        fn = os.path.join(tmpdir, "config.ini")
+        with open(fn, "w") as f:
+            f.write(CONFIG.format(tmpdir=tmpdir, workers=workers, port=port))
+        switchboard = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--switchboard", fn])
+        try:
+            waitListening(port)
+            # the first worker to listen does not mean that all of them do
+            time.sleep(2 if workers > 0 else 0)
+            sessions = args.sessions // args.clients
+            clients = [subprocess.Popen([sys.executable, BENCHMARK, "--client", str(port), str(sessions), str(args.bytes), "2000"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True) for _ in range(args.clients)]
+            connected = [json.loads(client.stdout.readline()) for client in clients]
+            started = time.perf_counter()
+            for client in clients:
+                client.stdin.write("go\n")
+                client.stdin.flush()
+            echoed = [json.loads(client.stdout.readline()) for client in clients]
+            elapsed = time.perf_counter() - started
+            for client in clients:
+                client.wait()
+        finally:
+            switchboard.terminate()
+            switchboard.wait()
+    relayed = sum(result["bytes"] for result in echoed)
+    return {"workers": workers, "sessions": sum(result["connected"] for result in connected),
+        "failed": sum(result["failed"] for result in connected), "relay_bytes": relayed,
+        "elapsed": elapsed, "relay_mbytes_per_second": relayed / elapsed / 1e6}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="0,1,2,4", type=lambda x: [int(n) for n in x.split(",")], help="numbers of workers to measure")
+    parser.add_argument("--sessions", default=64, type=int, help="concurrent sessions")
+    parser.add_argument("--clients", default=4, type=int, help="load generator processes to spread the sessions over")
+    parser.add_argument("--bytes", default=4194304, type=int, help="bytes every session echoes")
+    parser.add_argument("--switchboard", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.switchboard:
+        import fakedocker
+        fakedocker.install()
+        sys.argv = [SWITCHBOARD, args.switchboard, "127.0.0.1"]
+        runpy.run_path(SWITCHBOARD, run_name="__main__")
+        return
+
+    results = []
+    for workers in args.workers:
+        result = measure(args, workers)
+        print("{} workers: {}".format(workers, json.dumps(result)), file=sys.stderr)
+        results += [result]
+    print(json.dumps({"cpus": os.cpu_count(), "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+# Benchmarks the switchboard without docker: the switchboard runs in this process against
+# fakedocker.py, and the sessions come from a child process running this script with
+# --client. For every number of concurrent sessions it measures
+#
+# - spawn: every session gets a container of its own. Connect-to-first-byte latency,
+#   containers started per second, memory per session and docker API calls per session.
+# - relay: all sessions share one container. Connect-to-first-byte latency, memory per
+#   session, and relay throughput while every session echoes --bytes through it.
+# - idle: like relay, but the sessions stay idle. Memory the switchboard allocates per
+#   session, measured with tracemalloc, leaving out the fake containers.
+# - stream: for every --highwatermarks value, --streamsessions sessions of a profile with
+#   that highwatermark stream --streambytes each through one container as fast as they
+#   can. Relay throughput, and the peak RSS of the switchboard while they stream.
+#
+# The results are printed as JSON, to compare them across commits.
+#
+# usage: ./benchmark.py [--sessions 10,100,1000,10000] [--spawnmax 1000] [--highwatermarks 16384,65536,262144,1048576] [--output results.json]
+
+import fakedocker
+fakedocker.install()
+from switchboardtest import loadSwitchboard
+
+from twisted.internet import reactor, defer, protocol, task, threads
+import argparse
+import json
+import os, sys, platform, resource, subprocess, tempfile, threading, time, tracemalloc
+
+CONFIG = """
+[global]
+logfile = {tmpdir}/switchboard.log
+loglevel = WARNING
+reaperinterval = 0
+dockerthreads = 16
+listenbacklog = 4096
+
+[profile:spawn]
+container = echo
+outerport = 0
+innerport = 8000
+
+[profile:relay]
+container = echo
+outerport = 0
+innerport = 8000
+reuse = true
+"""
+
+STREAMPROFILE = """
+[profile:stream{highwatermark}]
+container = echo
+outerport = 0
+innerport = 8000
+reuse = true
+highwatermark = {highwatermark}
+"""
+
+# sockets the switchboard process needs per session: from the client, to the container,
+# the container's end, and for spawn the container's listening socket
+FDS_PER_SESSION = {"spawn": 4, "relay": 3, "idle": 3, "stream": 3}
+
+# the fake containers, and the event loop they run on
+FAKEDOCKER_FILTERS = [tracemalloc.Filter(False, fakedocker.__file__), tracemalloc.Filter(False, "*/asyncio/*")]
+
+def raiseFileLimit():
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# samples the RSS of this process in a thread, for the largest one while it runs
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+def percentiles(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]}
+
+
+# the load generator, in the child process
+
+class Session(protocol.Protocol):
+    def connectionMade(self):
+        self.firstByte = None
+        self.sent = 0
+        self.echoed = 0
+
+    def dataReceived(self, data):
+        load = self.factory.load
+        if self.firstByte == None:
+            self.firstByte = time.perf_counter()
+            if data.startswith(b"Hello"):
+                load.connected(self)
+            else:
+                load.failed(self)
+            return
+        # send the next chunk once the last one is back, unless streaming
+        self.echoed += len(data)
+        if self.echoed >= load.bytes:
+            load.echoDone(self)
+        elif self.echoed == self.sent and not load.stream:
+            load.send(self)
+
+    def connectionLost(self, reason):
+        if self.firstByte == None:
+            self.factory.load.failed(self)
+        self.factory.load.closed(self)
+
+class SessionFactory(protocol.ClientFactory):
+    protocol = Session
+
+    def __init__(self, load):
+        self.load = load
+        self.started = time.perf_counter()
+
+    def buildProtocol(self, addr):
+        p = super().buildProtocol(addr)
+        p.started = self.started
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self.load.failedConnects += 1
+        self.load.pending -= 1
+        self.load._check()
+
+# writes the bytes of a streaming session whenever its transport has written out the last ones
+class StreamProducer():
+    def __init__(self, session, load):
+        self.session = session
+        self.load = load
+
+    def resumeProducing(self):
+        size = min(self.load.CHUNK * 4, self.load.bytes - self.session.sent)
+        if size == 0:
+            self.session.transport.unregisterProducer()
+            return
+        self.session.sent += size
+        self.session.transport.write(b"x" * size)
+
+    def stopProducing(self):
+        pass
+
+class Load():
+    CHUNK = 16384
+
+    def __init__(self, port, sessions, bytes, rate, stream=False):
+        self.port = port
+        self.sessions = sessions
+        self.bytes = bytes
+        self.rate = rate
+        self.stream = stream
+        self.pending = sessions
+        self.open = set()
+        self.latencies = []
+        self.failedConnects = 0
+        self.failedSessions = 0
+        self.toConnect = sessions
+        self.live = 0
+        self.phase = defer.Deferred()
+        self.phaseName = "connect"
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.connector = task.LoopingCall(self._connectSome)
+        self.connector.start(0.01)
+        return self.phase
+
+    def _connectSome(self):
+        # spread the connects at rate per second, rather than overflowing the listen backlog
+        due = min(self.toConnect, max(1, int(self.rate * 0.01)))
+        for _ in range(due):
+            reactor.connectTCP("127.0.0.1", self.port, SessionFactory(self), timeout=60)
+        self.toConnect -= due
+        if self.toConnect == 0:
+            self.connector.stop()
+
+    def connected(self, session):
+        self.latencies += [(session.firstByte - session.started) * 1000]
+        self.open.add(session)
+        self.live += 1
+        self.pending -= 1
+        self._check()
+
+    def failed(self, session):
+        if session.firstByte != None:
+            session.transport.loseConnection()
+        self.failedSessions += 1
+        self.pending -= 1
+        self._check()
+
+    def closed(self, session):
+        if session in self.open:
+            self.live -= 1
+            if self.live == 0 and self.phase != None and self.phaseName == "close":
+                self._endPhase({})
+
+    def _check(self):
+        if self.pending == 0:
+            self.phaseName = "connected"
+            self._endPhase({"connected": len(self.open), "failed": self.failedConnects + self.failedSessions,
+                "elapsed": time.perf_counter() - self.started, "latency_ms": percentiles(self.latencies)})
+
+    def _endPhase(self, result):
+        d, self.phase = self.phase, defer.Deferred()
+        d.callback(result)
+
+    def echo(self):
+        self.phaseName = "echo"
+        self.echoing = len(self.open)
+        self.echoStarted = time.perf_counter()
+        d = self.phase
+        if self.bytes == 0 or self.echoing == 0:
+            self._endPhase({"bytes": 0, "elapsed": 0})
+            return d
+        for session in self.open:
+            if self.stream:
+                session.transport.registerProducer(StreamProducer(session, self), False)
+            else:
+                self.send(session)
+        return d
+
+    def send(self, session):
+        size = min(self.CHUNK, self.bytes - session.sent)
+        session.sent += size
+        session.transport.write(b"x" * size)
+
+    def echoDone(self, session):
+        self.echoing -= 1
+        if self.echoing == 0:
+            elapsed = time.perf_counter() - self.echoStarted
+            # every byte passes the switchboard twice, to the container and back
+            self._endPhase({"bytes": 2 * self.bytes * len(self.open), "elapsed": elapsed})
+
+    def close(self):
+        self.phaseName = "close"
+        d = self.phase
+        if self.live == 0:
+            self._endPhase({})
+        for session in list(self.open):
+            session.transport.loseConnection()
+        return d
+
+@defer.inlineCallbacks
+def client(port, sessions, bytes, rate, stream):
+    raiseFileLimit()
+    load = Load(port, sessions, bytes, rate, stream)
+    result = yield load.start()
+    print(json.dumps(result), flush=True)
+    yield threads.deferToThread(sys.stdin.readline)
+    result = yield load.echo()
+    print(json.dumps(result), flush=True)
+    yield load.close()
+    reactor.stop()
+
+
+# the switchboard, in this process
+
+class Benchmark():
+    def __init__(self, sb, ports, args):
+        self.sb = sb
+        self.ports = ports
+        self.args = args
+        self.fileLimit = raiseFileLimit()
+        self.results = []
+
+    def call(self, f, *args):
+        return threads.blockingCallFromThread(reactor, f, *args)
+
+    def _idle(self):
+        return len(list(self.ports._allInstances())) == 0 and len(self.ports.reaper) == 0
+
+    def waitIdle(self, timeout=120):
+        deadline = time.time() + timeout
+        while not self.call(self._idle) and time.time() < deadline:
+            time.sleep(0.1)
+
+    def scenario(self, name, sessions, highwatermark=None):
+        needed = sessions * FDS_PER_SESSION[name] + 100
+        if needed > self.fileLimit:
+            return {"scenario": name, "sessions": sessions, "skipped": "needs {} file descriptors, the limit is {}".format(needed, self.fileLimit)}
+
+        profilename = {"spawn": "spawn", "stream": "stream{}".format(highwatermark)}.get(name, "relay")
+        port = self.call(lambda: self.ports.listeners[profilename].getHost().port)
+        stats = self.ports.stats[profilename]
+        self.waitIdle()
+        fakedocker.calls.clear()
+        spawnsBefore = stats.spawnTimes.count
+        rssBefore = rss()
+        bytes = {"relay": self.args.bytes, "stream": self.args.streambytes}.get(name, 0)
+        if name == "idle":
+            tracemalloc.start()
+
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--client", str(port), str(sessions), str(bytes), str(self.args.rate)] +
+            (["--stream"] if name == "stream" else []), stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        connected = json.loads(proc.stdout.readline())
+        rssHeld = rss()
+        if name == "idle":
+            traced = tracemalloc.take_snapshot().filter_traces(FAKEDOCKER_FILTERS)
+            tracemalloc.stop()
+        sampler = RssSampler()
+        sampler.start()
+        proc.stdin.write("go\n")
+        proc.stdin.flush()
+        echoed = json.loads(proc.stdout.readline())
+        rssPeak = sampler.stop()
+        proc.wait()
+        self.waitIdle()
+
+        result = {
+            "scenario": name,
+            "sessions": sessions,
+            "connected": connected["connected"],
+            "failed": connected["failed"],
+            "connect_seconds": connected["elapsed"],
+            "first_byte_latency_ms": connected["latency_ms"],
+            "rss_bytes_per_session": (rssHeld - rssBefore) / max(1, connected["connected"]),
+            "docker_calls": dict(fakedocker.calls),
+            "docker_calls_per_session": dict((k, v / sessions) for (k, v) in fakedocker.calls.items()),
+        }
+        if name == "stream":
+            result["highwatermark"] = highwatermark
+            result["peak_rss_bytes"] = rssPeak
+            result["peak_rss_growth_bytes"] = rssPeak - rssHeld
+        if name == "idle":
+            result["traced_bytes_per_session"] = sum(stat.size for stat in traced.statistics("filename")) / max(1, connected["connected"])
+        if name == "spawn":
+            result["spawns_per_second"] = (stats.spawnTimes.count - spawnsBefore) / connected["elapsed"]
+        if echoed["elapsed"] > 0:
+            result["relay_bytes"] = echoed["bytes"]
+            result["relay_mbytes_per_second"] = echoed["bytes"] / echoed["elapsed"] / 1e6
+        return result
+
+    def run(self):
+        try:
+            for sessions in self.args.sessions:
+                for name in ["spawn", "relay", "idle"]:
+                    if name == "spawn" and sessions > self.args.spawnmax:
+                        continue
+                    result = self.scenario(name, sessions)
+                    print("{} {}: {}".format(name, sessions, json.dumps(result)), file=sys.stderr)
+                    self.results += [result]
+            for highwatermark in self.args.highwatermarks:
+                result = self.scenario("stream", self.args.streamsessions, highwatermark)
+                print("stream highwatermark {}: {}".format(highwatermark, json.dumps(result)), file=sys.stderr)
+                self.results += [result]
+        finally:
+            reactor.callFromThread(reactor.stop)
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", default="10,100,1000,10000", type=lambda x: [int(n) for n in x.split(",")],
+        help="numbers of concurrent sessions to measure")
+    parser.add_argument("--spawnmax", default=1000, type=int, help="largest number of sessions to measure spawning containers with")
+    parser.add_argument("--bytes", default=262144, type=int, help="bytes every session echoes in the relay scenario")
+    parser.add_argument("--rate", default=2000, type=int, help="new connections per second")
+    parser.add_argument("--highwatermarks", default="16384,65536,262144,1048576", type=lambda x: [int(n) for n in x.split(",") if n != ""],
+        help="highwatermark values to measure streaming with, none to leave it out")
+    parser.add_argument("--streamsessions", default=4, type=int, help="concurrent sessions in the stream scenario")
+    parser.add_argument("--streambytes", default=67108864, type=int, help="bytes every session streams in the stream scenario")
+    parser.add_argument("--output", help="file to write the results to, besides stdout")
+    parser.add_argument("--client", nargs=4, type=int, metavar=("PORT", "SESSIONS", "BYTES", "RATE"), help=argparse.SUPPRESS)
+    parser.add_argument("--stream", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        reactor.callWhenRunning(client, *args.client, args.stream)
+        reactor.run()
+        return
+
+    sb = loadSwitchboard()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "config.ini")
+        with open(fn, "w") as f:
+            f.write(CONFIG.format(tmpdir=tmpdir))
+            for highwatermark in args.highwatermarks:
+                f.write(STREAMPROFILE.format(highwatermark=highwatermark))
+        ports = sb.DockerPorts()
+        sb.globalDockerPorts = ports
+        ports.readConfig(fn)
+        ports.start()
+        ports.listen("127.0.0.1")
+        reactor.addSystemEventTrigger("before", "shutdown", ports.shutdown)
+
+        benchmark = Benchmark(sb, ports, args)
+        reactor.callWhenRunning(threading.Thread(target=benchmark.run, daemon=True).start)
+        reactor.run()
+
+    out = json.dumps({
+        "revision": gitRevision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": benchmark.results,
+    }, indent=2)
+    print(out)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Keeps one session busy while a burst of other connections makes the switchboard
+# start containers. The busy session must keep flowing while the containers boot.
+
+from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.internet import reactor
+import sys, time
+
+errorcode = 0
+
+class Pinger(Protocol):
+    def connectionMade(self):
+        self.last = None
+        self.maxgap = 0
+        self.count = 0
+
+    def dataReceived(self, data):
+        now = time.time()
+        if self.last is not None:
+            self.maxgap = max(self.maxgap, now - self.last)
+        self.last = now
+        self.count += 1
+        if self.count > self.factory.pings:
+            self.transport.write("quit\n".encode("utf-8"))
+        else:
+            reactor.callLater(0.1, self.transport.write, "ping\n".encode("utf-8"))
+
+    def connectionLost(self, reason):
+        print("Pinger got {} replies, largest gap between replies {:.2f}s".format(self.count, self.maxgap))
+        global errorcode
+        if self.count <= self.factory.pings or self.maxgap > self.factory.maxgap:
+            errorcode = 1
+        reactor.stop()
+
+class Burst(Protocol):
+    def dataReceived(self, data):
+        self.transport.write("quit\n".encode("utf-8"))
+
+class PingerFactory(ClientFactory):
+    protocol = Pinger
+
+    def __init__(self, pings, maxgap):
+        self.pings = pings
+        self.maxgap = maxgap
+
+    def clientConnectionFailed(self, connector, reason):
+        global errorcode
+        errorcode = 1
+        reactor.stop()
+
+class BurstFactory(ClientFactory):
+    protocol = Burst
+
+burstcount = int(sys.argv[1])
+maxgap = float(sys.argv[2])
+
+reactor.connectTCP("localhost", 2222, PingerFactory(100, maxgap))
+def burst():
+    for x in range(burstcount):
+        reactor.connectTCP("localhost", 2223, BurstFactory())
+reactor.callLater(2, burst)
+
+reactor.run()
+
+sys.exit(errorcode)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# An in-process stand-in for the parts of the Docker SDK that the switchboard uses, for
+# benchmarks that should measure the switchboard rather than the docker daemon.
+# Every container is a server for the echo protocol of testimages/echoserv on an ephemeral
+# port of 127.0.0.1. All of them run on one asyncio event loop in a thread of its own, so
+# there can be thousands. Each base_url is a daemon of its own, so several can be used as
+# docker hosts, and the ones in unreachable fail to connect to and to create containers
+# on, like a daemon that is down. Calls to the API are counted in calls, by name. The checkpoints taken on
+# each daemon are kept in checkpoints, as the paths they would have.
+#
+# install() makes "import docker" return this module.
+
+import asyncio
+import collections
+import itertools
+import sys
+import threading
+import time
+
+# seconds creating and starting a container, and a container.remove() take
+STARTDELAY = 0.0
+# seconds a new client takes to ask the daemon for its API version
+CONNECTDELAY = 0.0
+REMOVEDELAY = 0.0
+# CPUs and bytes of memory each container uses, according to stats()
+CPUUSAGE = 0.01
+MEMORYUSAGE = 16 * 1024 * 1024
+# what the HEALTHCHECK of each container reports, None for images without one
+HEALTH = "healthy"
+
+calls = collections.Counter()
+daemons = collections.defaultdict(dict)
+checkpoints = collections.defaultdict(set)
+unreachable = set()
+_ids = itertools.count()
+_loop = None
+_loopLock = threading.Lock()
+
+def _getLoop():
+    global _loop
+    with _loopLock:
+        if _loop == None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="fakedocker", daemon=True).start()
+        return _loop
+
+def install():
+    sys.modules["docker"] = sys.modules[__name__]
+
+def reset():
+    calls.clear()
+    for daemon in daemons.values():
+        for container in list(daemon.values()):
+            container._shutdown()
+        daemon.clear()
+    checkpoints.clear()
+    unreachable.clear()
+
+class errors():
+    class DockerException(Exception):
+        pass
+
+    class NotFound(DockerException):
+        pass
+
+    class ImageNotFound(NotFound):
+        pass
+
+    class APIError(DockerException):
+        def __init__(self, message, response=None, explanation=None):
+            super().__init__(message)
+            self.response = response
+            self.explanation = explanation
+
+class constants():
+    DEFAULT_DOCKER_API_VERSION = "1.45"
+
+class models():
+    class containers():
+        # what docker run makes of its arguments, left as they are, but for the version
+        def _create_container_args(kwargs):
+            return dict((k, v) for (k, v) in kwargs.items() if k != "version")
+
+class Container():
+    def __init__(self, daemon, image, options):
+        self.id = "fake{}".format(next(_ids))
+        self.image = image
+        self._daemon = daemon
+        self._writers = set()
+        self._server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._echo, "127.0.0.1", 0), _getLoop()).result()
+        port = str(self._server.sockets[0].getsockname()[1])
+        self.status = "running"
+        self.attrs = {
+            "Labels": dict(options.get("labels", {})),
+            "State": dict([("Status", "running")] + ([("Health", {"Status": HEALTH})] if HEALTH != None else [])),
+            "NetworkSettings": {"Ports": dict(("{}/tcp".format(str(p).split("/")[0]), [{"HostIp": "0.0.0.0", "HostPort": port}])
+                for p in options.get("ports", {}).keys())},
+        }
+
+    async def _echo(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            writer.write(b"Hello, this is an echo service!\n")
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if data.lower().startswith(b"quit"):
+                    writer.write(b"Goodbye.\n")
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _shutdown(self):
+        # like docker rm -f, this also drops the connections to the container
+        def close():
+            self._server.close()
+            for writer in list(self._writers):
+                writer.transport.abort()
+        _getLoop().call_soon_threadsafe(close)
+
+    def reload(self):
+        calls["inspect"] += 1
+
+    def remove(self, force=False):
+        calls["remove"] += 1
+        if self.id not in self._daemon:
+            raise errors.NotFound()
+        time.sleep(REMOVEDELAY)
+        del self._daemon[self.id]
+        self._shutdown()
+
+    def pause(self):
+        calls["pause"] += 1
+        self.status = "paused"
+
+    def unpause(self):
+        calls["unpause"] += 1
+        self.status = "running"
+
+    def stats(self, stream=False, decode=None, one_shot=None):
+        calls["stats"] += 1
+        # the counters of a single CPU, which the container has used CPUUSAGE of so far
+        def cpu(system):
+            return {"cpu_usage": {"total_usage": int(system * CPUUSAGE)}, "system_cpu_usage": system, "online_cpus": 1}
+        now = int(time.monotonic() * 1e9)
+        return {
+            "cpu_stats": cpu(now),
+            "precpu_stats": {} if one_shot else cpu(now - 1000000000),
+            "memory_stats": {"usage": MEMORYUSAGE, "limit": 1024 * 1024 * 1024},
+        }
+
+class ContainerCollection():
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def get(self, containerid):
+        calls["inspect"] += 1
+        if containerid not in self._daemon:
+            raise errors.NotFound()
+        return self._daemon[containerid]
+
+    def list(self, all=False, sparse=False, filters=None):
+        calls["list"] += 1
+        containers = list(self._daemon.values())
+        if filters and "label" in filters:
+            (key, value) = filters["label"].split("=", 1)
+            containers = [c for c in containers if c.attrs["Labels"].get(key) == value]
+        return containers
+
+class ImageCollection():
+    def pull(self, repository, tag=None):
+        calls["pull"] += 1
+
+class Response():
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+class APIClient():
+    def __init__(self, base_url):
+        self._base_url = base_url
+        self._daemon = daemons[base_url]
+        self._checkpoints = checkpoints[base_url]
+        self._version = constants.DEFAULT_DOCKER_API_VERSION
+        self.base_url = "http+docker://localhost"
+
+    @property
+    def api_version(self):
+        return self._version
+
+    def create_container(self, image, **options):
+        calls["create"] += 1
+        if self._base_url in unreachable:
+            raise errors.DockerException("Error while fetching server API version: connection refused")
+        time.sleep(STARTDELAY)
+        container = Container(self._daemon, image, options)
+        self._daemon[container.id] = container
+        return {"Id": container.id, "Warnings": []}
+
+    def start(self, containerid):
+        calls["start"] += 1
+
+    def remove_container(self, containerid, force=False):
+        self._daemon[containerid].remove(force=force)
+
+    # the endpoints the SDK has no methods for: taking, restoring from and deleting checkpoints
+    def post(self, url, params=None, json=None):
+        path = url.split("/v{}".format(self._version), 1)[1].split("/")
+        if path[1] != "containers" or path[2] not in self._daemon:
+            return Response(404)
+        if path[3:] == ["checkpoints"]:
+            calls["checkpoint"] += 1
+            self._checkpoints.add("{}/{}".format(json["CheckpointDir"], json["CheckpointID"]))
+            return Response(201)
+        if path[3:] == ["start"] and params != None and "checkpoint" in params:
+            calls["restore"] += 1
+            if "{}/{}".format(params["checkpoint-dir"], params["checkpoint"]) not in self._checkpoints:
+                return Response(500)
+            return Response(204)
+        return Response(404)
+
+    def delete(self, url, params=None):
+        path = url.split("/v{}".format(self._version), 1)[1].split("/")
+        if path[1] != "containers" or path[2] not in self._daemon or path[3] != "checkpoints":
+            return Response(404)
+        calls["deletecheckpoint"] += 1
+        checkpoint = "{}/{}".format(params["dir"], path[4])
+        if checkpoint not in self._checkpoints:
+            return Response(404)
+        self._checkpoints.remove(checkpoint)
+        return Response(204)
+
+class DockerClient():
+    def __init__(self, base_url=None, **options):
+        time.sleep(CONNECTDELAY)
+        if base_url in unreachable:
+            raise errors.DockerException("Error while fetching server API version: connection refused")
+        self.base_url = base_url
+        self.api = APIClient(base_url)
+        self.containers = ContainerCollection(daemons[base_url])
+        self.images = ImageCollection()
+
+    def close(self):
+        pass
+
+def from_env(**options):
+    return DockerClient(None, **options)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Opens a burst of connections at once, which wait for a free slot rather than being
+# rejected. Every one of them must get served, and the switchboard must keep starting
+# containers at a steady rate while it works through them, rather than stall.
+#
+# usage: ./loadclient.py <connections> <window seconds>
+
+from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.internet import reactor
+import sys, time
+
+class Session(Protocol):
+    def connectionMade(self):
+        self.greeted = False
+
+    def dataReceived(self, data):
+        if not self.greeted and b"echo service!" in data:
+            self.greeted = True
+            self.factory.served += [time.time()]
+            self.transport.write("quit\n".encode("utf-8"))
+        elif not self.greeted:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.ended()
+
+class LoadFactory(ClientFactory):
+    protocol = Session
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.served = []
+        self.done = 0
+
+    def ended(self):
+        self.done += 1
+        if self.done == self.connections:
+            reactor.stop()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.ended()
+
+connections = int(sys.argv[1])
+window = float(sys.argv[2])
+
+factory = LoadFactory(connections)
+started = time.time()
+for x in range(connections):
+    reactor.connectTCP("localhost", 2222, factory)
+reactor.run()
+
+# sessions served per window, from the start of the burst until the last one
+served = sorted(factory.served)
+windows = [0] * (int((served[-1] - started) / window) + 1 if len(served) > 0 else 0)
+for t in served:
+    windows[int((t - started) / window)] += 1
+print("Served {} of {} connections in {:.1f}s, per {}s: {}".format(len(served), connections, time.time() - started, window, windows))
+if len(served) < connections or 0 in windows:
+    sys.exit(1)
@@ -0,0 +1,59 @@
+#!/bin/bash -ex
+
+# this test drains a profile on the admin socket while a
+# connection is active, which must keep going, and then
+# kills that connection
+
+ADMIN="curl -sf --unix-socket /tmp/docker-tcp-switchboard-admin.sock"
+
+# start the switchboard
+../docker-tcp-switchboard.py config.ini &
+DAEMONPID=$!
+function cleanup {
+  echo "Cleaning up..."
+  kill -9 $DAEMONPID || true # daemon could already be dead
+  kill -9 $NCPID || true # netcat is hopefully disconnected already
+  cat /tmp/logfile
+  rm -f /tmp/logfile
+}
+trap cleanup EXIT
+
+sleep 2 # give time to startup
+
+# open a connection
+((while true; do echo hi; sleep 1; done; sleep 1000) | nc 0 2222 ) &
+NCPID=$!
+sleep 10
+
+$ADMIN http://localhost/profiles
+$ADMIN http://localhost/containers
+SESSION=$($ADMIN http://localhost/sessions | python3 -c 'import json, sys; print(json.load(sys.stdin)[0]["session"])')
+
+# a drained profile accepts no new connections, but keeps the ones it has
+$ADMIN -X POST http://localhost/profiles/echoserv/drain
+if nc -z 0 2222; then
+	echo "Fail: drained profile accepts connections";
+	false;
+fi
+kill -0 $NCPID
+$ADMIN http://localhost/sessions | grep $SESSION
+
+$ADMIN -X POST http://localhost/profiles/echoserv/undrain
+nc -z 0 2222
+
+# a killed session goes away along with its container
+$ADMIN -X POST http://localhost/sessions/$SESSION/kill
+sleep 5
+if $ADMIN http://localhost/sessions | grep $SESSION; then
+	echo "Fail: killed session is still there";
+	false;
+fi
+
+if [ $(docker ps -aq|wc -l) -eq 0 ];
+then
+	echo "Success: All containers are gone";
+else
+	echo "Fail: Some containers remain";
+	docker ps -a;
+	false;
+fi
@@ -0,0 +1,58 @@
+#!/bin/bash -ex
+
+# this test starts the switchboard with configfiles that each have one bad
+# value in a profile, which must stop it right away with an error naming
+# the problem, rather than when the first session comes in
+
+TMPDIR=$(mktemp -d)
+function cleanup {
+  echo "Cleaning up..."
+  rm -rf $TMPDIR
+}
+trap cleanup EXIT
+
+# expectfail <expected error> <profile options...>
+function expectfail {
+  EXPECTED="$1"
+  shift
+  printf "[global]\nloglevel = WARNING\n\n[profile:echoserv]\n" > $TMPDIR/config.ini
+  printf "%s\n" "$@" >> $TMPDIR/config.ini
+  if timeout 10 ../docker-tcp-switchboard.py $TMPDIR/config.ini 2> $TMPDIR/error; then
+    echo "Fail: switchboard started with a bad config";
+    cat $TMPDIR/config.ini;
+    false;
+  fi
+  cat $TMPDIR/error
+  grep -F "$EXPECTED" $TMPDIR/error
+}
+
+GOOD="container=echoserv innerport=64000"
+
+expectfail "Missing option outerport" container=echoserv innerport=64000
+expectfail "Missing option innerport" container=echoserv outerport=2222
+expectfail "invalid literal for int() with base 10: 'ssh'" $GOOD outerport=ssh
+expectfail "Invalid value 70000 for outerport" $GOOD outerport=70000
+expectfail "Invalid value 0 for innerport" container=echoserv outerport=2222 innerport=0
+expectfail "Invalid value 65536 for checkupport" $GOOD outerport=2222 checkupport=65536
+expectfail "Invalid value -1 for limit" $GOOD outerport=2222 limit=-1
+expectfail "Invalid value nan for idletimeout" $GOOD outerport=2222 idletimeout=nan
+expectfail "Invalid value inf for maxduration" $GOOD outerport=2222 maxduration=inf
+expectfail "Invalid value 0 for highwatermark" $GOOD outerport=2222 highwatermark=0
+expectfail "Unknown truthy value maybe" $GOOD outerport=2222 reuse=maybe
+expectfail "Unknown value magic" $GOOD outerport=2222 readiness=magic
+expectfail "Unknown value nowhere" $GOOD outerport=2222 dockerhosts=nowhere
+expectfail "invalid literal for int() with base 10: '12x'" $GOOD outerport=2222 maxmemory=12x
+expectfail "Invalid dockeroptions" $GOOD outerport=2222 "[dockeroptions:echoserv]" "bogus = 1"
+expectfail "Invalid dockeroptions" $GOOD outerport=2222 "[dockeroptions:echoserv]" "mem_limit = lots"
+expectfail "Invalid value [ \"8.8.8.8\", for dns" $GOOD outerport=2222 "[dockeroptions]" "dns = [ \"8.8.8.8\","
+
+# a good config still starts, and keeps running until it is stopped
+printf "[global]\nloglevel = WARNING\n\n[profile:echoserv]\n" > $TMPDIR/config.ini
+printf "%s\n" $GOOD outerport=2222 "[dockeroptions:echoserv]" "mem_limit = 64m" >> $TMPDIR/config.ini
+if timeout 5 ../docker-tcp-switchboard.py $TMPDIR/config.ini; then
+  echo "Fail: switchboard stopped with a good config";
+  false;
+else
+  [ $? -eq 124 ]
+fi
+echo "Success: All bad configs were refused"
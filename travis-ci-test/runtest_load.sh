@@ -0,0 +1,29 @@
+#!/bin/bash -ex
+
+# this test opens 500 connections at once, which have to wait for
+# free slots and get their containers started at a steady rate
+
+# start the switchboard
+../docker-tcp-switchboard.py config_load.ini &
+DAEMONPID=$!
+function cleanup {
+  echo "Cleaning up..."
+  kill -9 $DAEMONPID || true
+  tail -n 100 /tmp/logfile
+  rm -f /tmp/logfile
+}
+trap cleanup EXIT
+
+sleep 2 # give time to startup
+
+timeout --signal=KILL 1200 ./loadclient.py 500 30
+sleep 10
+
+if [ $(docker ps -aq|wc -l) -eq 0 ]; 
+then 
+	echo "Success: All containers are gone"; 
+else 
+	echo "Fail: Some containers remain"; 
+	docker ps -a; 
+	false; 
+fi
@@ -0,0 +1,157 @@
+# What the test_*.py tests share. They run the switchboard in the test process against
+# fakedocker.py, so they need neither docker nor the test images, with twisted.trial:
+#
+#   python3 -m twisted.trial ./test_*.py
+
+import fakedocker
+fakedocker.install()
+
+from twisted.internet import reactor, defer, protocol, task
+from twisted.protocols import amp
+from twisted.trial import unittest
+import importlib.util
+import os
+
+def loadSwitchboard():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker-tcp-switchboard.py")
+    spec = importlib.util.spec_from_file_location("switchboard", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+switchboard = loadSwitchboard()
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+# A client of the switchboard. It keeps what it received, and until() waits for some of it.
+class Client(protocol.Protocol):
+    def __init__(self):
+        self.received = b""
+        self.waiting = []
+        self.closed = defer.Deferred()
+
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+
+    def dataReceived(self, data):
+        self.received += data
+        for (expected, d) in list(self.waiting):
+            if expected in self.received:
+                self.waiting.remove((expected, d))
+                d.callback(self.received)
+
+    def until(self, expected):
+        if expected in self.received:
+            return defer.succeed(self.received)
+        d = defer.Deferred()
+        self.waiting += [(expected, d)]
+        return d
+
+    def connectionLost(self, reason):
+        for (expected, d) in self.waiting:
+            d.errback(AssertionError("Connection closed without {!r}, after {!r}".format(expected, self.received)))
+        self.waiting = []
+        self.closed.callback(self.received)
+
+# a worker's end of the connection to the coordinator, which leaves the reactor running
+# once it is closed
+class WorkerProtocol(switchboard.WorkerProtocol):
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+
+class SwitchboardTestCase(unittest.TestCase):
+    timeout = 60
+
+    def setUp(self):
+        fakedocker.reset()
+        fakedocker.CPUUSAGE = 0.01
+        fakedocker.MEMORYUSAGE = 16 * 1024 * 1024
+        self.clients = []
+
+    # starts a switchboard with the configfile config, on 127.0.0.1, and stops it again
+    # after the test
+    def startSwitchboard(self, config, dockerports=None):
+        self.configfile = self.mktemp()
+        with open(self.configfile, "w") as f:
+            f.write(config)
+        ports = dockerports if dockerports != None else switchboard.DockerPorts()
+        switchboard.globalDockerPorts = ports
+        ports.readConfig(self.configfile)
+        ports.start()
+        ports.listen("127.0.0.1")
+        self.addCleanup(self.stopSwitchboard, ports)
+        return ports
+
+    # rewrites the configfile with config, and reloads it
+    def reload(self, ports, config):
+        with open(self.configfile, "w") as f:
+            f.write(config)
+        ports.reload(self.configfile)
+
+    @defer.inlineCallbacks
+    def stopSwitchboard(self, ports):
+        for client in self.clients:
+            client.transport.abortConnection()
+        for listener in list(ports.listeners.values()):
+            yield listener.stopListening()
+        yield ports.shutdown()
+        yield ports.reaper.whenIdle()
+        # the sessions notice that their clients are gone
+        yield sleep(0.1)
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    # connects a worker, with the dockerports of its own, to ports as its coordinator
+    @defer.inlineCallbacks
+    def connectWorker(self, ports, workerports):
+        socketpath = self.mktemp()
+        listener = reactor.listenUNIX(socketpath, switchboard.CoordinatorFactory(ports))
+        self.addCleanup(listener.stopListening)
+        worker = yield protocol.ClientCreator(reactor, WorkerProtocol, workerports).connectUNIX(socketpath)
+        self.addCleanup(worker.transport.loseConnection)
+        workerports.coordinator = worker
+        # until the coordinator has noticed it
+        yield self.until(lambda: len(ports.workerProtocols) > 0)
+        return worker
+
+    # waits for condition() to become true, for up to 5 seconds
+    @defer.inlineCallbacks
+    def until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            yield sleep(0.05)
+        self.fail("Condition never became true")
+
+    def port(self, ports, profilename):
+        return ports.listeners[profilename].getHost().port
+
+    # connects to the listener of a profile, and sends header first thing
+    def connect(self, ports, profilename, header=b""):
+        factory = protocol.ClientFactory.forProtocol(Client)
+        factory.connected = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.port(ports, profilename), factory)
+        def connected(client):
+            self.clients += [client]
+            if len(header) > 0:
+                client.transport.write(header)
+            return client
+        return factory.connected.addCallback(connected)
+
+    # connects, and waits for the greeting of the echo service in the container
+    @defer.inlineCallbacks
+    def session(self, ports, profilename, header=b""):
+        client = yield self.connect(ports, profilename, header)
+        yield client.until(b"echo service!\n")
+        return client
+
+    # closes the connection of a client, and waits until the switchboard noticed
+    @defer.inlineCallbacks
+    def close(self, client):
+        client.transport.loseConnection()
+        yield client.closed
+        yield sleep(0.1)
+
+    def containers(self):
+        return sum(len(daemon) for daemon in fakedocker.daemons.values())
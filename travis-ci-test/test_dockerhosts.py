@@ -0,0 +1,117 @@
+# Placing containers on several docker hosts, and leaving out the ones that fail.
+
+from switchboardtest import SwitchboardTestCase, switchboard, fakedocker, sleep
+from twisted.internet import defer
+import random
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+scheduler = {scheduler}
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+"""
+
+HOST = """
+[dockerhost:{name}]
+url = tcp://{name}.invalid:2375
+address = 127.0.0.1
+{options}
+"""
+
+class DockerHostTest(SwitchboardTestCase):
+    # a switchboard with a docker host for every name, and its options
+    def startHosts(self, scheduler, hosts):
+        config = CONFIG.format(scheduler=scheduler)
+        for (name, options) in hosts:
+            config += HOST.format(name=name, options=options)
+        return self.startSwitchboard(config)
+
+    # containers on each docker host
+    def placed(self, names):
+        return [len(fakedocker.daemons["tcp://{}.invalid:2375".format(name)]) for name in names]
+
+    @defer.inlineCallbacks
+    def test_leastLoaded(self):
+        ports = self.startHosts("leastloaded", [("a", ""), ("b", "weight = 2")])
+        for _ in range(6):
+            yield self.session(ports, "echo")
+        self.assertEqual(self.placed(["a", "b"]), [2, 4])
+
+    @defer.inlineCallbacks
+    def test_maxContainers(self):
+        ports = self.startHosts("leastloaded", [("a", "maxcontainers = 1"), ("b", "")])
+        for _ in range(4):
+            yield self.session(ports, "echo")
+        self.assertEqual(self.placed(["a", "b"]), [1, 3])
+        # with both hosts full, sessions are turned away
+        ports.dockerHosts["b"].maxcontainers = 3
+        client = yield self.connect(ports, "echo")
+        received = yield client.closed
+        self.assertNotIn(b"echo service!", received)
+        self.assertEqual(self.placed(["a", "b"]), [1, 3])
+
+    @defer.inlineCallbacks
+    def test_twoChoices(self):
+        # the two hosts picked at random, with their containers at the time
+        samples = []
+        pick = random.sample
+        def sample(population, k):
+            hosts = pick(population, k)
+            samples.append(dict((host.name, len(host.instances)) for host in hosts))
+            return hosts
+        self.patch(switchboard.random, "sample", sample)
+        ports = self.startHosts("twochoices", [("a", ""), ("b", ""), ("c", "")])
+        for _ in range(9):
+            before = self.placed(["a", "b", "c"])
+            yield self.session(ports, "echo")
+            after = self.placed(["a", "b", "c"])
+            (name,) = [name for (name, x, y) in zip(["a", "b", "c"], before, after) if x != y]
+            # the container goes on the less busy of the two
+            self.assertIn(name, samples[-1])
+            self.assertEqual(samples[-1][name], min(samples[-1].values()))
+        self.assertEqual(len(samples), 9)
+
+    @defer.inlineCallbacks
+    def failover(self, scheduler, names):
+        ports = self.startHosts(scheduler, [(name, "") for name in names])
+        host = ports.dockerHosts["a"]
+        host.RETRYAFTER = 0.5
+        fakedocker.unreachable.add("tcp://a.invalid:2375")
+
+        # sessions whose container was to go on the failing host are told to try again,
+        # until it gets skipped
+        failed = 0
+        for _ in range(20):
+            if not host.isAvailable():
+                break
+            client = yield self.connect(ports, "echo")
+            received = yield client.until(b"\n")
+            if b"Failed to start a container" in received:
+                failed += 1
+            yield self.close(client)
+        self.assertEqual(failed, switchboard.DockerHost.MAXFAILURES)
+        for _ in range(6):
+            yield self.session(ports, "echo")
+        self.assertEqual(self.placed(names)[0], 0)
+        self.assertEqual(sum(self.placed(names)), 6)
+
+        # until it gets another try, and succeeds
+        fakedocker.unreachable.clear()
+        yield sleep(0.5)
+        for _ in range(10):
+            if self.placed(names)[0] > 0:
+                break
+            yield self.session(ports, "echo")
+        self.assertEqual(self.placed(names)[0], 1)
+        self.assertTrue(host.isHealthy())
+
+    def test_failoverLeastLoaded(self):
+        return self.failover("leastloaded", ["a", "b"])
+
+    def test_failoverTwoChoices(self):
+        return self.failover("twochoices", ["a", "b", "c"])
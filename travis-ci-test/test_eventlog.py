@@ -0,0 +1,20 @@
+# The event log, which the workers share.
+
+from switchboardtest import switchboard
+from twisted.trial import unittest
+import json
+
+class EventLogTest(unittest.SynchronousTestCase):
+    def test_sharedFile(self):
+        fn = self.mktemp()
+        logs = [switchboard.EventLog(fn) for _ in range(4)]
+        for i in range(5000):
+            for (n, log) in enumerate(logs):
+                log.write({"event": "session", "worker": n, "number": i, "padding": "x" * 200})
+        for log in logs:
+            log.close()
+        # every line is an event of its own
+        with open(fn) as f:
+            events = [json.loads(line) for line in f]
+        for n in range(len(logs)):
+            self.assertEqual([event["number"] for event in events if event["worker"] == n], list(range(5000)))
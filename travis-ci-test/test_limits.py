@@ -0,0 +1,70 @@
+# Waiting for a free slot below the limit of a profile, and spawn limiters.
+
+from switchboardtest import SwitchboardTestCase, switchboard, sleep
+from twisted.internet import defer
+import time
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+{options}
+"""
+
+class LimitTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def test_requeueAtFront(self):
+        queue = switchboard.WaitQueue(maxsize=2, timeout=10)
+        first = queue.wait()
+        second = queue.wait()
+        self.assertTrue(queue.wakeOne())
+        self.assertTrue(first.result)
+        # the woken waiter lost its slot, and goes back in front of the other one, even
+        # though the queue is full
+        since = time.time() - 9.8
+        requeued = queue.wait(since)
+        queue.wakeOne()
+        self.assertTrue(requeued.result)
+        # with the time it had left
+        requeued = queue.wait(since)
+        self.assertEqual(len(queue), 2)
+        yield sleep(0.4)
+        self.assertFalse(requeued.result)
+        self.assertFalse(second.called)
+        second.cancel()
+        second.addErrback(lambda failure: None)
+
+    @defer.inlineCallbacks
+    def test_spawnLimitersReleased(self):
+        ports = self.startSwitchboard(CONFIG.format(options="spawnrate = 100"))
+        for _ in range(3):
+            client = yield self.session(ports, "echo")
+            yield self.close(client)
+        self.assertEqual(ports.spawnLimiters["echo"].active, 0)
+        self.assertEqual(ports.spawnLimiter.active, 0)
+
+    @defer.inlineCallbacks
+    def test_workerCancelsWaiting(self):
+        ports = self.startSwitchboard(CONFIG.format(options="limit = 1\nlimitwait = 30"))
+        client = yield self.session(ports, "echo")
+
+        # a worker, connected to the switchboard as its coordinator
+        worker = switchboard.RemoteDockerPorts()
+        yield self.connectWorker(ports, worker)
+
+        # its session waits for a free slot, until it is gone
+        d = worker.create("echo")
+        yield self.until(lambda: len(ports.limitQueues["echo"]) == 1)
+        d.cancel()
+        d.addErrback(lambda failure: failure.trap(defer.CancelledError))
+        yield self.until(lambda: len(ports.limitQueues["echo"]) == 0)
+        self.assertEqual(ports.limitQueues["echo"].rejected, 0)
+        # so the slot goes to the next session at once
+        yield self.close(client)
+        yield self.session(ports, "echo")
+        self.assertEqual(self.containers(), 1)
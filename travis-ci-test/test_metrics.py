@@ -0,0 +1,52 @@
+# The Prometheus metrics, served over HTTP.
+
+from switchboardtest import SwitchboardTestCase, switchboard
+from twisted.internet import reactor, defer
+from twisted.web import client, server
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+
+[profile:say "hi" \\ there]
+container = echo
+outerport = 0
+innerport = 8000
+"""
+
+class MetricsTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def metrics(self, ports):
+        listener = reactor.listenTCP(0, server.Site(switchboard.MetricsResource(ports)), interface="127.0.0.1")
+        self.addCleanup(listener.stopListening)
+        agent = client.Agent(reactor, pool=client.HTTPConnectionPool(reactor, persistent=False))
+        response = yield agent.request(b"GET", "http://127.0.0.1:{}/metrics".format(listener.getHost().port).encode("ascii"))
+        body = yield client.readBody(response)
+        self.assertEqual(response.code, 200)
+        return body.decode("utf-8").splitlines()
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        ports = self.startSwitchboard(CONFIG)
+        yield self.session(ports, "echo")
+        lines = yield self.metrics(ports)
+        self.assertIn('switchboard_sessions{profile="echo"} 1', lines)
+        self.assertIn('switchboard_sessions_total{profile="echo"} 1', lines)
+        self.assertIn('switchboard_sessions_total{profile="say \\"hi\\" \\\\ there"} 0', lines)
+        self.assertIn('switchboard_spawn_seconds_count{profile="echo"} 1', lines)
+        # every sample is a name, the labels and a value
+        for line in lines:
+            if not line.startswith("#"):
+                self.assertRegex(line, r'^switchboard_[a-z_]+(\{([a-z]+="([^"\\]|\\.)*",?)+\})? \S+$')
+
+    def test_escape(self):
+        metrics = switchboard.MetricsResource(None)
+        out = []
+        metrics._metric(out, "test", "gauge", "Test", [((("profile", 'a"b\\c\nd'),), 1)])
+        self.assertEqual(out[-1], 'switchboard_test{profile="a\\"b\\\\c\\nd"} 1')
@@ -0,0 +1,70 @@
+# The idle pool of prewarmed containers of a profile.
+
+from switchboardtest import SwitchboardTestCase, fakedocker
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+prewarmdelay = 0
+{options}
+"""
+
+class PoolTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def test_hit(self):
+        ports = self.startSwitchboard(CONFIG.format(options="prewarm = 1"))
+        pool = ports.idleByName["echo"]
+        yield self.until(lambda: len(pool) == 1)
+        pooled = pool[0]
+        self.assertEqual(fakedocker.calls["create"], 1)
+        yield self.session(ports, "echo")
+        (session,) = ports.stats["echo"].sessions
+        self.assertIs(session.dockerinstance, pooled)
+        self.assertEqual(ports.poolHits["echo"], 1)
+        # the only container created since is the one that refills the pool
+        yield self.until(lambda: len(pool) == 1)
+        self.assertEqual(fakedocker.calls["create"], 2)
+        self.assertEqual(self.containers(), 2)
+
+    @defer.inlineCallbacks
+    def test_miss(self):
+        ports = self.startSwitchboard(CONFIG.format(options="prewarm = 0\nmaxidle = 2"))
+        pool = ports.idleByName["echo"]
+        yield self.session(ports, "echo")
+        self.assertEqual(ports.poolMisses["echo"], 1)
+        self.assertEqual(ports.poolTarget["echo"], 1)
+        # the pool grows after a miss
+        yield self.until(lambda: len(pool) == 1)
+        self.assertEqual(fakedocker.calls["create"], 2)
+
+    @defer.inlineCallbacks
+    def test_refill(self):
+        ports = self.startSwitchboard(CONFIG.format(options="prewarm = 2"))
+        pool = ports.idleByName["echo"]
+        yield self.until(lambda: len(pool) == 2)
+        for _ in range(2):
+            yield self.session(ports, "echo")
+        self.assertEqual(ports.poolHits["echo"], 2)
+        yield self.until(lambda: len(pool) == 2)
+        self.assertEqual(fakedocker.calls["create"], 4)
+        self.assertEqual(ports.poolMisses["echo"], 0)
+
+    @defer.inlineCallbacks
+    def test_reloadResizes(self):
+        ports = self.startSwitchboard(CONFIG.format(options="prewarm = 1"))
+        pool = ports.idleByName["echo"]
+        yield self.until(lambda: len(pool) == 1)
+        self.reload(ports, CONFIG.format(options="prewarm = 3"))
+        yield self.until(lambda: len(pool) == 3)
+        self.assertEqual(ports.poolTarget["echo"], 3)
+        self.reload(ports, CONFIG.format(options="prewarm = 1"))
+        self.assertEqual(len(pool), 1)
+        yield ports.reaper.whenIdle()
+        self.assertEqual(self.containers(), 1)
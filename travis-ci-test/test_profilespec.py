@@ -0,0 +1,62 @@
+# The settings of a profile, as compiled when the configfile is read.
+
+from switchboardtest import switchboard, fakedocker
+from twisted.trial import unittest
+import operator
+
+CONFIG = """
+[global]
+loglevel = ERROR
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+
+[dockeroptions:echo]
+dns = [ "8.8.8.8" ]
+environment = { "SERVICE": "echo" }
+"""
+
+class ProfileSpecTest(unittest.SynchronousTestCase):
+    def setUp(self):
+        fakedocker.reset()
+        self.configfile = self.mktemp()
+        with open(self.configfile, "w") as f:
+            f.write(CONFIG)
+        self.ports = switchboard.DockerPorts()
+        self.ports.readConfig(self.configfile)
+        self.spec = self.ports.imageParams["echo"]
+
+    def test_compiledForHosts(self):
+        # reading the configfile does not connect to the docker hosts
+        host = self.ports.dockerHosts["local"]
+        self.assertEqual((host.client, host.apiVersion), (None, None))
+        # the arguments get compiled for a host once it is connected
+        fakedocker.constants.DEFAULT_DOCKER_API_VERSION = "1.44"
+        self.addCleanup(setattr, fakedocker.constants, "DEFAULT_DOCKER_API_VERSION", "1.45")
+        host.getClient()
+        self.assertNotIn("1.44", self.spec._createArgs)
+        self.ports._hostConnected(host)
+        self.assertEqual(host.apiVersion, "1.44")
+        self.assertIn("1.44", self.spec._createArgs)
+        # and right away for profiles read after that
+        with open(self.configfile, "w") as f:
+            f.write(CONFIG.replace("8.8.8.8", "1.1.1.1"))
+        self.ports.reload(self.configfile)
+        self.assertIsNot(self.ports.imageParams["echo"], self.spec)
+        self.assertIn("1.44", self.ports.imageParams["echo"]._createArgs)
+
+    def test_readOnly(self):
+        self.assertRaises(AttributeError, setattr, self.spec, "limit", 1)
+        self.assertRaises(TypeError, operator.setitem, self.spec.dockeroptions, "dns", [])
+        self.assertRaises(TypeError, operator.setitem, self.spec.dockeroptions["environment"], "SERVICE", "other")
+        self.assertEqual(self.spec.dockeroptions["dns"], ("8.8.8.8",))
+
+    def test_createArgsCopied(self):
+        version = fakedocker.constants.DEFAULT_DOCKER_API_VERSION
+        args = self.spec.createArgs(version)
+        args["environment"]["SERVICE"] = "changed"
+        args["ports"][9000] = None
+        self.assertEqual(self.spec.createArgs(version)["environment"], {"SERVICE": "echo"})
+        self.assertNotIn(9000, self.spec.createArgs(version)["ports"])
@@ -0,0 +1,57 @@
+# Reading and writing PROXY protocol headers.
+
+from switchboardtest import switchboard
+from twisted.trial import unittest
+from twisted.internet import address
+import struct
+
+IPV4 = (address.IPv4Address("TCP", "192.0.2.1", 40000), address.IPv4Address("TCP", "198.51.100.2", 2222))
+IPV6 = (address.IPv6Address("TCP", "2001:db8::1", 40000), address.IPv6Address("TCP", "2001:db8::2", 2222))
+
+class ProxyHeaderTest(unittest.SynchronousTestCase):
+    def assertRoundTrip(self, version, source, destination):
+        header = switchboard.buildProxyHeader(version, source, destination)
+        self.assertEqual(switchboard.parseProxyHeader(header + b"payload"), (len(header), source, destination, {}))
+
+    def test_roundTrip(self):
+        for version in ["v1", "v2"]:
+            self.assertRoundTrip(version, *IPV4)
+            self.assertRoundTrip(version, *IPV6)
+
+    def test_v1(self):
+        self.assertEqual(switchboard.buildProxyHeader("v1", *IPV4), b"PROXY TCP4 192.0.2.1 198.51.100.2 40000 2222\r\n")
+
+    def test_unknown(self):
+        # the proxy's own connections, or addresses of different families
+        for (version, length) in [("v1", 15), ("v2", 16)]:
+            for (source, destination) in [(None, None), (IPV4[0], None), (IPV4[0], IPV6[1])]:
+                header = switchboard.buildProxyHeader(version, source, destination)
+                self.assertEqual(switchboard.parseProxyHeader(header), (length, None, None, {}))
+        self.assertEqual(switchboard.parseProxyHeader(b"PROXY UNKNOWN 2001:db8::1 2001:db8::2 1 2\r\n"), (43, None, None, {}))
+
+    def test_truncated(self):
+        for header in [switchboard.buildProxyHeader("v1", *IPV6), switchboard.buildProxyHeader("v2", *IPV6)]:
+            for end in range(len(header)):
+                self.assertEqual(switchboard.parseProxyHeader(header[:end]), None)
+
+    def test_tlvs(self):
+        header = switchboard.buildProxyHeader("v2", *IPV4)
+        tlvs = struct.pack("!BH", 0xE0, 5) + b"alice" + struct.pack("!BH", 0x05, 0)
+        header = header[:14] + struct.pack("!H", 12 + len(tlvs)) + header[16:] + tlvs
+        self.assertEqual(switchboard.parseProxyHeader(header), (len(header), IPV4[0], IPV4[1], {0xE0: b"alice", 0x05: b""}))
+        # a TLV that runs past the end of the header
+        header = header[:14] + struct.pack("!H", 12 + len(tlvs) - 1) + header[16:-1]
+        self.assertRaises(ValueError, switchboard.parseProxyHeader, header)
+
+    def test_familyMismatch(self):
+        for header in [b"PROXY TCP6 1.2.3.4 5.6.7.8 1 1\r\n", b"PROXY TCP4 2001:db8::1 2001:db8::2 1 1\r\n", b"PROXY TCP6 2001:db8::1 5.6.7.8 1 1\r\n"]:
+            self.assertRaises(ValueError, switchboard.parseProxyHeader, header)
+
+    def test_malformed(self):
+        for header in [b"PROXY TCP4 1.2.3.4 5.6.7.8 1\r\n", b"PROXY UDP4 1.2.3.4 5.6.7.8 1 1\r\n", b"PROXY TCP4 1.2.3.4 5.6.7.8 1 70000\r\n",
+                b"PROXY TCP4 1.2.3.4 example.com 1 1\r\n", b"PROXY TCP4 " + b"1" * 200, b"GET / HTTP/1.1\r\n"]:
+            self.assertRaises(ValueError, switchboard.parseProxyHeader, header)
+        header = switchboard.buildProxyHeader("v2", *IPV4)
+        # version 1 in the version 2 format, an unknown command, and an address block that is too short
+        for broken in [header[:12] + b"\x11" + header[13:], header[:12] + b"\x22" + header[13:], header[:14] + b"\x00\x08" + header[16:24]]:
+            self.assertRaises(ValueError, switchboard.parseProxyHeader, broken)
@@ -0,0 +1,79 @@
+# Time and traffic limits of sessions.
+
+from switchboardtest import SwitchboardTestCase, switchboard, fakedocker, sleep
+from twisted.internet import defer
+import socket
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+{options}
+"""
+
+class QuotaTest(SwitchboardTestCase):
+    # a switchboard whose timer wheel ticks every 0.1 seconds
+    def startQuick(self, options):
+        ports = switchboard.DockerPorts()
+        ports.timerWheel = switchboard.TimerWheel(tick=0.1)
+        self.addCleanup(ports.timerWheel.stop)
+        return self.startSwitchboard(CONFIG.format(options=options), ports)
+
+    @defer.inlineCallbacks
+    def test_idleTimeoutAfterStart(self):
+        # starting the container takes longer than the idle timeout
+        fakedocker.STARTDELAY = 0.5
+        self.addCleanup(setattr, fakedocker, "STARTDELAY", 0.0)
+        ports = self.startQuick("idletimeout = 0.3")
+        client = yield self.session(ports, "echo")
+        client.transport.write(b"still here\n")
+        yield client.until(b"still here\n")
+        self.assertEqual(ports.stats["echo"].quotaDisconnects, 0)
+        # and the session is idle once it has been quiet
+        yield client.closed
+        self.assertEqual(ports.stats["echo"].quotaDisconnects, 1)
+
+    @defer.inlineCallbacks
+    def test_throttleKeepsFlowControl(self):
+        ports = self.startQuick("ratelimit = 1000000\nhighwatermark = 16384")
+        client = yield self.session(ports, "echo")
+        (session,) = ports.stats["echo"].sessions
+        # with small socket buffers, what does not fit is buffered by the switchboard
+        client.transport.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        session.transport.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        # the client stops reading what the container echoes, so the switchboard has to stop
+        # reading from the container, rather than buffer all of it
+        client.transport.pauseProducing()
+        chunk = b"x" * 65536
+        for _ in range(128):
+            client.transport.write(chunk)
+        for _ in range(10):
+            yield sleep(0.1)
+            transport = session.transport
+            buffered = sum(len(data) for data in transport._tempDataBuffer) + len(transport.dataBuffer) - transport.offset
+            self.assertLessEqual(buffered, 16384 + 2 * 65536)
+        client.transport.resumeProducing()
+
+    @defer.inlineCallbacks
+    def test_underRateLimit(self):
+        ports = self.startQuick("ratelimit = 1000")
+        throttled = []
+        throttle = ports.timerWheel.throttle
+        def recordThrottle(entry):
+            throttled.append(entry)
+            throttle(entry)
+        ports.timerWheel.throttle = recordThrottle
+        # the wheel has not run since it was created
+        yield sleep(0.3)
+        client = yield self.session(ports, "echo")
+        # 60 bytes both ways every 0.3 seconds stays under the 100 bytes of a tick
+        for line in (b"a", b"b", b"c"):
+            client.transport.write(line * 29 + b"\n")
+            yield client.until(line * 29 + b"\n")
+            yield sleep(0.3)
+        self.assertEqual(throttled, [])
@@ -0,0 +1,48 @@
+# Telling that a new container is ready, with the readiness option.
+
+from switchboardtest import SwitchboardTestCase, fakedocker
+from twisted.internet import defer
+import time
+
+CONFIG = """
+[global]
+loglevel = CRITICAL
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+readinesstimeout = 30
+{options}
+"""
+
+class ReadinessTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def test_ready(self):
+        for readiness in ["banner", "tcp", "healthcheck"]:
+            ports = self.startSwitchboard(CONFIG.format(options="readiness = " + readiness))
+            client = yield self.session(ports, "echo")
+            self.assertEqual(ports.stats["echo"].readinessFailures, 0)
+            yield self.close(client)
+            yield self.stopSwitchboard(ports)
+
+    # a container that is not going to become healthy fails at once, rather than after
+    # readinesstimeout
+    @defer.inlineCallbacks
+    def assertFailsAtOnce(self, health):
+        fakedocker.HEALTH = health
+        self.addCleanup(setattr, fakedocker, "HEALTH", "healthy")
+        ports = self.startSwitchboard(CONFIG.format(options="readiness = healthcheck"))
+        started = time.time()
+        client = yield self.connect(ports, "echo")
+        received = yield client.closed
+        self.assertIn(b"Failed to start a container", received)
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(ports.stats["echo"].readinessFailures, 1)
+
+    def test_unhealthy(self):
+        return self.assertFailsAtOnce("unhealthy")
+
+    def test_noHealthcheck(self):
+        return self.assertFailsAtOnce(None)
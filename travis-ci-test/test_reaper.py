@@ -0,0 +1,67 @@
+# Removing containers in the background, and sweeping up the ones nobody knows about.
+
+from switchboardtest import SwitchboardTestCase, switchboard, fakedocker, sleep
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+"""
+
+# stands in for an instance, whose container fails to be removed the first failures times
+class Removable():
+    def __init__(self, name, failures=0):
+        self.name = name
+        self.failures = failures
+
+    def removeContainer(self):
+        self.failures -= 1
+        return self.failures < 0
+
+    def getInstanceID(self):
+        return self.name
+
+class ReaperTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def test_retryLeavesSlot(self):
+        reaper = switchboard.ContainerReaper(lambda: [], concurrency=1)
+        reaper.RETRYDELAY = 0.5
+        flaky = reaper.reap(Removable("flaky", failures=1))
+        other = reaper.reap(Removable("other"))
+        idle = reaper.whenIdle()
+        # the other container gets removed while the first one waits to be tried again
+        yield sleep(0.2)
+        self.assertTrue(other.called)
+        self.assertTrue(other.result)
+        self.assertFalse(flaky.called)
+        self.assertFalse(idle.called)
+        self.assertEqual(len(reaper), 1)
+        removed = yield flaky
+        self.assertTrue(removed)
+        yield idle
+        self.assertEqual((reaper.removed, reaper.failed), (2, 0))
+
+    @defer.inlineCallbacks
+    def test_sweepWhileStarting(self):
+        fakedocker.STARTDELAY = 0.5
+        self.addCleanup(setattr, fakedocker, "STARTDELAY", 0.0)
+        warnings = []
+        self.patch(switchboard.logger, "warning", lambda *args: warnings.append(args))
+        ports = self.startSwitchboard(CONFIG)
+        session = self.session(ports, "echo")
+        yield sleep(0.1)
+        # the starting instance has no container yet, which is nothing to warn about
+        yield ports._sweepOrphans()
+        self.assertEqual(warnings, [])
+        yield session
+        # and its container is known once it has one
+        for _ in range(2):
+            yield ports._sweepOrphans()
+        self.assertEqual(self.containers(), 1)
+        self.assertEqual(warnings, [])
@@ -0,0 +1,109 @@
+# Reloading the profiles from the configfile.
+
+from switchboardtest import SwitchboardTestCase, switchboard, fakedocker, sleep
+from twisted.internet import defer
+import json, time
+
+PROFILE = """
+[profile:{name}]
+container = echo
+outerport = 0
+innerport = 8000
+{options}
+"""
+
+def config(**profiles):
+    return "[global]\nloglevel = ERROR\nreaperinterval = 0\n" + "".join(PROFILE.format(name=name, options=options) for (name, options) in profiles.items())
+
+class ReloadTest(SwitchboardTestCase):
+    def profiles(self, ports):
+        return [profile["profile"] for profile in ports.describeProfiles()]
+
+    @defer.inlineCallbacks
+    def test_addChangeRemove(self):
+        ports = self.startSwitchboard(config(echo="limit = 1", gone=""))
+        client = yield self.session(ports, "gone")
+
+        self.reload(ports, config(echo="limit = 2", added=""))
+        self.assertEqual(ports.imageParams["echo"].limit, 2)
+        added = yield self.session(ports, "added")
+        # the removed profile takes no new sessions, but keeps the one it has
+        self.assertEqual(self.profiles(ports), ["added", "echo", "gone"])
+        self.assertNotIn("gone", ports.listeners)
+        client.transport.write(b"still here\n")
+        yield client.until(b"still here\n")
+
+        # and is gone with its last session
+        yield self.close(client)
+        self.assertEqual(self.profiles(ports), ["added", "echo"])
+        for byName in [ports.imageParams, ports.stats, ports.instancesByName, ports.idleByName, ports.heldByName,
+                ports.limitQueues, ports.spawnLimiters, ports.readinessChecks]:
+            self.assertNotIn("gone", byName)
+        self.assertEqual(self.containers(), 1)
+        yield self.close(added)
+
+        # it can come back with a reload
+        self.reload(ports, config(echo="limit = 2", gone=""))
+        client = yield self.session(ports, "gone")
+        self.assertEqual(self.profiles(ports), ["echo", "gone"])
+
+    # a worker that reports active sessions of a profile, then disconnects once the profile
+    # was dropped, and maybe added again
+    @defer.inlineCallbacks
+    def workerDisconnects(self, addedAgain):
+        ports = self.startSwitchboard(config(echo="", gone=""))
+        worker = yield self.connectWorker(ports, switchboard.RemoteDockerPorts())
+        counters = {"sessionsTotal": 2, "quotaDisconnects": 0, "bytesUp": 0, "bytesDown": 0, "sessionsActive": 2}
+        worker.callRemote(switchboard.ReportStats, stats=json.dumps({"gone": counters}))
+        yield self.until(lambda: ports.stats["gone"].sessionsActive == 2)
+
+        self.reload(ports, config(echo=""))
+        self.assertNotIn("gone", ports.stats)
+        if addedAgain:
+            self.reload(ports, config(echo="", gone=""))
+        worker.transport.loseConnection()
+        while len(ports.workerProtocols) > 0:
+            yield sleep(0.01)
+        return ports
+
+    def test_workerDisconnectsAfterDrop(self):
+        return self.workerDisconnects(False)
+
+    @defer.inlineCallbacks
+    def test_workerDisconnectsAfterReadd(self):
+        ports = yield self.workerDisconnects(True)
+        self.assertEqual(ports.stats["gone"].sessionsActive, 0)
+
+    @defer.inlineCallbacks
+    def test_slowDaemon(self):
+        # a daemon that is down, and takes long to tell, holds up neither the reload nor the
+        # sessions on other docker hosts
+        fakedocker.CONNECTDELAY = 1.0
+        self.addCleanup(setattr, fakedocker, "CONNECTDELAY", 0.0)
+        fakedocker.unreachable.add("tcp://down.invalid:2375")
+        hosts = "".join("[dockerhost:{0}]\nurl = tcp://{0}.invalid:2375\naddress = 127.0.0.1\n".format(name) for name in ["up", "down"])
+        ports = self.startSwitchboard(config(echo="dockerhosts = up") + hosts)
+        started = time.time()
+        self.reload(ports, config(echo="dockerhosts = up, down") + hosts)
+        self.assertLess(time.time() - started, 0.5)
+        yield self.session(ports, "echo")
+        up = ports.dockerHosts["up"]
+        self.assertEqual(up.apiVersion, fakedocker.constants.DEFAULT_DOCKER_API_VERSION)
+        self.assertIn(up.apiVersion, ports.imageParams["echo"]._createArgs)
+        self.assertEqual(ports.dockerHosts["down"].apiVersion, None)
+
+    def test_removeUnused(self):
+        ports = self.startSwitchboard(config(echo="", gone=""))
+        self.reload(ports, config(echo=""))
+        self.assertEqual(self.profiles(ports), ["echo"])
+
+    @defer.inlineCallbacks
+    def test_badConfigKept(self):
+        ports = self.startSwitchboard(config(echo="limit = 1"))
+        before = ports.imageParams["echo"]
+        for bad in [config(echo="limit = -1"), config(echo="limit = 2", broken="readiness = magic"), "[global]\nloglevel = ERROR\n"]:
+            self.reload(ports, bad)
+            self.assertIs(ports.imageParams["echo"], before)
+            self.assertEqual(self.profiles(ports), ["echo"])
+        client = yield self.session(ports, "echo")
+        self.assertEqual(self.containers(), 1)
@@ -0,0 +1,62 @@
+# Admitting new containers by the CPU and memory their profile's containers use.
+
+from switchboardtest import SwitchboardTestCase, fakedocker, sleep
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+statsinterval = 0.2
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+maxmemory = 40m
+{options}
+"""
+
+class ResourceTest(SwitchboardTestCase):
+    def sampled(self, ports, containers):
+        return lambda: ports.resourceMonitor.usage.get("echo", (0, 0, 0))[2] == containers
+
+    @defer.inlineCallbacks
+    def test_refuseThenAdmit(self):
+        ports = self.startSwitchboard(CONFIG.format(options=""))
+        stats = ports.stats["echo"]
+        # the first container is sampled as soon as it runs, which leaves room for a second one
+        yield self.session(ports, "echo")
+        yield self.until(self.sampled(ports, 1))
+        yield self.session(ports, "echo")
+        yield self.until(self.sampled(ports, 2))
+
+        # two containers of 16 MB leave no room for a third one below 40 MB
+        client = yield self.connect(ports, "echo")
+        received = yield client.closed
+        self.assertIn(b"Maximum connection-count reached", received)
+        self.assertEqual(stats.limitRejections, 1)
+
+        # until they use less
+        fakedocker.MEMORYUSAGE = 8 * 1024 * 1024
+        yield sleep(0.5)
+        yield self.session(ports, "echo")
+        self.assertEqual(stats.limitRejections, 1)
+        self.assertEqual(self.containers(), 3)
+
+    @defer.inlineCallbacks
+    def test_oneAtATimeUntilSampled(self):
+        fakedocker.STARTDELAY = 0.3
+        self.addCleanup(setattr, fakedocker, "STARTDELAY", 0.0)
+        ports = self.startSwitchboard(CONFIG.format(options="limitwait = 10"))
+        # the second connection waits for the first container to be sampled
+        sessions = [self.session(ports, "echo") for _ in range(2)]
+        yield sleep(0.05)
+        self.assertEqual(len(ports.limitQueues["echo"]), 1)
+        yield defer.gatherResults(sessions)
+        self.assertEqual(self.containers(), 2)
+        self.assertEqual(ports.stats["echo"].limitRejections, 0)
+
+    def test_maxloadLocalOnly(self):
+        config = CONFIG.format(options="maxload = 1\ndockerhosts = remote") + "\n[dockerhost:remote]\nurl = tcp://192.0.2.1:2375\n"
+        self.assertRaises(SystemExit, self.startSwitchboard, config)
@@ -0,0 +1,74 @@
+# Resuming sessions on held containers, and telling apart clients that share an address.
+
+from switchboardtest import SwitchboardTestCase, switchboard
+from twisted.internet import defer
+import struct
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+resumegrace = 30
+acceptproxy = true
+resumekey = {resumekey}
+"""
+
+# a PROXY protocol v2 header for a client on 127.0.0.1, with TLVs
+def proxyHeader(tlvs):
+    header = switchboard.buildProxyHeader("v2", switchboard.address.IPv4Address("TCP", "127.0.0.1", 40000),
+        switchboard.address.IPv4Address("TCP", "127.0.0.1", 2222))
+    extra = b"".join(struct.pack("!BH", kind, len(value)) + value for (kind, value) in tlvs.items())
+    return header[:14] + struct.pack("!H", struct.unpack_from("!H", header, 14)[0] + len(extra)) + header[16:] + extra
+
+class ResumeTest(SwitchboardTestCase):
+    def instanceOf(self, ports):
+        return [instance.getInstanceID() for instance in ports.instancesByName["echo"]]
+
+    @defer.inlineCallbacks
+    def test_sameAddressOtherClient(self):
+        ports = self.startSwitchboard(CONFIG.format(resumekey="tlv"))
+        alice = yield self.session(ports, "echo", proxyHeader({0xE0: b"alice"}))
+        aliceInstance = self.instanceOf(ports)
+        yield self.close(alice)
+        self.assertEqual(len(ports.heldByName["echo"]), 1)
+
+        # another client behind the same address gets a container of its own
+        bob = yield self.session(ports, "echo", proxyHeader({0xE0: b"bob"}))
+        self.assertNotEqual(self.instanceOf(ports), aliceInstance)
+        self.assertEqual(ports.stats["echo"].resumes, 0)
+        self.assertEqual(len(ports.heldByName["echo"]), 1)
+        yield self.close(bob)
+
+        # and the client that left gets its own back
+        alice = yield self.session(ports, "echo", proxyHeader({0xE0: b"alice"}))
+        self.assertEqual(self.instanceOf(ports), aliceInstance)
+        self.assertEqual(ports.stats["echo"].resumes, 1)
+
+    @defer.inlineCallbacks
+    def test_withoutKeyNotHeld(self):
+        ports = self.startSwitchboard(CONFIG.format(resumekey="tlv"))
+        client = yield self.session(ports, "echo", proxyHeader({0x05: b"unrelated"}))
+        yield self.close(client)
+        self.assertEqual(len(ports.heldByName["echo"]), 0)
+        self.assertEqual(self.containers(), 0)
+
+    @defer.inlineCallbacks
+    def test_ip(self):
+        ports = self.startSwitchboard(CONFIG.format(resumekey="ip"))
+        client = yield self.session(ports, "echo", proxyHeader({}))
+        instance = self.instanceOf(ports)
+        yield self.close(client)
+        client = yield self.session(ports, "echo", proxyHeader({}))
+        self.assertEqual(self.instanceOf(ports), instance)
+        self.assertEqual(ports.stats["echo"].resumes, 1)
+
+    def test_resumekeyNeeded(self):
+        config = CONFIG.replace("resumekey = {resumekey}\n", "")
+        self.assertRaises(SystemExit, self.startSwitchboard, config)
+        config = CONFIG.format(resumekey="tlv").replace("acceptproxy = true\n", "")
+        self.assertRaises(SystemExit, self.startSwitchboard, config)
@@ -0,0 +1,44 @@
+# Sharing containers between sessions, with reuse and reusesessions.
+
+from switchboardtest import SwitchboardTestCase, fakedocker
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+reuse = true
+reusesessions = 3
+"""
+
+class ReuseTest(SwitchboardTestCase):
+    # the instance the session of client is on
+    def instance(self, ports, client):
+        port = client.transport.getHost().port
+        (session,) = [s for s in ports.stats["echo"].sessions if s.transport.getPeer().port == port]
+        return session.dockerinstance
+
+    @defer.inlineCallbacks
+    def test_leastLoaded(self):
+        ports = self.startSwitchboard(CONFIG)
+        clients = []
+        for _ in range(4):
+            clients += [(yield self.session(ports, "echo"))]
+        # the first instance is full, so the fourth session starts another one
+        (first, second) = [self.instance(ports, client) for client in (clients[0], clients[3])]
+        self.assertIsNot(first, second)
+        self.assertEqual((first.sessions, second.sessions), (3, 1))
+        self.assertEqual(fakedocker.calls["create"], 2)
+
+        # with room on both, the next session goes to the one with fewer sessions
+        yield self.close(clients[0])
+        self.assertEqual(first.sessions, 2)
+        client = yield self.session(ports, "echo")
+        self.assertIs(self.instance(ports, client), second)
+        self.assertEqual((first.sessions, second.sessions), (2, 2))
+        self.assertEqual(fakedocker.calls["create"], 2)
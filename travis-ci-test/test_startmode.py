@@ -0,0 +1,73 @@
+# Starting containers from a paused idle pool, and from checkpoints.
+
+from switchboardtest import SwitchboardTestCase, fakedocker
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+{options}
+"""
+
+class StartModeTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def session(self, ports, profilename, header=b""):
+        client = yield super().session(ports, profilename, header)
+        (session,) = ports.stats[profilename].sessions
+        return (client, session.dockerinstance)
+
+    @defer.inlineCallbacks
+    def test_paused(self):
+        ports = self.startSwitchboard(CONFIG.format(options="startmode = paused\nprewarm = 1\nmaxidle = 1"))
+        pool = ports.idleByName["echo"]
+        yield self.until(lambda: len(pool) == 1 and pool[0].isPaused())
+        (client, instance) = yield self.session(ports, "echo")
+        self.assertFalse(instance.isPaused())
+        self.assertEqual(fakedocker.calls["unpause"], 1)
+        self.assertEqual(ports.stats["echo"].startTimes["paused"].count, 1)
+        # the pool gets refilled, and paused again
+        yield self.until(lambda: len(pool) == 1 and pool[0].isPaused())
+        self.assertEqual(fakedocker.calls["pause"], 2)
+
+    @defer.inlineCallbacks
+    def test_checkpoint(self):
+        ports = self.startSwitchboard(CONFIG.format(options="startmode = checkpoint"))
+        # the first container is run, and checkpointed for the ones after it
+        (client, instance) = yield self.session(ports, "echo")
+        self.assertEqual(instance.startMode, "run")
+        self.assertEqual(len(fakedocker.checkpoints[None]), 1)
+        yield self.close(client)
+        (client, instance) = yield self.session(ports, "echo")
+        self.assertEqual(instance.startMode, "checkpoint")
+        self.assertEqual(fakedocker.calls["restore"], 1)
+        yield self.close(client)
+
+        # other settings get a checkpoint of their own, which replaces the old one
+        (old,) = fakedocker.checkpoints[None]
+        self.reload(ports, CONFIG.format(options="startmode = checkpoint\n[dockeroptions:echo]\nmem_limit = 64m"))
+        (client, instance) = yield self.session(ports, "echo")
+        self.assertEqual(instance.startMode, "run")
+        self.assertEqual(fakedocker.calls["deletecheckpoint"], 1)
+        self.assertEqual(len(fakedocker.checkpoints[None]), 1)
+        self.assertNotIn(old, fakedocker.checkpoints[None])
+
+    @defer.inlineCallbacks
+    def test_restoreFails(self):
+        ports = self.startSwitchboard(CONFIG.format(options="startmode = checkpoint"))
+        (client, instance) = yield self.session(ports, "echo")
+        yield self.close(client)
+        fakedocker.checkpoints[None].clear()
+        # the host starts containers normally from then on
+        for _ in range(2):
+            (client, instance) = yield self.session(ports, "echo")
+            self.assertEqual(instance.startMode, "run")
+            yield self.close(client)
+        self.assertFalse(instance.restoreFailed)
+        self.assertEqual(fakedocker.calls["restore"], 1)
+        self.assertEqual(ports.stats["echo"].startFallbacks, 1)
@@ -0,0 +1,65 @@
+# What the coordinator asks the workers about their sessions.
+
+from switchboardtest import SwitchboardTestCase, switchboard
+from twisted.internet import defer
+
+CONFIG = """
+[global]
+loglevel = ERROR
+reaperinterval = 0
+
+[profile:echo]
+container = echo
+outerport = 0
+innerport = 8000
+"""
+
+class Session():
+    def __init__(self, sessionNumber):
+        self.sessionNumber = sessionNumber
+
+    def describe(self):
+        return {"number": self.sessionNumber}
+
+# the dockerports of a worker, with sessions that come and go between two batches
+class WorkerPorts():
+    def __init__(self, numbers):
+        self.sessions = [Session(n) for n in numbers]
+        self.listed = 0
+        self.changes = dict()
+        self.coordinator = None
+
+    def _localSessions(self):
+        (removed, added) = self.changes.pop(self.listed, ([], []))
+        self.sessions = [session for session in self.sessions if session.sessionNumber not in removed] + [Session(n) for n in added]
+        self.listed += 1
+        return sorted(self.sessions, key=lambda session: session.sessionNumber)
+
+class WorkerTest(SwitchboardTestCase):
+    @defer.inlineCallbacks
+    def listed(self, numbers, changes):
+        self.patch(switchboard.ListSessions, "BATCHSIZE", 2)
+        ports = self.startSwitchboard(CONFIG)
+        worker = WorkerPorts(numbers)
+        worker.changes = changes
+        yield self.connectWorker(ports, worker)
+        sessions = yield ports.listSessions()
+        return [session["number"] for session in sessions]
+
+    @defer.inlineCallbacks
+    def test_listSessions(self):
+        listed = yield self.listed(range(1, 6), {})
+        self.assertEqual(listed, [1, 2, 3, 4, 5])
+
+    @defer.inlineCallbacks
+    def test_listedSessionsEnd(self):
+        # sessions that end after they were listed do not make others get left out, and
+        # new ones get listed once
+        listed = yield self.listed(range(1, 8), {1: ([1, 2], [8]), 2: ([], [9])})
+        self.assertEqual(listed, [1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+    @defer.inlineCallbacks
+    def test_unlistedSessionsEnd(self):
+        # sessions that end before they were listed are left out, without listing others twice
+        listed = yield self.listed(range(1, 8), {1: ([5, 6], [])})
+        self.assertEqual(listed, [1, 2, 3, 4, 7])